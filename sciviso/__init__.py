@@ -23,15 +23,37 @@ __author__ = 'Ariane Mora'
 __author_email__ = 'ariane.n.mora@gmail.com'
 __license__ = 'GPL3'
 
-from sciviso.vis import Vis, VisException
-from sciviso.violinplot import Violinplot
-from sciviso.boxplot import Boxplot
-from sciviso.barchart import Barchart
-from sciviso.heatmap import Heatmap
-from sciviso.histogram import Histogram
-from sciviso.scatterplot import Scatterplot
-from sciviso.volcanoplot import Volcanoplot
-from sciviso.emapplot import Emapplot
-from sciviso.line import Line
-from sciviso.sankey import Sankeyplot
-from sciviso.countplot import Countplot
+import importlib
+
+# Charts are imported on first use (PEP 562) so e.g. only needing a Barchart doesn't pull in plotly, networkx or
+# adjustText.
+_lazy_imports = {
+    'Vis': 'sciviso.vis',
+    'VisException': 'sciviso.vis',
+    'Violinplot': 'sciviso.violinplot',
+    'Boxplot': 'sciviso.boxplot',
+    'Barchart': 'sciviso.barchart',
+    'Heatmap': 'sciviso.heatmap',
+    'Histogram': 'sciviso.histogram',
+    'Scatterplot': 'sciviso.scatterplot',
+    'Volcanoplot': 'sciviso.volcanoplot',
+    'Emapplot': 'sciviso.emapplot',
+    'Line': 'sciviso.line',
+    'Sankeyplot': 'sciviso.sankey',
+    'Countplot': 'sciviso.countplot',
+}
+
+__all__ = list(_lazy_imports)
+
+
+def __getattr__(name):
+    module = _lazy_imports.get(name)
+    if module is None:
+        raise AttributeError(f"module 'sciviso' has no attribute '{name}'")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value  # Cache it so __getattr__ isn't called again
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -19,22 +19,26 @@
 ###############################################################################
 from collections import defaultdict
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import seaborn as sns
-from statannot import add_stat_annotation
+from itertools import combinations
 
 from sciviso import Vis
+from sciviso.stats import PairwiseStats
 
 
 class Boxplot(Vis):
     """
     Box plot. Adds stat annotations and returns the SVG or saves it to disk.
-    for stats annotations details see: https://github.com/webermarcolivier/statannot
+    Stats are computed by stats.PairwiseStats, stat_method is one of stats.PAIRWISE_TESTS (same names as statannot)
+    With hue the stats compare (x, hue) groups, so box_pairs are ((x, hue), (x, hue)) tuples, by default each pair of
+    hue groups within each x group.
     """
 
     def __init__(self, df: pd.DataFrame, x: object, y: object, title='', xlabel='', ylabel='', box_colors=None,
                  hue=None, order=None, hue_order=None, showfliers=False, add_dots=False, add_stats=True,
-                 stat_method='Mann-Whitney', box_pairs=None, figsize=(3, 3), config=None):
+                 stat_method='Mann-Whitney', box_pairs=None, figsize=(3, 3), config=None, stat_n_jobs=1):
         super().__init__(df, figsize=figsize)
         self.df = df
         self.x = x
@@ -48,6 +52,8 @@ class Boxplot(Vis):
         self.add_stats = add_stats
         self.stat_method = stat_method
         self.box_pairs = box_pairs
+        self.stat_n_jobs = stat_n_jobs
+        self.stats_df = None
         self.label = 'boxplot'
         self.xlabel = xlabel
         self.ylabel = ylabel
@@ -56,37 +62,38 @@ class Boxplot(Vis):
             self.load_style(config)
 
     def format_data_for_boxplot(self, df: pd.DataFrame, conditions: list, filter_column=None, filter_values=None):
+        """
+        Reshapes a wide dataframe (one column per sample) into the long format used by the boxplot, each column
+        containing a condition becomes a sample of that condition.
+        :param df: dataframe with a column per sample
+        :param conditions: list of conditions, a column belongs to a condition if the condition is in its name
+        :param filter_column: optional column to filter the rows on
+        :param filter_values: the values of filter_column to keep
+        :return: dataframe with Samples, Values and Conditions columns (Samples and Conditions are categorical),
+        ordered by row then condition then sample
+        """
         condition_dict = defaultdict(list)
         for column in df.columns:
             for c in conditions:
                 if c in column:
                     condition_dict[c].append(column)
-
-        # Now lets get the values
-        values = []
-        condition = []
-        samples = []
-        if filter_column is None or filter_values is None:
-            for i in range(0, len(df)):
-                for cond, columns in condition_dict.items():
-                    for c in columns:
-                        values.append(df[c].values[i])
-                        condition.append(cond)
-                        samples.append(c)
-        else:
-            i = 0
-            for v in df[filter_column].values:
-                if v in filter_values:
-                    for cond, columns in condition_dict.items():
-                        for c in columns:
-                            values.append(df[c].values[i])
-                            condition.append(cond)
-                            samples.append(c)
-                i += 1
+        columns = [c for cond_columns in condition_dict.values() for c in cond_columns]
+        column_conditions = [cond for cond, cond_columns in condition_dict.items() for _ in cond_columns]
+
+        if filter_column is not None and filter_values is not None:
+            filter_values = [filter_values] if isinstance(filter_values, str) else list(filter_values)
+            df = df[df[filter_column].isin(set(filter_values))]
+        # Row major ravel gives the values row by row, then by condition then by sample
+        values = df[columns].values.ravel()
+        num_rows = len(df)
         box_df = pd.DataFrame()
-        box_df['Samples'] = samples
+        # A column can be in more than one condition so code the samples rather than assuming they are unique
+        sample_codes, samples = pd.factorize(np.array(columns, dtype=object))
+        condition_codes, condition_names = pd.factorize(np.array(column_conditions, dtype=object))
+        box_df['Samples'] = pd.Categorical.from_codes(np.tile(sample_codes, num_rows), categories=samples)
         box_df['Values'] = values
-        box_df['Conditions'] = condition
+        box_df['Conditions'] = pd.Categorical.from_codes(np.tile(condition_codes, num_rows),
+                                                         categories=condition_names)
         return box_df
 
     def plot(self, ax=None, legend=True):
@@ -123,21 +130,15 @@ class Boxplot(Vis):
 
         if self.add_stats:
             # Add all pairs in the order if the box pairs is none
-            if box_pairs is None:
-                pairs = []
-                box_pairs = []
-                for i in order:
-                    for j in order:
-                        if i != j:
-                            # Ensure we don't get duplicates
-                            pair = f'{i}{j}' if i < j else f'{j}{i}'
-                            if pair not in pairs:
-                                box_pairs.append((i, j))
-                                pairs.append(pair)
+            if box_pairs is None and hue is None:
+                box_pairs = list(combinations(order, 2))
+            elif box_pairs is None:
+                # Compare the hue groups within each x group
+                box_pairs = [((o, h1), (o, h2)) for o in order for h1, h2 in combinations(hue_order, 2)]
             # Add stats annotation
-            add_stat_annotation(ax, data=vis_df, x=x, y=y, order=order,
-                                box_pairs=box_pairs,
-                                test=self.stat_method, text_format='star', loc='inside', verbose=2)
+            pairwise = PairwiseStats(vis_df, x, y, hue=hue, sciutil=self.u)
+            self.stats_df = pairwise.test(box_pairs, self.stat_method, n_jobs=self.stat_n_jobs)
+            self.add_stat_annotation(ax, vis_df, x, y, order, self.stats_df, hue=hue, hue_order=hue_order)
 
         ax.set_xticklabels(ax.get_xticklabels(), rotation=45, horizontalalignment='right', weight='bold')
 
@@ -16,18 +16,101 @@
 ###############################################################################
 import matplotlib as mpl
 
+import hashlib
 import matplotlib.pyplot as plt
 import pandas as pd
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import numpy as np
 import networkx as nx
 import seaborn as sns
 from matplotlib.patches import Rectangle
 from matplotlib.legend_handler import HandlerBase
 from matplotlib.colors import ListedColormap
+from scipy import sparse
 import sys
 
-from sciviso import Vis
+from sciviso import Vis, VisException
+
+# Node positions keyed on the graph and layout settings, so restyling the same graph doesn't recompute the layout
+LAYOUT_CACHE = OrderedDict()
+LAYOUT_CACHE_SIZE = 32
+
+
+def graph_hash(G) -> str:
+    """ Hash of the graph's nodes and edges (in insertion order), used as the layout cache key. """
+    h = hashlib.sha1()
+    for node in G.nodes():
+        h.update(repr(node).encode())
+    h.update(b'|')
+    for u, v in G.edges():
+        h.update(repr((u, v)).encode())
+    return h.hexdigest()
+
+
+def grid_force_layout(G, iterations=50, seed=0, k=None, grid_size=32, chunk_size=2048):
+    """
+    Fruchterman-Reingold style force layout where the repulsion is approximated Barnes-Hut style: the nodes are
+    binned into a grid_size x grid_size grid and each node is repelled by each occupied cell's centre of mass rather
+    than by every other node. Each iteration costs O(n x occupied cells + edges) rather than O(n^2).
+    :param G: networkx graph
+    :param iterations: number of iterations
+    :param seed: seed for the initial positions
+    :param k: optimal distance between nodes, defaults to 1/sqrt(n)
+    :param grid_size: number of cells along each axis
+    :param chunk_size: number of nodes to compute the repulsion for at once (bounds memory)
+    :return: dict of node: np.array([x, y]) scaled to [-1, 1]
+    """
+    nodes = list(G.nodes())
+    n = len(nodes)
+    if n == 0:
+        return {}
+    if n == 1:
+        return {nodes[0]: np.zeros(2)}
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = np.array([(index[u], index[v]) for u, v in G.edges() if u != v], dtype=int).reshape(-1, 2)
+    pos = np.random.RandomState(seed).rand(n, 2)
+    k = np.sqrt(1.0 / n) if k is None else k
+    # Temperature limits how far a node can move in each iteration and cools linearly
+    t = 0.1
+    dt = t / (iterations + 1)
+    for _ in range(iterations):
+        mins = pos.min(axis=0)
+        span = pos.max(axis=0) - mins + 1e-9
+        cells = np.minimum(((pos - mins) / span * grid_size).astype(int), grid_size - 1)
+        cell_ids = cells[:, 0] * grid_size + cells[:, 1]
+        counts = np.bincount(cell_ids, minlength=grid_size ** 2)
+        sums = np.stack([np.bincount(cell_ids, weights=pos[:, d], minlength=grid_size ** 2) for d in range(2)],
+                        axis=1)
+        occupied = np.nonzero(counts)[0]
+        cell_mass = counts[occupied].astype(float)
+        cell_com = sums[occupied] / cell_mass[:, None]
+        displacement = np.zeros((n, 2))
+        for start in range(0, n, chunk_size):
+            chunk = pos[start: start + chunk_size]
+            delta = chunk[:, None, :] - cell_com[None, :, :]
+            dist2 = np.maximum((delta ** 2).sum(axis=2), 1e-9)
+            displacement[start: start + chunk_size] = (delta * (cell_mass * k ** 2 / dist2)[:, :, None]).sum(axis=1)
+        # Replace each node's own cell (which includes itself) with the centre of mass of the other nodes in it
+        own = np.searchsorted(occupied, cell_ids)
+        delta = pos - cell_com[own]
+        dist2 = np.maximum((delta ** 2).sum(axis=1), 1e-9)
+        displacement -= delta * (cell_mass[own] * k ** 2 / dist2)[:, None]
+        others = cell_mass[own] - 1
+        has_others = others > 0
+        delta = pos[has_others] - (sums[cell_ids[has_others]] - pos[has_others]) / others[has_others, None]
+        dist2 = np.maximum((delta ** 2).sum(axis=1), 1e-9)
+        displacement[has_others] += delta * (others[has_others] * k ** 2 / dist2)[:, None]
+        # Attraction along the edges
+        if len(edges):
+            delta = pos[edges[:, 0]] - pos[edges[:, 1]]
+            force = delta * (np.sqrt((delta ** 2).sum(axis=1)) / k)[:, None]
+            np.add.at(displacement, edges[:, 0], -force)
+            np.add.at(displacement, edges[:, 1], force)
+        length = np.maximum(np.sqrt((displacement ** 2).sum(axis=1)), 1e-9)
+        pos += displacement * (np.minimum(length, t) / length)[:, None]
+        t -= dt
+    pos = nx.rescale_layout(pos)
+    return dict(zip(nodes, pos))
 
 
 class HandlerColormap(HandlerBase):
@@ -70,28 +153,205 @@ class Emapplot(Vis):
 
     def get_colours(self, colours, vmin, vmax, step=8):
         # Convert the colours to be between the vmin and vmax at certain step sizes
-        new_colours = []
-        step_size = (vmax-vmin)/step
-        colour_intervals =
-        for c in colours:
+        colours = np.clip(np.asarray(colours, dtype=float), vmin, vmax)
+        step_size = (vmax - vmin) / step
+        if step_size == 0:
+            return colours
+        colour_intervals = np.minimum(np.floor((colours - vmin) / step_size), step - 1)
+        return vmin + colour_intervals * step_size
 
+    def get_gene_matrix(self):
+        """
+        Encodes the overlap column as a sparse term x gene indicator matrix, rows are in the same order as the
+        dataframe and genes are numbered in the order they are first seen.
+        :return: scipy.sparse.csr_matrix (n_terms x n_genes) with a 1 where the term contains the gene
+        """
+        gene_lists = [genes.split(self.overlap_sep) for genes in self.df[self.overlap_column].values]
+        lengths = [len(genes) for genes in gene_lists]
+        gene_codes, gene_names = pd.factorize(np.concatenate(gene_lists) if gene_lists else np.array([]))
+        term_codes = np.repeat(np.arange(len(gene_lists)), lengths)
+        gene_matrix = sparse.csr_matrix((np.ones(len(gene_codes), dtype=np.int32), (term_codes, gene_codes)),
+                                        shape=(len(gene_lists), len(gene_names)))
+        # Duplicate genes within a term are summed on construction, we only want set membership
+        gene_matrix.data[:] = 1
+        return gene_matrix
 
-    def build_graph(self, min_overlap=1, node_cmap='viridis',
-                    plot_cliques=False, c_vmin=None, c_vmax=None, edge_vmin=None, edge_vmax=None,
-                    g_min=None, g_mid=None, g_max=None):
+    @staticmethod
+    def get_overlaps(gene_matrix, min_overlap=1):
         """
-        Builds a graph from the dataframe from R
-        :return:
+        Gets the number of genes shared between each pair of terms from one sparse matrix product, so the cost scales
+        with the number of overlapping pairs rather than the number of pairs.
+        :param gene_matrix: term x gene indicator matrix (see get_gene_matrix)
+        :param min_overlap: minimum number of shared genes for two terms to be joined by an edge
+        :return: rows, cols, shared for each pair of terms with rows < cols
         """
-        G = nx.Graph()
+        shared = gene_matrix @ gene_matrix.T
+        if min_overlap > 0:
+            shared = sparse.triu(shared, k=1).tocoo()
+            rows, cols, values = shared.row, shared.col, shared.data
+        else:
+            # Terms without any shared genes still count, so every pair is an edge
+            rows, cols = np.triu_indices(gene_matrix.shape[0], k=1)
+            values = np.asarray(shared[rows, cols]).ravel()
+        keep = values >= min_overlap
+        return rows[keep], cols[keep], values[keep]
+
+    @staticmethod
+    def get_minhash_signatures(gene_matrix, num_perm=128, seed=0, max_cells=10000000):
+        """
+        MinHash signature of each term's gene set, the fraction of matching signature values between two terms
+        estimates their Jaccard similarity.
+        :param gene_matrix: term x gene indicator matrix (see get_gene_matrix)
+        :param num_perm: number of hash functions
+        :param seed: seed for the hash functions so the signatures are reproducible
+        :param max_cells: maximum size of the (num_perm x entries) hash array, the terms are hashed in chunks of rows
+        below this
+        :return: np.array (n_terms x num_perm)
+        """
+        prime = (1 << 31) - 1
+        rng = np.random.RandomState(seed)
+        a = rng.randint(1, prime, size=(num_perm, 1)).astype(np.int64)
+        b = rng.randint(0, prime, size=(num_perm, 1)).astype(np.int64)
+        n_terms = gene_matrix.shape[0]
+        indptr, indices = gene_matrix.indptr, gene_matrix.indices
+        signatures = np.full((n_terms, num_perm), prime, dtype=np.int64)
+        max_entries = max(1, max_cells // num_perm)
+        start = 0
+        while start < n_terms:
+            # Take rows until their entries fill the chunk (always at least one row)
+            end = max(start + 1, int(np.searchsorted(indptr, indptr[start] + max_entries, side='right')) - 1)
+            end = min(end, n_terms)
+            # Hash every (term, gene) entry then take the minimum within each term's row
+            hashes = (a * indices[indptr[start]: indptr[end]].astype(np.int64)[None, :] + b) % prime
+            row_starts = indptr[start: end] - indptr[start]
+            filled = np.diff(indptr[start: end + 1]) > 0
+            if np.any(filled):
+                signatures[start: end][filled] = np.minimum.reduceat(hashes, row_starts[filled], axis=1).T
+            start = end
+        return signatures
+
+    def get_overlaps_lsh(self, gene_matrix, min_overlap=1, num_perm=128, num_bands=64, seed=0):
+        """
+        Locality sensitive hashing over the MinHash signatures, only terms that land in the same bucket for at least
+        one band are candidates and only the candidates have their overlap computed exactly. More bands (fewer
+        signature values per band) finds more of the weakly similar pairs at the cost of more candidates.
+        :param gene_matrix: term x gene indicator matrix (see get_gene_matrix)
+        :param min_overlap: minimum number of shared genes for two terms to be joined by an edge
+        :param num_perm: number of hash functions in the MinHash signature
+        :param num_bands: number of bands the signature is split into, has to divide num_perm
+        :param seed: seed for the hash functions
+        :return: rows, cols, shared for each candidate pair of terms with rows < cols
+        """
+        if num_perm % num_bands != 0:
+            msg = self.u.msg.msg_arg_err("get_overlaps_lsh", "num_bands", num_bands,
+                                         [b for b in range(1, num_perm + 1) if num_perm % b == 0])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        n_terms = gene_matrix.shape[0]
+        rows_per_band = num_perm // num_bands
+        signatures = self.get_minhash_signatures(gene_matrix, num_perm, seed)
+        candidates = []
+        for band in range(num_bands):
+            # Fold the band's signature values into one key, colliding keys only add candidates that get scored
+            band_keys = np.zeros(n_terms, dtype=np.int64)
+            for col in signatures[:, band * rows_per_band: (band + 1) * rows_per_band].T:
+                band_keys = band_keys * 1000003 ^ col
+            order = np.argsort(band_keys, kind='stable')
+            _, bucket_starts, bucket_sizes = np.unique(band_keys[order], return_index=True, return_counts=True)
+            # Pair every term with each of the terms after it in the same bucket
+            rank = np.arange(n_terms) - np.repeat(bucket_starts, bucket_sizes)
+            partners = np.repeat(bucket_sizes, bucket_sizes) - 1 - rank
+            left = np.repeat(np.arange(n_terms), partners)
+            offsets = np.arange(len(left)) - np.repeat(np.cumsum(partners) - partners, partners) + 1
+            if len(left):
+                candidates.append(order[left] * n_terms + order[left + offsets])
+        if not candidates:
+            return np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=int)
+        candidates = np.unique(np.concatenate(candidates))
+        # The stable sort keeps the terms in each bucket in dataframe order so rows < cols
+        rows, cols = candidates // n_terms, candidates % n_terms
+        # Score only the candidates exactly
+        values = np.asarray(gene_matrix[rows].multiply(gene_matrix[cols]).sum(axis=1)).ravel()
+        keep = values >= max(min_overlap, 1)
+        return rows[keep], cols[keep], values[keep]
 
+    def get_similarity(self, shared, size_i, size_j, num_genes, similarity='count'):
+        """
+        Converts the number of shared genes between two terms into a similarity.
+        :param shared: number of genes shared between term i and term j
+        :param size_i: number of genes in term i
+        :param size_j: number of genes in term j
+        :param num_genes: number of distinct genes across all terms, used as the background for kappa
+        :param similarity: 'count' (shared genes), 'jaccard' (shared / union), 'overlap' (shared / smaller term) or
+        'kappa' (Cohen's kappa, as in clusterProfiler's emapplot)
+        :return: np.array of similarities
+        """
+        shared = np.asarray(shared, dtype=float)
+        size_i = np.asarray(size_i, dtype=float)
+        size_j = np.asarray(size_j, dtype=float)
+        if similarity == 'count':
+            return shared
+        elif similarity == 'jaccard':
+            return shared / (size_i + size_j - shared)
+        elif similarity == 'overlap':
+            return shared / np.minimum(size_i, size_j)
+        elif similarity == 'kappa':
+            both = shared
+            neither = num_genes - (size_i + size_j - shared)
+            observed = (both + neither) / num_genes
+            expected = (size_i * size_j + (num_genes - size_i) * (num_genes - size_j)) / (num_genes ** 2)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                kappa = (observed - expected) / (1 - expected)
+            # Identical terms covering every gene have no disagreement to measure
+            return np.where(expected == 1, 1.0, kappa)
+        msg = self.u.msg.msg_arg_err("get_similarity", "similarity", similarity,
+                                     ["count", "jaccard", "overlap", "kappa"])
+        self.u.err_p([msg])
+        raise VisException(msg)
+
+    def get_edge_map_sparse(self, min_overlap=1, similarity='count', similarity_cutoff=None, use_lsh=False,
+                            num_perm=128, num_bands=64, seed=0):
+        """
+        Builds the edge map from the sparse term x gene matrix, optionally only scoring the candidate pairs found by
+        MinHash LSH.
+        :param min_overlap: minimum number of shared genes for two terms to be joined by an edge
+        :param similarity: 'count', 'jaccard', 'overlap' or 'kappa' see get_similarity
+        :param similarity_cutoff: minimum similarity for two terms to be joined by an edge
+        :param use_lsh: only score pairs of terms that are likely to be similar (approximate, for very large inputs)
+        :param num_perm: number of MinHash hash functions when use_lsh is True
+        :param num_bands: number of LSH bands when use_lsh is True
+        :param seed: seed for the MinHash hash functions
+        :return: dict of dicts, edge_map[id_i][id_j] = similarity, for i < j in the dataframe order
+        """
+        ids = self.df[self.id].values
+        gene_matrix = self.get_gene_matrix()
+        if use_lsh:
+            rows, cols, shared = self.get_overlaps_lsh(gene_matrix, min_overlap, num_perm, num_bands, seed)
+        else:
+            rows, cols, shared = self.get_overlaps(gene_matrix, min_overlap)
+        sizes = np.asarray(gene_matrix.sum(axis=1)).ravel()
+        values = self.get_similarity(shared, sizes[rows], sizes[cols], gene_matrix.shape[1], similarity)
+        if similarity_cutoff is not None:
+            keep = values >= similarity_cutoff
+            rows, cols, values = rows[keep], cols[keep], values[keep]
+        if similarity == 'count':
+            values = values.astype(int)
+        # Keep the same edge order as the pairwise method i.e. by row then by column
+        order = np.lexsort((cols, rows))
+        edge_map = defaultdict(dict)
+        for i, j, v in zip(rows[order], cols[order], values[order]):
+            edge_map[ids[i]][ids[j]] = v.item()
+        return edge_map
+
+    def get_edge_map_pairwise(self, min_overlap=1):
+        """
+        Gets the number of genes shared between each pair of terms by intersecting the gene sets of every pair.
+        :param min_overlap: minimum number of shared genes for two terms to be joined by an edge
+        :return: dict of dicts, edge_map[id_i][id_j] = shared genes, for i < j in the dataframe order
+        """
         edge_map = defaultdict(dict)
         gene_ids = self.df[self.overlap_column].values
         gene_ids = [set(genes.split(self.overlap_sep)) for genes in gene_ids] # Turn it into a list
-        all_genes = 0
-        for g in gene_ids:
-            all_genes += len(g)
-        min_overlap = min_overlap
         # Want to iterate over and get the maps between the two
         for i, id_i in enumerate(self.df[self.id].values):
             for j, id_j in enumerate(self.df[self.id].values):
@@ -107,34 +367,124 @@ class Emapplot(Vis):
                         overlapping_genes = len(gene_ids[i] & gene_ids[j])
                         if overlapping_genes >= min_overlap:
                             edge_map[id_i][id_j] = overlapping_genes
+        return edge_map
+
+    def get_layout(self, G, layout='spring', seed=0, iterations=50, k=2, use_cache=True):
+        """
+        Computes node positions for the graph, the positions are cached on the graph's nodes and edges and the layout
+        settings so re-drawing the same graph is free.
+        :param G: networkx graph
+        :param layout: 'spring', 'kamada_kawai', 'spectral', 'grid_force' (approximate force layout for large graphs)
+        or 'auto' (spring for up to 1000 nodes otherwise grid_force)
+        :param seed: random seed for the spring and grid_force layouts so the positions are reproducible
+        :param iterations: number of iterations for the spring and grid_force layouts
+        :param k: optimal distance between nodes for the spring layout
+        :param use_cache: whether to look up and store the positions in LAYOUT_CACHE
+        :return: dict of node: position
+        """
+        if layout == 'auto':
+            layout = 'spring' if G.number_of_nodes() <= 1000 else 'grid_force'
+        key = (graph_hash(G), layout, seed, iterations, k)
+        if use_cache and key in LAYOUT_CACHE:
+            LAYOUT_CACHE.move_to_end(key)
+            return LAYOUT_CACHE[key]
+        if layout == 'spring':
+            pos = nx.spring_layout(G, k=k, iterations=iterations, seed=seed)
+        elif layout == 'kamada_kawai':
+            pos = nx.kamada_kawai_layout(G)
+        elif layout == 'spectral':
+            pos = nx.spectral_layout(G)
+        elif layout == 'grid_force':
+            pos = grid_force_layout(G, iterations=iterations, seed=seed)
+        else:
+            msg = self.u.msg.msg_arg_err("get_layout", "layout", layout,
+                                         ["spring", "kamada_kawai", "spectral", "grid_force", "auto"])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        if use_cache:
+            LAYOUT_CACHE[key] = pos
+            if len(LAYOUT_CACHE) > LAYOUT_CACHE_SIZE:
+                LAYOUT_CACHE.popitem(last=False)
+        return pos
+
+    def get_components(self, edge_map):
+        """
+        Labels the connected components of the graph with a union-find (disjoint-set) over the edge map.
+        :param edge_map: dict of dicts, edge_map[id_i][id_j] for each edge
+        :return: np.array with a component label for each row of the dataframe, numbered in order of first appearance
+        """
+        index = {node: i for i, node in enumerate(self.df[self.id].values)}
+        parent = list(range(len(self.df)))
+        rank = [0] * len(self.df)
+
+        def find(i):
+            # Path halving keeps the trees flat
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for node_from, node_to_lst in edge_map.items():
+            for node_to in node_to_lst:
+                root_from, root_to = find(index[node_from]), find(index[node_to])
+                if root_from == root_to:
+                    continue
+                # Union by rank
+                if rank[root_from] < rank[root_to]:
+                    root_from, root_to = root_to, root_from
+                parent[root_to] = root_from
+                if rank[root_from] == rank[root_to]:
+                    rank[root_from] += 1
+        roots = [find(i) for i in range(len(parent))]
+        return pd.factorize(np.array(roots))[0]
+
+    def build_graph(self, min_overlap=1, node_cmap='viridis',
+                    plot_cliques=False, c_vmin=None, c_vmax=None, edge_vmin=None, edge_vmax=None,
+                    g_min=None, g_mid=None, g_max=None, overlap_method='sparse', similarity='count',
+                    similarity_cutoff=None, use_lsh=False, num_perm=128, num_bands=64, layout='spring',
+                    layout_seed=0, layout_iterations=50, use_layout_cache=True, lsh_seed=0):
+        """
+        Builds a graph from the dataframe from R
+        :param overlap_method: 'sparse' gets all overlaps from one sparse matrix product, 'pairwise' intersects the
+        gene sets of every pair of terms (slow for more than a few hundred terms).
+        :param similarity: edge weight, 'count' (shared genes), 'jaccard', 'overlap' or 'kappa'
+        :param similarity_cutoff: minimum similarity for two terms to be joined, e.g. 0.2 for jaccard as in
+        clusterProfiler
+        :param use_lsh: only score pairs found by a MinHash LSH index, use for very large term sets (approximate)
+        :param num_perm: number of MinHash hash functions when use_lsh is True
+        :param num_bands: number of LSH bands when use_lsh is True
+        :param layout: 'spring', 'kamada_kawai', 'spectral', 'grid_force' or 'auto' see get_layout
+        :param layout_seed: seed for the layout so the node positions are the same between runs
+        :param layout_iterations: number of iterations for the force directed layouts
+        :param use_layout_cache: reuse the positions if the same graph has been laid out before
+        :param lsh_seed: seed for the MinHash hash functions when use_lsh is True
+        :return: copy of the dataframe with a 'component' column giving each term's connected component
+        """
+        G = nx.Graph()
+
+        if overlap_method == 'sparse':
+            edge_map = self.get_edge_map_sparse(min_overlap, similarity, similarity_cutoff, use_lsh, num_perm,
+                                                num_bands, lsh_seed)
+        elif overlap_method == 'pairwise':
+            if similarity != 'count' or use_lsh:
+                msg = self.u.msg.msg_arg_err("build_graph", "overlap_method", overlap_method, ["sparse"])
+                self.u.err_p([msg, 'Similarity metrics and LSH are only available for the sparse overlap method.'])
+                raise VisException(msg)
+            edge_map = self.get_edge_map_pairwise(min_overlap)
+        else:
+            msg = self.u.msg.msg_arg_err("build_graph", "overlap_method", overlap_method, ["sparse", "pairwise"])
+            self.u.err_p([msg])
+            raise VisException(msg)
         edges = []
         for node1 in edge_map:
             for node2 in edge_map[node1]:
                 edges.append((node1, node2))
 
-        seen_nodes = []
-        edge_groups = defaultdict(list)
-        for node_from, node_to_lst in edge_map.items():
-            if node_from not in seen_nodes:
-                # Now we want to traverse the graph visiting each node
-                for node in node_to_lst:
-                    if node not in edge_groups[node_from] and node not in seen_nodes:
-                        edge_groups[node_from].append(node)
-                        seen_nodes.append(node)
-                        if edge_map.get(node) and node not in seen_nodes:
-                            for node2 in edge_map.get(node):
-                                edge_groups[node_from].append(node2)
-                                seen_nodes.append(node2)
-                seen_nodes.append(node_from)
-                edge_groups[node_from].append(node_from)
+        components = self.get_components(edge_map)
 
+        # Add the nodes first so the graph's node order matches the dataframe (and so the sizes and colours)
+        G.add_nodes_from(self.df[self.id].values)
         G.add_edges_from(edges)
-        nodes = G.nodes()
-        # Check that all nodes have been added and if not add them
-        nodes_to_add = [node_id for node_id in self.df[self.id].values if node_id not in nodes]
-        for node in nodes_to_add:
-            G.add_node(node)
-            edge_groups[node].append(node) # So that we actually draw it!
         # Now we want a list of node sizes and colours
         mins = np.min(self.df[self.size].values) if not g_min else g_min
         maxs = np.max(self.df[self.size].values) if not g_max else g_max
@@ -145,9 +495,9 @@ class Emapplot(Vis):
 
         # Need to create a layout when doing
         # separate calls to draw nodes and edges
-        pos = nx.spring_layout(G,  k=2) #nx.kamada_kawai_layout(G) # nx.spring_layout(G,  k=2) #
+        pos = self.get_layout(G, layout, seed=layout_seed, iterations=layout_iterations, use_cache=use_layout_cache)
         if c_vmin is not None and c_vmax is not None:
-            colour = get_colours(colour, c_vmin, c_vmax)
+            colour = self.get_colours(colour, c_vmin, c_vmax)
         nx.draw_networkx_nodes(G, pos, cmap=plt.get_cmap(node_cmap),
                                node_color=colour, node_size=sizes)
 
@@ -170,7 +520,6 @@ class Emapplot(Vis):
         # correspond to the "top" term.
         # https://networkx.org/documentation/stable/reference/algorithms/generated/networkx.algorithms.clique.find_cliques.html#networkx.algorithms.clique.find_cliques
         labels_to_draw = {}
-        gene_numbers = dict(zip(self.df[self.id].values, self.df[self.size].values))
 
         # If the user has selected the smallest GO term as the one they want
         if plot_cliques:
@@ -180,10 +529,9 @@ class Emapplot(Vis):
                 smallest_GO = min([g.split(':')[1] for g in clique])
                 labels_to_draw[f'GO:{smallest_GO}'] = labels[f'GO:{smallest_GO}']
 
-        for node, node_group in edge_groups.items():
-            # For each clique we want to get the GO term with the smallest ID
-            smallest_GO = np.argmax([gene_numbers.get(g) for g in node_group])
-            go = node_group[smallest_GO]
+        # For each connected component we label the term with the most genes
+        component_df = pd.DataFrame({'component': components, 'size': self.df[self.size].values})
+        for go in self.df[self.id].values[component_df.groupby('component')['size'].idxmax().values]:
             labels_to_draw[go] = labels[go]
 
         small_labels = {}
@@ -208,7 +556,11 @@ class Emapplot(Vis):
         cmin_node = '{:.2e}'.format(min(colour))
         cmax_node = '{:.2e}'.format(max(colour))
 
-        cmap_labels = [f'P.adj:{cmin_node},{cmax_node}', f'G.shared:{min(edge_values)}-{max(edge_values)}']
+        if similarity == 'count':
+            edge_label = f'G.shared:{min(edge_values)}-{max(edge_values)}'
+        else:
+            edge_label = f'{similarity.capitalize()}:{min(edge_values):.2f}-{max(edge_values):.2f}'
+        cmap_labels = [f'P.adj:{cmin_node},{cmax_node}', edge_label]
         # create proxy artists as handles:
         cmaps = [plt.get_cmap(node_cmap), edge_cmap]
         cmap_handles = [Rectangle((0, 0), 1, 1) for _ in cmaps]
@@ -245,4 +597,7 @@ class Emapplot(Vis):
         legend.set_title("No. Genes")
 
         plt.gca().add_artist(legend)
-        plt.axis("off")
\ No newline at end of file
+        plt.axis("off")
+        graph_df = self.df.copy()
+        graph_df['component'] = components
+        return graph_df
\ No newline at end of file
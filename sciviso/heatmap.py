@@ -15,12 +15,107 @@
 #                                                                             #
 ###############################################################################
 
+import hashlib
+import os
+import warnings
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import seaborn as sns
+from collections import OrderedDict
 from matplotlib.patches import Patch
+from scipy.cluster import hierarchy
+from scipy.cluster.vq import kmeans2
 
-from sciviso import Vis
+from sciviso import Vis, VisException
+
+# Linkages keyed on the matrix content and the clustering settings, so restyling the same data doesn't recluster
+LINKAGE_CACHE = OrderedDict()
+LINKAGE_CACHE_SIZE = 16
+
+
+def matrix_hash(values: np.array) -> str:
+    """ Hash of a matrix's shape, dtype and values, used as the linkage cache key. """
+    # Object arrays hold pointers rather than values, hash the numbers they contain
+    values = np.ascontiguousarray(values, dtype=float if values.dtype == object else None)
+    h = hashlib.sha1()
+    h.update(repr((values.shape, values.dtype.str)).encode())
+    h.update(values.view(np.uint8).ravel() if values.size else b'')
+    return h.hexdigest()
+
+
+def kmeans_linkage(values: np.array, method='average', metric='euclidean', n_clusters=None, max_exact=5000,
+                   seed=0) -> np.array:
+    """
+    Two stage hierarchical clustering for matrices too large for a dense distance matrix: the rows are grouped by
+    k-means (n_clusters, default sqrt of the rows), each group is clustered exactly and then the group centroids are
+    clustered. The pieces are joined into one linkage over all the rows (the centroid merges are shifted above the
+    highest within group merge so the dendrogram stays monotonic). Groups still larger than max_exact are split the
+    same way, so memory is bounded by max_exact squared rather than the number of rows squared.
+    Parameters
+    ----------
+    values:     matrix whose rows are clustered
+    method:     linkage method for the groups and centroids
+    metric:     distance for the groups and centroids (k-means itself always uses euclidean distance)
+    n_clusters: number of k-means groups
+    max_exact:  largest number of rows clustered exactly
+    seed:       k-means seed
+
+    Returns
+    -------
+    scipy linkage matrix over all the rows of values
+    """
+    n = len(values)
+    if n <= max_exact:
+        return hierarchy.linkage(values, method=method, metric=metric)
+    n_clusters = n_clusters or int(np.ceil(np.sqrt(n)))
+    with warnings.catch_warnings():
+        # Empty clusters are fine, they are just dropped
+        warnings.simplefilter('ignore')
+        # Random rows as the starting centroids, scipy's k-means++ start is much slower on large matrices
+        _, labels = kmeans2(values, n_clusters, minit='points', seed=seed)
+    groups = [idxs for idxs in pd.Series(np.arange(n)).groupby(labels).indices.values()]
+    if len(groups) == 1:
+        # k-means couldn't split the rows (e.g. they are all the same), so any split will do
+        groups = np.array_split(np.arange(n), n_clusters)
+    rows = []
+    sizes = np.ones(2 * n - 1, dtype=np.int64)
+    group_nodes = np.zeros(len(groups), dtype=np.int64)
+    next_node = n
+    for g, idxs in enumerate(groups):
+        if len(idxs) == 1:
+            group_nodes[g] = idxs[0]
+            continue
+        inner = kmeans_linkage(values[idxs], method, metric, max_exact=max_exact, seed=seed)
+        # Leaves of the group's linkage are its rows, merged nodes follow on from the ones already made
+        ids = inner[:, :2].astype(np.int64)
+        ids = np.where(ids < len(idxs), idxs[np.minimum(ids, len(idxs) - 1)], ids - len(idxs) + next_node)
+        rows.append(np.column_stack([ids, inner[:, 2], inner[:, 3]]))
+        next_node += len(idxs) - 1
+        group_nodes[g] = next_node - 1
+        sizes[next_node - len(idxs) + 1: next_node] = inner[:, 3]
+    height = max([r[:, 2].max() for r in rows], default=0)
+    centroids = np.array([values[idxs].mean(axis=0) for idxs in groups])
+    outer = hierarchy.linkage(centroids, method=method, metric=metric)
+    ids = outer[:, :2].astype(np.int64)
+    ids = np.where(ids < len(groups), group_nodes[np.minimum(ids, len(groups) - 1)], ids - len(groups) + next_node)
+    counts = np.zeros(len(ids), dtype=np.int64)
+    for i, (a, b) in enumerate(ids):
+        # Counts of merged nodes depend on the merges before them
+        counts[i] = sizes[a] + sizes[b]
+        sizes[next_node + i] = counts[i]
+    rows.append(np.column_stack([ids, outer[:, 2] + height, counts]))
+    linkage = np.vstack(rows).astype(float)
+    # Put the merges in order of height (as scipy does), as long as every merge still comes after its children
+    order = np.argsort(linkage[:, 2], kind='stable')
+    position = np.empty(n - 1, dtype=np.int64)
+    position[order] = np.arange(n - 1)
+    children = linkage[order, :2].astype(np.int64)
+    merged = children >= n
+    if np.all(position[children[merged] - n] < np.nonzero(merged)[0]):
+        children[merged] = position[children[merged] - n] + n
+        linkage = np.column_stack([children, linkage[order, 2:]]).astype(float)
+    return linkage
 
 
 class Heatmap(Vis):
@@ -29,8 +124,19 @@ class Heatmap(Vis):
                  cluster_rows=True, cluster_cols=True, row_colours=None, col_colours=None, vmin=None, vmax=None,
                  linewidths=0.5, x_tick_labels=1, y_tick_labels=1, rows_to_colour=None, cols_to_colour=None,
                  figsize=(3, 3), cmap='RdBu_r',
-                 annot=False, color_palettes=None,
-                 config={}):
+                 annot=False, color_palettes=None, linkage_method='average', linkage_metric='euclidean',
+                 cache_linkage=True, linkage_cache_dir=None, cluster_backend='exact', max_exact_rows=10000,
+                 dtype=None, config={}):
+        """
+        linkage_method, linkage_metric: clustering settings passed to scipy.cluster.hierarchy.linkage (the seaborn
+        clustermap defaults).
+        cache_linkage: keep the linkages in LINKAGE_CACHE (keyed on the matrix content and settings) so plotting the
+        same data again with a different style doesn't recluster.
+        linkage_cache_dir: directory the linkages are also saved to (as .npy files) so they are kept between sessions.
+        cluster_backend: 'exact' (scipy linkage on all the rows), 'kmeans' (see kmeans_linkage, for tens of thousands
+        of rows) or 'auto' (kmeans above max_exact_rows rows).
+        dtype: e.g. np.float32 to cluster a single precision copy of the data (half the memory of float64).
+        """
         super().__init__(df, figsize=figsize)
         self.chart_columns = chart_columns
         self.row_index = row_index
@@ -55,21 +161,128 @@ class Heatmap(Vis):
         self.y_tick_labels = y_tick_labels
         self.linewidths = linewidths
         self.annot = annot
+        self.linkage_method = linkage_method
+        self.linkage_metric = linkage_metric
+        self.cache_linkage = cache_linkage
+        self.linkage_cache_dir = linkage_cache_dir
+        self.cluster_backend = cluster_backend
+        self.max_exact_rows = max_exact_rows
+        self.dtype = dtype
+        # Linkages used by the last plot, can be passed back to plot or used for the ordering (see get_order)
+        self.row_linkage, self.col_linkage = None, None
+        # Matrix and row colours built from self.df, kept until the dataframe or the columns used change
+        self.matrix, self.matrix_key, self.matrix_df = None, None, None
+        self.row_colour_luts, self.row_colour_key, self.row_colour_df = None, None, None
         if config:
             self.load_style(config)
 
-    def plot(self, ax=None, linecolor="none", row_linkage=None, col_linkage=None):
+    def get_linkage(self, values: np.array) -> np.array:
+        """
+        Hierarchical clustering of the rows of values, looked up in LINKAGE_CACHE (then linkage_cache_dir) before
+        computing it.
+        Parameters
+        ----------
+        values: matrix whose rows are clustered (pass the transpose to cluster the columns)
+
+        Returns
+        -------
+        scipy linkage matrix
+        """
+        if self.cluster_backend not in ['exact', 'kmeans', 'auto']:
+            msg = self.u.msg.msg_arg_err("get_linkage", "cluster_backend", self.cluster_backend,
+                                         ['exact', 'kmeans', 'auto'])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        if self.dtype is not None:
+            # A no-op for the matrix from get_matrix, which already has the dtype
+            values = values.astype(self.dtype, copy=False)
+        backend = self.cluster_backend
+        if backend == 'auto':
+            backend = 'kmeans' if len(values) > self.max_exact_rows else 'exact'
+        key = (matrix_hash(values), self.linkage_method, self.linkage_metric, backend,
+               self.max_exact_rows if backend == 'kmeans' else None)
+        if self.cache_linkage and key in LINKAGE_CACHE:
+            LINKAGE_CACHE.move_to_end(key)
+            return LINKAGE_CACHE[key]
+        path = None
+        if self.linkage_cache_dir is not None:
+            name = hashlib.sha1(repr(key).encode()).hexdigest()
+            path = os.path.join(self.linkage_cache_dir, 'linkage_' + name + '.npy')
+        if path is not None and os.path.exists(path):
+            linkage = np.load(path)
+        else:
+            if backend == 'kmeans':
+                linkage = kmeans_linkage(values, self.linkage_method, self.linkage_metric,
+                                         max_exact=self.max_exact_rows)
+            else:
+                linkage = hierarchy.linkage(values, method=self.linkage_method, metric=self.linkage_metric)
+            if path is not None:
+                os.makedirs(self.linkage_cache_dir, exist_ok=True)
+                np.save(path, linkage)
+        if self.cache_linkage:
+            LINKAGE_CACHE[key] = linkage
+            if len(LINKAGE_CACHE) > LINKAGE_CACHE_SIZE:
+                LINKAGE_CACHE.popitem(last=False)
+        return linkage
+
+    def clear_cache(self) -> None:
+        """ Drops the matrix and row colours built from self.df, needed if the dataframe was changed in place. """
+        self.matrix, self.matrix_key = None, None
+        self.row_colour_luts, self.row_colour_key = None, None
+
+    def get_matrix(self) -> pd.DataFrame:
+        """
+        The chart columns as a dataframe indexed by row_index, built once per dataframe and set of columns. The values
+        are a view of self.df (no copy) when the chart columns are stored together with a dtype that fits.
+        """
+        key = (id(self.df), tuple(self.chart_columns), self.row_index, self.dtype)
+        if self.matrix is not None and self.matrix_key == key:
+            return self.matrix
         self.check_args_in_columns([self.chart_columns, [self.row_index]])
-        df_dists = pd.DataFrame(self.df[self.chart_columns].values)
-        df_dists.columns = self.chart_columns
-        df_dists.index = self.df[self.row_index].values
+        values = self.df[self.chart_columns].to_numpy(dtype=self.dtype, copy=False)
+        self.matrix = pd.DataFrame(values, index=self.df[self.row_index].values, columns=self.chart_columns,
+                                   copy=False)
+        # Keep the dataframe the key's id refers to
+        self.matrix_key, self.matrix_df = key, self.df
+        return self.matrix
+
+    def get_row_colour_luts(self) -> list:
+        """
+        For each column in rows_to_colour, the colour of each row and the lookup from value to colour (for the
+        legend). Built once per dataframe, columns and palettes.
+        Returns
+        -------
+        list of (row colours, lut)
+        """
+        key = (id(self.df), tuple(self.rows_to_colour), tuple(self.color_palettes))
+        if self.row_colour_luts is not None and self.row_colour_key == key:
+            return self.row_colour_luts
+        self.row_colour_luts = []
+        for i, rc in enumerate(self.rows_to_colour):
+            codes, values = pd.factorize(self.df[rc].values)
+            colours = sns.color_palette(self.color_palettes[i], len(values))
+            lut = dict(zip(values, colours))
+            self.row_colour_luts.append((pd.Series([colours[c] for c in codes]), lut))
+        self.row_colour_key, self.row_colour_df = key, self.df
+        return self.row_colour_luts
+
+    def get_order(self, axis='rows') -> np.array:
+        """ Order of the rows (or columns) in the dendrogram of the last plot, None if they weren't clustered. """
+        linkage = self.row_linkage if axis == 'rows' else self.col_linkage
+        return None if linkage is None else hierarchy.leaves_list(linkage)
+
+    def plot(self, ax=None, linecolor="none", row_linkage=None, col_linkage=None):
+        df_dists = self.get_matrix()
+        # Use the cached clustering rather than have clustermap recompute it
+        if self.cluster_rows and row_linkage is None:
+            row_linkage = self.get_linkage(df_dists.values)
+        if self.cluster_cols and col_linkage is None:
+            col_linkage = self.get_linkage(df_dists.values.T)
+        self.row_linkage = row_linkage if self.cluster_rows else None
+        self.col_linkage = col_linkage if self.cluster_cols else None
         # Check if the user has got row_colours defined
         if self.rows_to_colour:
-            self.row_colours = []
-            for i, rc in enumerate(self.rows_to_colour):
-                labels = self.df[rc].values
-                lut = dict(zip(set(labels), sns.color_palette(self.color_palettes[i], len(set(labels)))))
-                self.row_colours.append(pd.DataFrame(labels)[0].map(lut))
+            self.row_colours = [colours for colours, lut in self.get_row_colour_luts()]
         if ax:
             ax = sns.clustermap(df_dists, col_cluster=self.cluster_cols, figsize=self.figsize,
                                 row_cluster=self.cluster_rows,
@@ -88,9 +301,7 @@ class Heatmap(Vis):
                                 linewidths=self.linewidths, row_linkage=row_linkage, col_linkage=col_linkage,
                                 linecolor=linecolor)
         if self.rows_to_colour:
-            for i, rc in enumerate(self.rows_to_colour):
-                labels = self.df[rc].values
-                lut = dict(zip(set(labels), sns.color_palette(self.color_palettes[i], len(set(labels)))))
+            for i, (colours, lut) in enumerate(self.get_row_colour_luts()):
                 handles = [Patch(facecolor=lut[name]) for name in lut]
                 legend = plt.legend(handles, lut, bbox_to_anchor=(2, i))
                 plt.gca().add_artist(legend)
@@ -106,20 +317,131 @@ class Heatmap(Vis):
         plt.tight_layout()
         return ax
 
-    def plot_hm(self, ax=None, linecolor="black"):
-        self.check_args_in_columns([self.chart_columns, [self.row_index]])
-        df_dists = pd.DataFrame(self.df[self.chart_columns].values)
-        df_dists.columns = self.chart_columns
-        df_dists.index = self.df[self.row_index].values
-        if ax:
+    @staticmethod
+    def aggregate_bins(values: np.array, n_bins: int, how='mean', axis=0) -> np.array:
+        """
+        Aggregates consecutive rows (axis=0) or columns (axis=1) of values into n_bins equal bins.
+        Parameters
+        ----------
+        values: matrix
+        n_bins: number of bins, at most the number of rows (columns)
+        how:    'mean' or 'max' of each bin, NaNs are ignored
+        axis:   0 to bin the rows, 1 the columns
+
+        Returns
+        -------
+        the binned matrix and the start index of each bin
+        """
+        n = values.shape[axis]
+        starts = np.unique(np.linspace(0, n, n_bins + 1).astype(np.int64)[:-1])
+        if len(starts) == n:
+            return values, starts
+        missing = np.isnan(values)
+        if how == 'max':
+            # fmax ignores NaNs unless the whole bin is NaN
+            return np.fmax.reduceat(values, starts, axis=axis), starts
+        sums = np.add.reduceat(np.where(missing, 0, values), starts, axis=axis)
+        counts = np.add.reduceat(~missing, starts, axis=axis)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sums / counts, starts
+
+    def get_ticks(self, names: np.array, length: float, tick_labels) -> tuple:
+        """
+        Positions and labels of the rows (columns) to label, tick_labels is as in seaborn: True or 'auto' labels the
+        rows with their names, an int every tick_labels-th one, a list gives the labels to use and 0 or False none.
+        Labels are spread out further when more than fit along length (in points) are asked for.
+        """
+        n = len(names)
+        if isinstance(tick_labels, (bool, int, np.integer)) and not tick_labels:
+            return np.array([], dtype=np.int64), np.array([])
+        if isinstance(tick_labels, (bool, str)):
+            step = 1
+        elif isinstance(tick_labels, (int, np.integer)):
+            step = int(tick_labels)
+        else:
+            step = 1
+            names = np.asarray(tick_labels)
+        max_ticks = max(1, int(length / (self.label_font_size * 1.2)))
+        step = max(step, int(np.ceil(n / max_ticks)))
+        idxs = np.arange(0, min(n, len(names)), step)
+        return idxs, names[idxs]
+
+    def plot_aggregate(self, ax: plt.axes, df_dists: pd.DataFrame, how='mean'):
+        """
+        Draws the matrix with imshow, first aggregating rows (and columns) into bins of one pixel (at self.dpi) if
+        there are more than the axis has pixels. The size of the output then depends on the figure rather than the
+        matrix. Only as many tick labels as fit are drawn. Returns the image.
+        """
+        fig = ax.figure
+        width, height = ax.get_position().width * fig.get_figwidth(), ax.get_position().height * fig.get_figheight()
+        values = df_dists.values
+        if not np.issubdtype(values.dtype, np.floating):
+            values = values.astype(float)
+        n_rows, n_cols = values.shape
+        values, row_starts = self.aggregate_bins(values, min(n_rows, int(height * self.dpi)), how, axis=0)
+        values, col_starts = self.aggregate_bins(values, min(n_cols, int(width * self.dpi)), how, axis=1)
+        image = ax.imshow(values, aspect='auto', interpolation='nearest', cmap=self.cmap_str, vmin=self.vmin,
+                          vmax=self.vmax, extent=(0, n_cols, n_rows, 0))
+        # Ticks are in row (column) units, at the middle of the labelled row as in seaborn
+        row_ticks, row_labels = self.get_ticks(df_dists.index.values, height * 72, self.y_tick_labels)
+        col_ticks, col_labels = self.get_ticks(df_dists.columns.values, width * 72, self.x_tick_labels)
+        ax.set_yticks(row_ticks + 0.5)
+        ax.set_yticklabels(row_labels)
+        ax.set_xticks(col_ticks + 0.5)
+        ax.set_xticklabels(col_labels)
+        ax.grid(False)
+        return image
+
+    def plot_hm(self, ax=None, linecolor="black", render='auto', aggregate='mean', row_order=None, row_linkage=None):
+        """
+        Heatmap without clustering, the rows are drawn in the order of the dataframe unless an order is given.
+        Parameters
+        ----------
+        ax:         axis to draw on
+        linecolor:  colour of the lines between the cells (mesh only)
+        render:     'mesh' (sns.heatmap, a polygon per cell), 'aggregate' (see plot_aggregate) or 'auto' (aggregate
+                    when there are more rows or columns than pixels)
+        aggregate:  'mean' or 'max' of the rows in each pixel
+        row_order:  positions of the rows in the order to draw them, e.g. get_order('rows') after plot
+        row_linkage: linkage whose dendrogram order the rows are drawn in, e.g. from get_linkage (with
+                    cluster_backend 'auto' or 'kmeans' for large matrices)
+
+        Returns
+        -------
+        ax
+        """
+        if render not in ['mesh', 'aggregate', 'auto']:
+            msg = self.u.msg.msg_arg_err("plot_hm", "render", render, ['mesh', 'aggregate', 'auto'])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        if aggregate not in ['mean', 'max']:
+            msg = self.u.msg.msg_arg_err("plot_hm", "aggregate", aggregate, ['mean', 'max'])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        df_dists = self.get_matrix()
+        if row_linkage is not None:
+            row_order = hierarchy.leaves_list(row_linkage)
+        if row_order is not None:
+            df_dists = df_dists.iloc[row_order]
+        if render == 'auto':
+            pixels = np.array(self.figsize) * self.dpi
+            render = 'aggregate' if len(df_dists) > pixels[1] or len(self.chart_columns) > pixels[0] else 'mesh'
+        if render == 'aggregate':
+            if ax is None:
+                fig, ax = plt.subplots(figsize=self.figsize)
+            if self.annot:
+                self.u.warn_p(['plot_hm', 'annot is ignored when the heatmap is aggregated.'])
+            image = self.plot_aggregate(ax, df_dists, aggregate)
+            ax.figure.colorbar(image, ax=ax, shrink=0.3, aspect=3, orientation='horizontal')
+        elif ax:
             ax = sns.heatmap(df_dists,
                              ax=ax, cmap=self.cmap_str, vmax=self.vmax, vmin=self.vmin, annot=self.annot,
                              yticklabels=self.y_tick_labels, xticklabels=self.x_tick_labels, linewidths=self.linewidths,
-                             linecolor=linecolor)
+                             linecolor=linecolor, cbar_kws=dict(shrink=0.3, aspect=3, orientation='horizontal'))
         else:
             ax = sns.heatmap(df_dists, cmap=self.cmap_str, vmax=self.vmax, vmin=self.vmin, annot=self.annot,
                              yticklabels=self.y_tick_labels, xticklabels=self.x_tick_labels, linewidths=self.linewidths,
-                             linecolor=linecolor)
+                             linecolor=linecolor, cbar_kws=dict(shrink=0.3, aspect=3, orientation='horizontal'))
         plt.title(self.title)
         plt.setp(ax.yaxis.get_majorticklabels(), rotation=0)
         plt.setp(ax.xaxis.get_majorticklabels(), rotation=45, horizontalalignment='right')
@@ -128,5 +450,4 @@ class Heatmap(Vis):
         ax.set_xticklabels(ax.get_xmajorticklabels(), fontsize=self.label_font_size)
         self.set_ax_params(ax)
         plt.tight_layout()
-        plt.colorbar(ax=ax, shrink=0.3, aspect=3, orientation='horizontal')
         return ax
@@ -18,28 +18,78 @@
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 
-from sciviso import Vis
+from sciviso import Vis, VisException
 
 
 class Line(Vis):
 
     def __init__(self, df: pd.DataFrame, title='', xlabel='', ylabel='', colour=None, figsize=(3, 3), config={}):
         super().__init__(df, figsize=figsize)
-        super().__init__(df)
         self.title = title
         self.colour = colour
         self.xlabel = xlabel
         self.ylabel = ylabel
+        # Summary of each group drawn as bands by the last plot_line_grps
+        self.summaries = []
         if config:
             self.load_style(config)
 
+    @staticmethod
+    def summarise(values: np.array, quantiles=(0.25, 0.75)) -> pd.DataFrame:
+        """
+        Summary of a group of profiles at each axis position (NaNs are ignored).
+        Parameters
+        ----------
+        values:     one row per profile, one column per axis position
+        quantiles:  quantiles to compute, e.g. (0.05, 0.25, 0.75, 0.95)
+
+        Returns
+        -------
+        dataframe with a row per axis position and columns n, mean, sd, sem and q<quantile> for each quantile
+        """
+        n = np.sum(~np.isnan(values), axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.nanmean(values, axis=0)
+            sd = np.nanstd(values, axis=0, ddof=1)
+            summary = pd.DataFrame({'n': n, 'mean': mean, 'sd': sd, 'sem': sd / np.sqrt(n)})
+        if quantiles:
+            # All the quantiles from one sort of each column
+            for q, q_values in zip(quantiles, np.nanquantile(values, quantiles, axis=0)):
+                summary[f'q{q}'] = q_values
+        return summary
+
+    def plot_summary(self, ax: plt.axes, axis_x: np.array, summary: pd.DataFrame, colour: str, band='sd',
+                     quantiles=(0.25, 0.75), alpha_band=0.3) -> None:
+        """
+        Draws a group's summary (see summarise) as shaded bands: mean +/- the sd or sem, and between each pair of
+        quantiles from the outside in (e.g. 5-95% then 25-75%), the inner ones darker.
+        """
+        if quantiles:
+            quantiles = sorted(quantiles)
+            pairs = [(quantiles[i], quantiles[-1 - i]) for i in range(len(quantiles) // 2)]
+            for i, (low, high) in enumerate(pairs):
+                ax.fill_between(axis_x, summary[f'q{low}'].values, summary[f'q{high}'].values, color=colour,
+                                alpha=alpha_band * (i + 1) / len(pairs), linewidth=0, zorder=1)
+        if band:
+            mean, spread = summary['mean'].values, summary[band].values
+            ax.fill_between(axis_x, mean - spread, mean + spread, color=colour, alpha=alpha_band, linewidth=0, zorder=1)
+
     def plot_line_grps(self, idxs, axis_labels, axis_columns, labels_lst=None, title='', plt_mean=True, colours=None,
                       dot_colours=None, ylim=None, alpha_bg=0.1, alpha_highlight=0.8, linewidth_bg=0.5,
-                      linewidth_highlight=3.0, scatter_linewidth=2.0):
-        """ Plot means of line groups with optional alternative dot colours. """
+                      linewidth_highlight=3.0, scatter_linewidth=2.0, summary='auto', summary_threshold=1000,
+                      band='sd', quantiles=(0.25, 0.75), alpha_band=0.3):
+        """
+        Plot means of line groups with optional alternative dot colours.
+
+        With summary each group is drawn as bands (see plot_summary) rather than a line per profile, so the time and
+        file size no longer depend on the number of profiles. summary can be True, False or 'auto' (when there are
+        more than summary_threshold profiles). band is 'sd', 'sem' or None, quantiles None for no quantile bands. The
+        summaries are kept on self.summaries (a dataframe per group).
+        """
         fig, ax = plt.subplots()
-        axis_values = []
         if not labels_lst:
             labels_lst = axis_labels
         if not colours:
@@ -47,32 +97,42 @@ class Line(Vis):
         if not dot_colours:
             dot_colours = self.palette
 
-        for c in axis_columns:
-            axis_values.append(self.df[c].values)
-
-        c_i = 0
-        values_lst = []
-        axis_x = range(0, len(axis_labels))
-        for v in axis_values:
-            value_lst = []
-            for i in idxs:
-                plt.plot(axis_x, v[i], alpha=alpha_bg,
-                         c=colours[c_i], linewidth=linewidth_bg, zorder=1)
-                value_lst.append(np.array(v[i]))
-            c_i += 1
-            if c_i == len(colours):
-                c_i = 0
-            values_lst.append(value_lst)
+        if summary not in [True, False, 'auto']:
+            msg = self.u.msg.msg_arg_err("plot_line_grps", "summary", summary, [True, False, 'auto'])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        if band not in ['sd', 'sem', None]:
+            msg = self.u.msg.msg_arg_err("plot_line_grps", "band", band, ['sd', 'sem', None])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        axis_x = np.arange(len(axis_labels))
+        means = []
+        self.summaries = []
+        for c_i, c in enumerate(axis_columns):
+            # One row per profile, one column per axis position
+            values = self.df[c].to_numpy(dtype=float)[idxs]
+            colour = colours[c_i % len(colours)]
+            if summary is True or (summary == 'auto' and len(values) > summary_threshold):
+                group_summary = self.summarise(values, quantiles)
+                self.summaries.append(group_summary)
+                self.plot_summary(ax, axis_x, group_summary, colour, band, quantiles, alpha_band)
+                means.append(group_summary['mean'].values)
+            else:
+                # All the profiles of the group as a single artist
+                segments = np.stack([np.broadcast_to(axis_x, values.shape), values], axis=-1)
+                ax.add_collection(LineCollection(segments, colors=colour, alpha=alpha_bg, linewidths=linewidth_bg,
+                                                 zorder=1))
+                means.append(values.mean(axis=0))
+        ax.autoscale_view()
 
-        c_i = 0
         if plt_mean:
-            for v in values_lst:
-                plt.plot(axis_x, np.mean(np.array(v), axis=0),
-                         alpha=alpha_highlight, linewidth=linewidth_highlight, c=colours[c_i], zorder=1)
-                plt.scatter(axis_x, np.mean(np.array(v), axis=0), facecolors='none', linewidth=scatter_linewidth,
-                            edgecolors=dot_colours[c_i], alpha=alpha_highlight, zorder=2)
-
-                c_i += 1
+            for c_i, mean in enumerate(means):
+                plt.plot(axis_x, mean, alpha=alpha_highlight, linewidth=linewidth_highlight,
+                         c=colours[c_i % len(colours)], zorder=1)
+                plt.scatter(axis_x, mean, facecolors='none', linewidth=scatter_linewidth,
+                            edgecolors=dot_colours[c_i % len(dot_colours)], alpha=alpha_highlight, zorder=2)
+        handles = [Line2D([], [], c=colours[c_i % len(colours)], linewidth=linewidth_highlight, alpha=alpha_highlight)
+                   for c_i in range(len(axis_columns))]
 
         plt.xticks(np.arange(len(axis_labels)))
         if ylim:
@@ -81,7 +141,10 @@ class Line(Vis):
         ax.set_xticklabels(axis_labels, rotation=45, ha='right')
         plt.title(title)
         ax.tick_params(labelsize=self.label_font_size)
-        ax.legend(labels_lst, loc='center left', bbox_to_anchor=(1, 0.5), fontsize=self.label_font_size)
+        # labels_lst falls back to the axis labels, so it needn't have a label per group
+        n = min(len(handles), len(labels_lst))
+        ax.legend(handles[:n], labels_lst[:n], loc='center left', bbox_to_anchor=(1, 0.5),
+                  fontsize=self.label_font_size)
         self.set_ax_params(ax)
         plt.tight_layout()
         return ax
@@ -15,106 +15,275 @@
 #                                                                             #
 ###############################################################################
 
+import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
+from matplotlib.collections import PathCollection
+from matplotlib.patches import Rectangle
+from matplotlib.path import Path
 
-from collections import defaultdict
-from sciviso import Vis
+from sciviso import Vis, VisException
 
 """
 Based on: https://plotly.com/python/sankey-diagram/
 """
 
+# Path codes of a ribbon: a curve along the top from the source to the target, down the target side and back along the
+# bottom
+RIBBON_CODES = [Path.MOVETO, Path.CURVE4, Path.CURVE4, Path.CURVE4, Path.LINETO, Path.CURVE4, Path.CURVE4, Path.CURVE4,
+                Path.CLOSEPOLY]
+
+# Colours of the SiRCle regulatory groups, used for these values when no colours are given
+SIRCLE_COLOURS = {'MDS': '#d8419b', 'MDS+TMDE': '#e585c0', 'MDS_ncRNA': '#d880b4',
+                  'MDE': '#6aaf44', 'MDE+TMDS': '#0e8e6d', 'MDE_ncRNA': '#9edb77',
+                  'TMDE': '#fe2323', 'TMDS': '#2952ff',
+                  'TPDE': '#e68e25', 'TPDE+TMDS': '#844c0f',
+                  'TPDS': '#462d76', 'TPDS+TMDE': '#9b29b7'}
+
 
 class Sankeyplot(Vis):
 
-    def __init__(self, df: pd.DataFrame, title='', figsize=(3, 3), colours=None, config={}):
+    def __init__(self, df: pd.DataFrame, title='', figsize=(3, 3), colours=None, engine='plotly', config={}):
+        """
+        colours: list of colours cycled over the values of the colour column, or a dict of value to colour. By default
+        the SiRCle group colours are used for those groups and the default list for any other value.
+        engine: 'plotly' returns an interactive plotly figure (static export needs kaleido), 'matplotlib' draws the
+        diagram itself on a matplotlib axis so it can be saved with save_svg/save_png like the other charts.
+        """
         super().__init__(df, figsize=figsize)
-        super().__init__(df)
         self.df = df
+        self.engine = engine
         self.title = title
         self.label = 'sankey'
+        self.user_colours = colours is not None
         self.colours = colours if colours is not None else ['#FFC107', '#016957', '#9785C0',
                '#D09139', '#338A03', '#5930B1', '#FFE884', '#35B567', '#1E88E5',
                '#ACAD60', '#A2FFB4', '#854A9C']
         if config:
             self.load_style(config)
 
-    def plot(self, colour_col=None, columns=None):
+    def get_colour_lookup(self, values: np.array) -> np.array:
+        """ Colour of each of the (unique) values of the colour column. """
+        if isinstance(self.colours, dict):
+            return np.array([self.colours.get(v) for v in values], dtype=object)
+        lookup = np.array([self.colours[i % len(self.colours)] for i in range(len(values))], dtype=object)
+        if not self.user_colours:
+            lookup = np.array([SIRCLE_COLOURS.get(v, c) for v, c in zip(values, lookup)], dtype=object)
+        return lookup
+
+    @staticmethod
+    def count_links(sources: np.array, targets: np.array, num_nodes: int, weights=None, colours=None) -> pd.DataFrame:
+        """
+        Sums the rows going between each pair of nodes with one np.unique over the pairs packed as integers, so the
+        cost only depends on the number of rows and the result on the number of distinct links.
+        :param sources: source node of each row
+        :param targets: target node of each row
+        :param num_nodes: total number of nodes
+        :param weights: value of each row, by default each row counts as 1
+        :param colours: colour of each row, a link takes the colour of the last row that follows it
+        :return: links dataframe (source, target, value, colour) in the order the links first appear
+        """
+        pairs = sources.astype(np.int64) * num_nodes + targets
+        keys, first, inverse = np.unique(pairs, return_index=True, return_inverse=True)
+        values = np.bincount(inverse, weights=weights, minlength=len(keys))
+        last = np.zeros(len(keys), dtype=np.int64)
+        np.maximum.at(last, inverse, np.arange(len(pairs)))
+        order = np.argsort(first, kind='stable')
+        return pd.DataFrame({'source': keys[order] // num_nodes, 'target': keys[order] % num_nodes,
+                             'value': values[order],
+                             'colour': colours[last[order]] if colours is not None else None})
+
+    def get_weights(self, weight_col: str) -> np.array:
+        """ Values of the weight column, None (each row counts once) if there isn't one. """
+        if weight_col is None:
+            return None
+        self.check_columns([weight_col])
+        return self.df[weight_col].values.astype(float)
+
+    def get_nodes_and_links(self, columns: list, colour_col: str, weight_col=None) -> tuple:
+        """
+        Codes the values of each column as nodes (with pd.factorize, numbered on from the previous columns) and sums
+        the rows going between the nodes of neighbouring columns (see count_links).
+        :param columns: columns from left to right
+        :param colour_col: column the links are coloured by, a link takes the colour of the last row that follows it
+        :param weight_col: column with the number of entities each row stands for (e.g. a count table), by default
+        each row is one entity
+        :return: nodes dataframe (column, label), links dataframe (source, target, value, colour)
+        """
+        codes, nodes = [], []
+        offset = 0
+        for c in columns:
+            column_codes, values = pd.factorize(self.df[c].values, use_na_sentinel=False)
+            codes.append(column_codes + offset)
+            nodes.append(pd.DataFrame({'column': c, 'label': [str(v) for v in values]}))
+            offset += len(values)
+        colour_codes, colour_values = pd.factorize(self.df[colour_col].values, use_na_sentinel=False)
+        colours = self.get_colour_lookup(colour_values)[colour_codes]
+        weights = self.get_weights(weight_col)
+        links = [self.count_links(codes[i], codes[i + 1], offset, weights, colours) for i in range(len(columns) - 1)]
+        nodes = pd.concat(nodes, ignore_index=True)
+        links = pd.concat(links, ignore_index=True) if links else pd.DataFrame(columns=['source', 'target', 'value',
+                                                                                          'colour'])
+        return nodes, links
+
+    def get_nodes_and_links_from_edges(self, source_col: str, target_col: str, value_col=None,
+                                       colour_col=None) -> tuple:
+        """
+        Nodes and links from an edge table, i.e. self.df has a row per flow rather than per entity. Rows with the same
+        source and target are summed, so the cost only depends on the number of flows.
+        :param source_col: column with the source node of each flow
+        :param target_col: column with the target node of each flow
+        :param value_col: column with the size of each flow, by default each row counts as 1
+        :param colour_col: column the links are coloured by, by default the source column
+        :return: nodes dataframe (column, label), links dataframe (source, target, value, colour)
+        """
+        self.check_columns([source_col, target_col])
+        colour_col = colour_col if colour_col else source_col
+        self.check_columns([colour_col])
+        # A node is the same whether it is the source or target of a flow
+        codes, values = pd.factorize(np.concatenate([self.df[source_col].values, self.df[target_col].values]),
+                                     use_na_sentinel=False)
+        colour_codes, colour_values = pd.factorize(self.df[colour_col].values, use_na_sentinel=False)
+        colours = self.get_colour_lookup(colour_values)[colour_codes]
+        nodes = pd.DataFrame({'column': None, 'label': [str(v) for v in values]})
+        links = self.count_links(codes[:len(self.df)], codes[len(self.df):], len(values), self.get_weights(value_col),
+                                 colours)
+        return nodes, links
+
+    def plot(self, colour_col=None, columns=None, weight_col=None, source_col=None, target_col=None, value_col=None,
+             ax=None):
         """
 
         :param colour_col: the colour column will be the column by which the values are annotated.
         :param columns: has to be ordered as in the very left one in the list is on the LHS while the one on the RHS is
         the last in the snakey plot: default is to use all columns
-        :return:
+        :param weight_col: column with the number of entities each row stands for, by default each row counts once
+        :param source_col: with target_col, plot an edge table (a row per flow, see get_nodes_and_links_from_edges)
+        instead of a row per entity
+        :param target_col: column with the target of each flow
+        :param value_col: column with the size of each flow in an edge table
+        :param ax: axis to draw on when the engine is matplotlib
+        :return: a plotly figure, or the matplotlib axis
         """
-        # Use by default the last column as colour
-        colour_col = colour_col if colour_col else self.df.columns[-1]
-        labels = {}
-        i = 0
-        columns = columns if columns else self.df.columns
-        for c in columns:
-            for v in self.df[c].values:
-                if labels.get(f'{c}:{v}') is None:
-                    labels[f'{c}:{v}'] = i
-                    i += 1
-        # Now we want to do the source to target
-        source = []
-        target = []
-        value = []
-        colours = []
-        colour_column = self.df[colour_col].values
-        cmap = {}
-        i = 0
-        for c in colour_column:
-            cmap[c] = self.colours[i]
-            i += 1
-            if i == len(self.colours):
-                i = 0
-
-        source_target_dict = defaultdict(int)
-        colour_dict = {}
-        cmap = {'MDS': '#d8419b', 'MDS+TMDE': '#e585c0', 'MDS_ncRNA': '#d880b4',
-                      'MDE': '#6aaf44', 'MDE+TMDS': '#0e8e6d', 'MDE_ncRNA': '#9edb77',
-                      'TMDE': '#fe2323', 'TMDS': '#2952ff',
-                      'TPDE': '#e68e25', 'TPDE+TMDS': '#844c0f',
-                      'TPDS': '#462d76', 'TPDS+TMDE': '#9b29b7'}
-
-        for i, c in enumerate(columns):
-            if i + 1 < len(columns):
-                # Basically we want to go through each and say the column0 is the source and the next value is the
-                # target
-                source_values = self.df[c].values
-                target_values = self.df[columns[i + 1]].values
-                for j, s in enumerate(source_values):
-                    lbl = str(labels.get(f'{c}:{s}')) + '-' + str(labels.get(f'{columns[i + 1]}:{target_values[j]}'))
-                    colour_dict[lbl] = cmap.get(colour_column[j])
-                    source_target_dict[lbl] += 1
-                    value.append(1)
-                    source.append(labels.get(f'{c}:{s}'))
-                    target.append(labels.get(f'{columns[i + 1]}:{target_values[j]}'))
-                    colours.append(cmap.get(colour_column[j]))
-
-        label_shows = [c.split(':')[1] for c in list(labels.keys())]
-        new_df = pd.DataFrame()
-        source = [int(k.split('-')[0]) for k in source_target_dict]
-        target = [int(k.split('-')[1]) for k in source_target_dict]
-        value = [v for k, v in source_target_dict.items()]
-        colours = [colour_dict[k] for k in source_target_dict]
+        if self.engine not in ['plotly', 'matplotlib']:
+            msg = self.u.msg.msg_arg_err("plot", "engine", self.engine, ['plotly', 'matplotlib'])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        if source_col is not None or target_col is not None:
+            nodes, links = self.get_nodes_and_links_from_edges(source_col, target_col, value_col, colour_col)
+        else:
+            # Use by default the last column as colour
+            colour_col = colour_col if colour_col else self.df.columns[-1]
+            columns = list(columns) if columns else list(self.df.columns)
+            nodes, links = self.get_nodes_and_links(columns, colour_col, weight_col)
+        if self.engine == 'matplotlib':
+            return self.plot_static(nodes, links, ax)
+        import plotly.graph_objects as go
         fig = go.Figure(data=[go.Sankey(
             node=dict(
                 pad=15,
                 thickness=20,
                 line=dict(color="black", width=0.5),
-                label=label_shows,
+                label=list(nodes['label'].values),
                 color='white'
             ),
             link=dict(
-                source=source,  # indices correspond to labels, eg A1, A2, A1, B1, ...
-                target=target,
-                value=value,
-                color=colours
+                source=list(links['source'].values),  # indices correspond to labels, eg A1, A2, A1, B1, ...
+                target=list(links['target'].values),
+                value=list(links['value'].values),
+                color=list(links['colour'].values)
             ))])
 
         fig.update_layout(title_text=self.title, font_size=self.title_font_size)
-        return fig
\ No newline at end of file
+        return fig
+
+    @staticmethod
+    def get_node_stages(nodes: pd.DataFrame, links: pd.DataFrame) -> np.array:
+        """
+        Stage (column of the diagram) of each node: the column it came from or, for edge tables, the longest path of
+        links leading to it.
+        """
+        if nodes['column'].notna().all():
+            return pd.factorize(nodes['column'].values)[0]
+        sources, targets = links['source'].values, links['target'].values
+        stages = np.zeros(len(nodes), dtype=np.int64)
+        # Relax the links until nothing moves (at most one pass per node, more means there is a cycle)
+        for _ in range(len(nodes)):
+            previous = stages.copy()
+            np.maximum.at(stages, targets, stages[sources] + 1)
+            if np.array_equal(previous, stages):
+                break
+        return stages
+
+    @staticmethod
+    def get_layout(nodes: pd.DataFrame, links: pd.DataFrame, pad=0.05, node_width=0.02) -> tuple:
+        """
+        Node and ribbon positions in a unit square. Nodes are as tall as the larger of their in and out flows (the same
+        scale in every stage), stacked in each stage in the order they appear with pad between them and centred.
+        Ribbons leave a node in the order of their targets' heights and arrive in the order of their sources' heights
+        so they don't cross at the nodes.
+        :return: nodes dataframe with x, top and height added, links dataframe with source_top, target_top and height
+        """
+        num_nodes = len(nodes)
+        sources, targets = links['source'].values.astype(np.int64), links['target'].values.astype(np.int64)
+        values = links['value'].values.astype(float)
+        sizes = np.maximum(np.bincount(sources, weights=values, minlength=num_nodes),
+                           np.bincount(targets, weights=values, minlength=num_nodes))
+        stages = Sankeyplot.get_node_stages(nodes, links)
+        num_stages = stages.max() + 1 if num_nodes else 1
+        stage_counts = np.bincount(stages, minlength=num_stages)
+        stage_totals = np.bincount(stages, weights=sizes, minlength=num_stages)
+        # Keep at least half the height for the nodes
+        pad = min(pad, 0.5 / max(stage_counts.max() - 1, 1))
+        with np.errstate(divide='ignore'):
+            scale = np.min(np.where(stage_totals > 0, (1 - pad * (stage_counts - 1)) / stage_totals, np.inf))
+        scale = scale if np.isfinite(scale) else 0
+        heights = sizes * scale
+        # Distance of each node from the top of its stage, then centre the stages
+        below = pd.Series(heights + pad).groupby(stages).cumsum().values - heights - pad
+        used = np.bincount(stages, weights=heights, minlength=num_stages) + pad * (stage_counts - 1)
+        tops = 1 - (1 - used[stages]) / 2 - below
+        nodes = nodes.assign(x=stages / max(num_stages - 1, 1) * (1 - node_width), top=tops, height=heights)
+        link_heights = values * scale
+        source_tops, target_tops = np.zeros(len(links)), np.zeros(len(links))
+        for ends, others, out in [(sources, targets, source_tops), (targets, sources, target_tops)]:
+            order = np.lexsort((-tops[others], ends))
+            stacked = pd.Series(link_heights[order]).groupby(ends[order]).cumsum().values - link_heights[order]
+            out[order] = tops[ends[order]] - stacked
+        links = links.assign(source_top=source_tops, target_top=target_tops, height=link_heights)
+        return nodes, links
+
+    def plot_static(self, nodes: pd.DataFrame, links: pd.DataFrame, ax=None, node_width=0.02):
+        """
+        Draws the Sankey diagram with matplotlib: white nodes with a black outline (as the plotly nodes) and all the
+        ribbons as one collection of bezier paths.
+        :return: ax
+        """
+        if ax is None:
+            fig, ax = plt.subplots(figsize=self.figsize)
+        nodes, links = self.get_layout(nodes, links, node_width=node_width)
+        x0 = nodes['x'].values[links['source'].values] + node_width
+        x1 = nodes['x'].values[links['target'].values]
+        xm = (x0 + x1) / 2
+        s_top, t_top, h = links['source_top'].values, links['target_top'].values, links['height'].values
+        vertices = np.stack([np.column_stack(v) for v in [
+            (x0, s_top), (xm, s_top), (xm, t_top), (x1, t_top), (x1, t_top - h), (xm, t_top - h), (xm, s_top - h),
+            (x0, s_top - h), (x0, s_top)]], axis=1)
+        colours = [c if c is not None else 'lightgrey' for c in links['colour'].values]
+        # Ribbons are see through as in plotly
+        ax.add_collection(PathCollection([Path(v, RIBBON_CODES) for v in vertices], facecolors=colours,
+                                         edgecolors='none', alpha=0.5))
+        last_x = nodes['x'].max()
+        for x, top, height, label in nodes[['x', 'top', 'height', 'label']].values:
+            ax.add_patch(Rectangle((x, top - height), node_width, height, facecolor='white', edgecolor='black',
+                                   linewidth=0.5))
+            # Labels go outside the last stage's nodes
+            right = x < last_x or last_x == 0
+            ax.text(x + node_width * 1.5 if right else x - node_width * 0.5, top - height / 2, label,
+                    ha='left' if right else 'right', va='center', fontsize=self.label_font_size)
+        # A little margin so the outline of the outer nodes isn't clipped
+        ax.set_xlim(-0.01, 1.01)
+        ax.set_ylim(-0.01, 1.01)
+        ax.axis('off')
+        ax.set_title(self.title, fontsize=self.title_font_size, fontweight=self.title_font_weight)
+        return ax
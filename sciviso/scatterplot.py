@@ -18,9 +18,12 @@
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
+from matplotlib.colors import LogNorm, to_rgba_array
+from matplotlib.lines import Line2D
+from matplotlib.patches import Patch
 from mpl_toolkits.mplot3d import Axes3D
 
-from sciviso import Vis
+from sciviso import Vis, VisException
 
 
 class Scatterplot(Vis):
@@ -29,7 +32,16 @@ class Scatterplot(Vis):
                  zlabel=None, add_legend=True,
                  points_to_annotate=None, annotation_label=None, add_correlation=False, correlation='Spearman',
                  s=30, config={},
-                 color_col=None):
+                 color_col=None, rasterize=None, rasterize_threshold=50000, aggregate=None, aggregate_column=None,
+                 aggregate_shape=None):
+        """
+        rasterize: draw the points as a bitmap (axes, labels and annotations stay as vector text when saving an SVG),
+        None rasterizes automatically when there are more than rasterize_threshold points.
+        aggregate: instead of drawing each point, bin the points into a pixel grid and draw it as an image (for
+        millions of points): 'count' (points per pixel), 'mean' (mean of aggregate_column, or of colour if it is an
+        array, per pixel) or 'category' (most common value of aggregate_column, default color_col, per pixel).
+        aggregate_shape: (rows, columns) of the grid, default is the axis size in pixels at the chart's dpi.
+        """
         super().__init__(df)
 
         self.x = x
@@ -46,10 +58,156 @@ class Scatterplot(Vis):
         self.add_legend = add_legend
         self.zlabel = zlabel
         self.color_col = color_col
+        self.rasterize = rasterize
+        self.rasterize_threshold = rasterize_threshold
+        self.aggregate = aggregate
+        self.aggregate_column = aggregate_column
+        self.aggregate_shape = aggregate_shape
         self.s = s if config.get('s') is None else s
         if config:
             self.load_style(config)
 
+    def use_rasterization(self, num_points: int) -> bool:
+        """ Whether to draw the point layer as a bitmap. """
+        if self.rasterize is None:
+            return num_points > self.rasterize_threshold
+        return self.rasterize
+
+    @staticmethod
+    def aggregate_points(x: np.array, y: np.array, shape: tuple, extent: list, values=None, how='count') -> np.array:
+        """
+        Bins the points into a grid, memory and time only depend on the number of points and pixels.
+        Parameters
+        ----------
+        x:      x coordinates
+        y:      y coordinates
+        shape:  (rows, columns) of the grid, rows go from the bottom of the plot up
+        extent: [x min, x max, y min, y max] covered by the grid
+        values: values per point for 'mean', integer category codes per point for 'category' (negative codes, i.e.
+                missing categories from pd.factorize, are left out)
+        how:    'count', 'mean' or 'category'
+
+        Returns
+        -------
+        grid (rows x columns) of the count, the mean (NaN for empty pixels) or the most common category code (-1 for
+        empty pixels)
+        """
+        rows, cols = shape
+        x_min, x_max, y_min, y_max = extent
+        ix = np.clip(((x - x_min) / ((x_max - x_min) or 1) * cols).astype(np.int64), 0, cols - 1)
+        iy = np.clip(((y - y_min) / ((y_max - y_min) or 1) * rows).astype(np.int64), 0, rows - 1)
+        pixels = iy * cols + ix
+        counts = np.bincount(pixels, minlength=rows * cols)
+        if how == 'count':
+            return counts.reshape(rows, cols)
+        if how == 'mean':
+            sums = np.bincount(pixels, weights=values, minlength=rows * cols)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return (sums / counts).reshape(rows, cols)
+        # Count each (pixel, category) combination then keep the most common category in each pixel
+        known = values >= 0
+        pixels, values = pixels[known], values[known]
+        num_categories = int(np.max(values)) + 1 if len(values) else 1
+        combos, combo_counts = np.unique(pixels * num_categories + values, return_counts=True)
+        combo_pixels = combos // num_categories
+        order = np.lexsort((combo_counts, combo_pixels))
+        last = np.append(combo_pixels[order][1:] != combo_pixels[order][:-1], True)
+        grid = np.full(rows * cols, -1, dtype=np.int64)
+        grid[combo_pixels[order][last]] = (combos % num_categories)[order][last]
+        return grid.reshape(rows, cols)
+
+    def plot_aggregate(self, ax: plt.axes, x: np.array, y: np.array):
+        """ Draws the points binned into a pixel grid with imshow (see aggregate), returns the image. """
+        finite = np.isfinite(x) & np.isfinite(y)
+        if self.aggregate == 'category':
+            column = self.aggregate_column or self.color_col
+            self.check_columns([column])
+            codes, categories = pd.factorize(self.df[column].values)
+            # Points without a category are dropped along with those without coordinates
+            finite &= codes >= 0
+        x, y = x[finite], y[finite]
+        extent = [self.min_x if self.min_x is not None else np.min(x),
+                  self.max_x if self.max_x is not None else np.max(x),
+                  self.min_y if self.min_y is not None else np.min(y),
+                  self.max_y if self.max_y is not None else np.max(y)]
+        shape = self.aggregate_shape
+        if shape is None:
+            bbox = ax.get_window_extent().transformed(ax.figure.dpi_scale_trans.inverted())
+            shape = (max(1, int(bbox.height * self.dpi)), max(1, int(bbox.width * self.dpi)))
+        imshow_args = dict(origin='lower', extent=extent, aspect='auto', interpolation='nearest')
+        if self.aggregate == 'count':
+            grid = self.aggregate_points(x, y, shape, extent)
+            image = ax.imshow(np.ma.masked_equal(grid, 0), cmap=self.cmap_str,
+                              norm=LogNorm(vmin=self.vmin or 1, vmax=self.vmax or max(1, grid.max())), **imshow_args)
+        elif self.aggregate == 'mean':
+            if self.aggregate_column is not None:
+                self.check_columns([self.aggregate_column])
+                values = self.df[self.aggregate_column].values
+            else:
+                values = np.asarray(self.colour)
+                if not np.issubdtype(values.dtype, np.number) or values.shape != finite.shape:
+                    msg = f'plot_aggregate: aggregate="mean" needs a numeric aggregate_column (or colour as an array ' \
+                          f'of values per point), colour was: {self.colour}'
+                    self.u.err_p([msg])
+                    raise VisException(msg)
+            values = values.astype(float)[finite]
+            grid = self.aggregate_points(x, y, shape, extent, values, how='mean')
+            image = ax.imshow(np.ma.masked_invalid(grid), cmap=self.cmap_str, vmin=self.vmin, vmax=self.vmax,
+                              **imshow_args)
+        elif self.aggregate == 'category':
+            grid = self.aggregate_points(x, y, shape, extent, codes[finite], how='category')
+            colours = to_rgba_array([self.palette[i % len(self.palette)] for i in range(len(categories))])
+            rgba = np.zeros(grid.shape + (4,))
+            rgba[grid >= 0] = colours[grid[grid >= 0]]
+            rgba[grid >= 0, 3] = self.opacity
+            image = ax.imshow(rgba, **imshow_args)
+            if self.add_legend:
+                handles = [Patch(facecolor=colours[i]) for i in range(len(categories))]
+                ax.legend(handles, list(categories), bbox_to_anchor=(1.05, 1.0), loc='upper left',
+                          fontsize=self.label_font_size)
+            return image
+        else:
+            msg = self.u.msg.msg_arg_err("plot_aggregate", "aggregate", self.aggregate, ['count', 'mean', 'category'])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        if self.add_legend:
+            plt.colorbar(image, ax=ax, shrink=0.2, aspect=3)
+        return image
+
+    def plot_categories(self, ax: plt.axes, coords: list, categories: np.array, rasterized=False) -> tuple:
+        """
+        Draws all the categories of the colour column with one scatter call and a colour per point, rather than a
+        filter and scatter call per category. Points are drawn grouped by category (in order of first appearance) so
+        later categories are on top, as when drawing them one at a time.
+        Parameters
+        ----------
+        ax:         axis to draw on
+        coords:     list of the x, y (and z) coordinate arrays
+        categories: category of each point
+        rasterized: draw the points as a bitmap
+
+        Returns
+        -------
+        scatter, list of legend handles (one per category)
+        """
+        codes, names = pd.factorize(categories)
+        colours = to_rgba_array([self.palette[i % len(self.palette)] for i in range(len(names))])
+        # Missing categories aren't drawn
+        drawn = np.where(codes >= 0)[0]
+        order = drawn[np.argsort(codes[drawn], kind='stable')]
+        scatter = ax.scatter(*[np.asarray(c)[order] for c in coords], c=colours[codes[order]], alpha=self.opacity,
+                             s=self.s, rasterized=rasterized)
+        handles = [Line2D([], [], marker='o', linestyle='', color=colours[i], alpha=self.opacity, label=name)
+                   for i, name in enumerate(names)]
+        return scatter, handles
+
+    def get_annotation_idxs(self, labels: np.array) -> np.array:
+        """ Positions of the labels that are in points_to_annotate, using a hash lookup so the cost is O(N + M). """
+        points_to_annotate = self.points_to_annotate
+        if isinstance(points_to_annotate, str):
+            points_to_annotate = [points_to_annotate]
+        return np.where(pd.Series(labels).isin(list(points_to_annotate)).values)[0]
+
     def annotate(self, ax: plt.axes, x: np.array, y: np.array, labels: np.array) -> plt.axes:
         """
         https://stackoverflow.com/questions/5147112/how-to-put-individual-tags-for-a-scatter-plot for more details
@@ -64,22 +222,21 @@ class Scatterplot(Vis):
         -------
 
         """
-        for i, name in enumerate(labels):
-            if name in self.points_to_annotate:
-                ax.annotate(name, (x[i], y[i]),
-                            xytext=(-5, 10),
-                            textcoords='offset points', ha='center', va='bottom',
-                            bbox=dict(boxstyle='round,pad=0.5',
-                                      fc='white', alpha=0.2)
-                            )
+        for i in self.get_annotation_idxs(labels):
+            name = labels[i]
+            ax.annotate(name, (x[i], y[i]),
+                        xytext=(-5, 10),
+                        textcoords='offset points', ha='center', va='bottom',
+                        bbox=dict(boxstyle='round,pad=0.5',
+                                  fc='white', alpha=0.2)
+                        )
 
         return ax
 
     def annotate3D(self, ax: plt.axes, x: np.array, y: np.array, z: np.array, labels: np.array) -> plt.axes:
 
-        for i, name in enumerate(labels):
-            if name in self.points_to_annotate:
-                ax.text3D(x[i], y[i], z[i], name, size=12, zorder=1)
+        for i in self.get_annotation_idxs(labels):
+            ax.text3D(x[i], y[i], z[i], labels[i], size=12, zorder=1)
         return ax
 
     def plot2D(self, ax=None):
@@ -98,22 +255,18 @@ class Scatterplot(Vis):
         # Plot the points
         if ax is None:
             fig, ax = plt.subplots()
-        # Check if we have a colour col
-        color_col = self.color_col
-        if color_col:
-            colors = list(set(vis_df[color_col].values))
-            ci = 0
-            for c in colors:
-                c_df = vis_df[vis_df[color_col] == c]
-                scatter = ax.scatter(c_df[x].values, c_df[y].values, c=self.palette[ci], alpha=self.opacity,
-                                     s=self.s, vmin=self.vmin, vmax=self.vmax, label=c)
-                ci += 1
-                if ci >= len(self.palette):
-                    ci = 0
+        if self.aggregate:
+            self.plot_aggregate(ax, vis_df[x].values, vis_df[y].values)
         else:
-            scatter = ax.scatter(vis_df[x].values, vis_df[y].values, c=self.colour, alpha=self.opacity,
-                                 cmap=self.cmap_str,
-                                 s=self.s, vmin=self.vmin, vmax=self.vmax)
+            rasterized = self.use_rasterization(len(vis_df))
+            # Check if we have a colour col
+            color_col = self.color_col
+            if color_col:
+                _, handles = self.plot_categories(ax, [vis_df[x].values, vis_df[y].values],
+                                                  vis_df[color_col].values, rasterized)
+            else:
+                ax.scatter(vis_df[x].values, vis_df[y].values, c=self.colour, alpha=self.opacity, cmap=self.cmap_str,
+                           s=self.s, vmin=self.vmin, vmax=self.vmax, rasterized=rasterized)
 
         # Check if we need to annotate anything
         if self.points_to_annotate is not None:
@@ -121,10 +274,9 @@ class Scatterplot(Vis):
             self.annotate(ax, vis_df[x].values, vis_df[y].values, self.df[self.annotation_label].values)
 
         self.add_labels()
-        if self.add_legend and self.color_col:
-            plt.colorbar(scatter, shrink=0.2, aspect=3)
-        elif self.color_col:
-            plt.legend(bbox_to_anchor=(1.05, 1.0), loc='upper left')
+        # The aggregated image draws its own legend
+        if self.color_col and not self.aggregate:
+            plt.legend(handles=handles, bbox_to_anchor=(1.05, 1.0), loc='upper left')
         ax.tick_params(labelsize=self.label_font_size)
         self.set_ax_params(ax)
         return ax
@@ -147,23 +299,16 @@ class Scatterplot(Vis):
         # Plot the points
         fig = plt.figure()
         ax = Axes3D(fig)
+        rasterized = self.use_rasterization(len(vis_df))
         # Check if we have a colour col
         color_col = self.color_col
         if color_col:
-            colors = list(set(vis_df[color_col].values))
-            ci = 0
-            for c in colors:
-                c_df = vis_df[vis_df[color_col] == c]
-                scatter = ax.scatter(c_df[x].values, c_df[y].values, c_df[z].values,
-                                     c=self.palette[ci], alpha=self.opacity,
-                                     s=self.s, vmin=self.vmin, vmax=self.vmax, label=c)
-                ci += 1
-                if ci >= len(self.palette):
-                    ci = 0
+            scatter, handles = self.plot_categories(ax, [vis_df[x].values, vis_df[y].values, vis_df[z].values],
+                                                    vis_df[color_col].values, rasterized)
         else:
             scatter = ax.scatter(vis_df[x].values, vis_df[y].values, vis_df[z].values, s=self.s,
                                  c=self.colour, alpha=self.opacity, cmap=self.cmap_str,
-                                 vmin=self.vmin, vmax=self.vmax)
+                                 vmin=self.vmin, vmax=self.vmax, rasterized=rasterized)
         # remove fill
         ax.xaxis.pane.fill = False
         ax.yaxis.pane.fill = False
@@ -175,13 +320,10 @@ class Scatterplot(Vis):
                             self.df[self.annotation_label].values)
 
         self.add_labels()
-        if isinstance(self.colour, str):
-            # continue
-            e = ''
-        elif self.add_legend and not self.color_col:
+        if self.add_legend and not self.color_col and not isinstance(self.colour, str):
             plt.colorbar(scatter, shrink=0.2, aspect=3)
         elif self.color_col:
-            plt.legend(bbox_to_anchor=(1.05, 1.0), loc='upper left')
+            plt.legend(handles=handles, bbox_to_anchor=(1.05, 1.0), loc='upper left')
         ax.tick_params(labelsize=self.label_font_size)
         plt.title(self.title)
         self.set_ax_params(ax)
@@ -200,13 +342,14 @@ class Scatterplot(Vis):
 
         x = self.df[self.x].values
         y = self.df[self.y].values
+        rasterized = self.use_rasterization(len(x))
         labels = []
         if plt_bg:
             if max_bg > len(x):
                 max_bg = len(x)
             rand_idxs = np.random.choice(range(0, len(self.df), 1), max_bg)
             ax.scatter(x[rand_idxs], y[rand_idxs], c='lightgrey', alpha=alpha_bg,
-                       vmin=self.vmin, vmax=self.vmax)
+                       vmin=self.vmin, vmax=self.vmax, rasterized=rasterized)
             labels = ['None']
 
         g_i = 0
@@ -216,7 +359,7 @@ class Scatterplot(Vis):
                        label=grp_labels[g_i],
                         linewidth=linewidth,
                        alpha=alpha_highlight,
-                       vmin=self.vmin, vmax=self.vmax)
+                       vmin=self.vmin, vmax=self.vmax, rasterized=rasterized)
             labels.append(grp_labels[g_i])
             c_i += 1
             if c_i == len(grp_colours):
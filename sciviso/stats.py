@@ -15,14 +15,14 @@
 #                                                                             #
 ###############################################################################
 
-import io
-import matplotlib.pyplot as plt
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-import seaborn as sns
-from matplotlib.colors import ListedColormap
-from textwrap import wrap
+from scipy import stats
 
-from sciutil import SciUtil, SciException
+from sciutil import SciUtil
+from sciviso.vis import VisException
 
 assumption_dict = {
     'ttest_1samp': {
@@ -89,7 +89,7 @@ assumption_dict = {
                      'Long': 'The Mann–Whitney U test (also known as the Wilcoxon rank sum test) can be used for the comparison of a non-normally distributed, but at least ordinally scaled, parameter in two unpaired samples.[1]',
                      'Null Hypothesis': 'The null hypothesis is that the two groups have the same mean.',
                      'Link': 'https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.mannwhitneyu.html#scipy.stats.mannwhitneyu',
-                     'Assumptions': {'paired': True,
+                     'Assumptions': {'paired': False,
                                      'normality': False,
                                      'equal-variance': False,
                                      'num_groups': 2,
@@ -104,7 +104,7 @@ assumption_dict = {
                  'Long': 'The Wilcoxon signed rank test can be used for the comparison of two paired samples of non-normally distributed parameters, but on a scale that is at least ordinal.[5] Alternatively, the sign test should be used when the two values are only distinguished on a binary scale—e.g., improvement versus deterioration. If more than matched paired samples are being compared, the Friedman test can be used as a generalization of the sign test. [1]',
                  'Null Hypothesis': 'The null hypothesis is that the two groups have the same mean.',
                  'Link': 'https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.wilcoxon.html#scipy.stats.wilcoxon',
-                 'Assumptions': {'paired': False,
+                 'Assumptions': {'paired': True,
                                  'normality': False,
                                  'equal-variance': False,
                                  'num_groups': 2,
@@ -181,36 +181,572 @@ assumption_dict = {
                },
 }
 
-class VisException(SciException):
-    def __init__(self, message=''):
-        Exception.__init__(self, message)
+# Names match statannot's so the charts' stat_method doesn't change
+PAIRWISE_TESTS = ['Mann-Whitney', 't-test_ind', 't-test_welch', 't-test_paired', 'Wilcoxon']
 
 
-class Vis:
+def mann_whitney_pairs(groups: list, counts: np.array, pairs: list, max_cells=10000000) -> np.array:
+    """
+    Two-sided Mann-Whitney U test for each pair of groups. The groups are ranked once: counts holds how often each
+    value of the pooled sample occurs in each group, so U and the tie correction of every pair come from sums over
+    the count rows rather than re-ranking the pair. Follows scipy.stats.mannwhitneyu: the exact distribution is used
+    when either group has 8 or fewer values and there are no ties, otherwise the normal approximation with tie and
+    continuity correction.
+    :param groups: list of np.arrays, one per group (only used for the exact tests)
+    :param counts: np.array (groups x unique pooled values) of the count of each value in each group
+    :param pairs: list of (i, j) indexes into the groups
+    :param max_cells: maximum size of the (pairs x unique values) arrays, the pairs are tested in chunks below this
+    :return: np.array (len(pairs) x 2) of U statistic (of the first group) and p value
+    """
+    results = np.zeros((len(pairs), 2))
+    n = counts.sum(axis=1)
+    # Number of values in each group strictly below each pooled value
+    below = np.cumsum(counts, axis=1) - counts
+    pair_i, pair_j = np.array(pairs, dtype=int).reshape(-1, 2).T
+    chunk_size = max(1, max_cells // max(counts.shape[1], 1))
+    for start in range(0, len(pairs), chunk_size):
+        i, j = pair_i[start: start + chunk_size], pair_j[start: start + chunk_size]
+        # Count of y below each x plus half the ties gives U of x
+        u1 = np.sum(counts[i] * (below[j] + 0.5 * counts[j]), axis=1)
+        ties = counts[i] + counts[j]
+        n1, n2 = n[i], n[j]
+        n12 = n1 + n2
+        u = np.maximum(u1, n1 * n2 - u1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tie_term = np.sum(ties ** 3 - ties, axis=1) / (n12 * (n12 - 1))
+            sd = np.sqrt(n1 * n2 / 12 * ((n12 + 1) - tie_term))
+            z = np.where(sd > 0, (u - n1 * n2 / 2 - 0.5) / sd, np.where(u > n1 * n2 / 2, np.inf, 0))
+        pvalues = np.minimum(1.0, 2 * stats.norm.sf(z))
+        exact = (np.minimum(n1, n2) <= 8) & ~np.any(ties > 1, axis=1)
+        for k in np.where(exact)[0]:
+            pvalues[k] = stats.mannwhitneyu(groups[i[k]], groups[j[k]], alternative='two-sided',
+                                            method='exact').pvalue
+        results[start: start + chunk_size, 0] = u1
+        results[start: start + chunk_size, 1] = pvalues
+    return results
+
 
+def wilcoxon_pairs(groups: list, pairs: list) -> np.array:
     """
+    Wilcoxon signed rank test for each pair of (paired, equal length) groups. Pairs of the same length are stacked
+    and tested in one call.
+    :param groups: list of np.arrays in the paired order
+    :param pairs: list of (i, j) indexes into the groups
+    :return: np.array (len(pairs) x 2) of statistic and p value
+    """
+    results = np.zeros((len(pairs), 2))
+    by_length = {}
+    for p_i, (i, j) in enumerate(pairs):
+        by_length.setdefault(len(groups[i]), []).append(p_i)
+    for p_idxs in by_length.values():
+        diffs = np.array([groups[pairs[p_i][0]] - groups[pairs[p_i][1]] for p_i in p_idxs])
+        res = stats.wilcoxon(diffs, axis=1)
+        results[p_idxs, 0] = res.statistic
+        results[p_idxs, 1] = res.pvalue
+    return results
 
-    #font.serif      : DejaVu Serif, Bitstream Vera Serif, Computer Modern Roman,
-    New Century Schoolbook, Century Schoolbook L, Utopia, ITC Bookman, Bookman, Nimbus Roman No9 L,
-    Times New Roman, Times, Palatino, Charter, serif
-#font.sans-serif : DejaVu Sans, Bitstream Vera Sans, Computer Modern Sans Serif,
 
- Lucida Grande, Verdana, Geneva, Lucid, Arial, Helvetica, Avant Garde, sans-serif
+class PairwiseStats:
 
     """
+    Computes pairwise tests between the groups of a long format dataframe in one batched pass. The per group value
+    counts, means and variances are computed once and shared by all the pairs. The t-tests and Mann-Whitney tests
+    are vectorised across all the pairs, the rank tests can optionally be split over a process pool.
+    If hue is given the groups are the (x, hue) combinations and the pairs must name them as (x, hue) tuples.
+    """
+
+    def __init__(self, df: pd.DataFrame, x: str, y: str, hue=None, sciutil=None):
+        self.u = SciUtil() if sciutil is None else sciutil
+        self.group_names = []
+        self.groups = []
+        for name, values in df.groupby(x if hue is None else [x, hue], sort=False, observed=True)[y]:
+            self.group_names.append(name)
+            self.groups.append(values.values.astype(float))
+        self.index = {name: i for i, name in enumerate(self.group_names)}
+        self.counts = None
+        self.n = np.array([len(g) for g in self.groups], dtype=float)
+        self.means = np.array([np.mean(g) if len(g) else np.nan for g in self.groups])
+        self.vars = np.array([np.var(g, ddof=1) if len(g) > 1 else np.nan for g in self.groups])
+
+    def t_test_pairs(self, pairs: list, equal_var=True) -> np.array:
+        """ Independent (Student's or Welch's) t-test for all pairs at once from the cached means and variances. """
+        i, j = np.array(pairs, dtype=int).reshape(-1, 2).T
+        n1, n2, v1, v2 = self.n[i], self.n[j], self.vars[i], self.vars[j]
+        if equal_var:
+            dof = n1 + n2 - 2
+            pooled = ((n1 - 1) * v1 + (n2 - 1) * v2) / dof
+            se = np.sqrt(pooled * (1 / n1 + 1 / n2))
+        else:
+            vn1, vn2 = v1 / n1, v2 / n2
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dof = (vn1 + vn2) ** 2 / (vn1 ** 2 / (n1 - 1) + vn2 ** 2 / (n2 - 1))
+            se = np.sqrt(vn1 + vn2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (self.means[i] - self.means[j]) / se
+        return np.stack([t, 2 * stats.t.sf(np.abs(t), dof)], axis=1)
+
+    def get_counts(self) -> np.array:
+        """ Ranks the pooled groups once: (groups x unique values) counts of each value in each group. """
+        if self.counts is None:
+            _, value_idx = np.unique(np.concatenate(self.groups), return_inverse=True)
+            num_values = int(value_idx.max()) + 1 if len(value_idx) else 0
+            group_idx = np.repeat(np.arange(len(self.groups)), self.n.astype(int))
+            self.counts = np.bincount(group_idx * num_values + value_idx.ravel(),
+                                      minlength=len(self.groups) * num_values).reshape(len(self.groups), num_values)
+            self.counts = self.counts.astype(float)
+        return self.counts
+
+    def paired_t_test_pairs(self, pairs: list) -> np.array:
+        """ Paired t-test for each pair, pairs of the same length are stacked and tested in one call. """
+        results = np.zeros((len(pairs), 2))
+        by_length = {}
+        for p_i, (i, j) in enumerate(pairs):
+            by_length.setdefault(len(self.groups[i]), []).append(p_i)
+        for p_idxs in by_length.values():
+            a = np.array([self.groups[pairs[p_i][0]] for p_i in p_idxs])
+            b = np.array([self.groups[pairs[p_i][1]] for p_i in p_idxs])
+            res = stats.ttest_rel(a, b, axis=1)
+            results[p_idxs, 0] = res.statistic
+            results[p_idxs, 1] = res.pvalue
+        return results
 
-    def __init__(self):
-        pass
+    def test(self, pairs: list, test='Mann-Whitney', n_jobs=1) -> pd.DataFrame:
+        """
+        Runs the test on each pair of groups.
+        :param pairs: list of (group1, group2) tuples of group names, groups are (x, hue) tuples if hue was given
+        :param test: one of PAIRWISE_TESTS
+        :param n_jobs: number of processes to split the rank tests over
+        :return: dataframe with group1, group2, test, statistic and pvalue columns (one row per pair)
+        """
+        # (x, hue) groups may be given as lists
+        pairs = [tuple(tuple(g) if isinstance(g, list) else g for g in pair) for pair in pairs]
+        idx_pairs = []
+        for g1, g2 in pairs:
+            for g in [g1, g2]:
+                if g not in self.index:
+                    msg = self.u.msg.msg_arg_err("PairwiseStats.test", "pairs", g,
+                                                 [str(name) for name in self.group_names])
+                    self.u.err_p([msg])
+                    raise VisException(msg)
+            idx_pairs.append((self.index[g1], self.index[g2]))
+        if test == 't-test_ind':
+            results = self.t_test_pairs(idx_pairs, equal_var=True)
+        elif test == 't-test_welch':
+            results = self.t_test_pairs(idx_pairs, equal_var=False)
+        elif test == 't-test_paired':
+            results = self.paired_t_test_pairs(idx_pairs)
+        elif test in ['Mann-Whitney', 'Wilcoxon']:
+            if test == 'Mann-Whitney':
+                func, args = mann_whitney_pairs, (self.groups, self.get_counts())
+            else:
+                func, args = wilcoxon_pairs, (self.groups, )
+            if n_jobs > 1 and len(idx_pairs) > 1:
+                chunks = [idx_pairs[c::n_jobs] for c in range(n_jobs) if idx_pairs[c::n_jobs]]
+                with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                    chunk_results = list(executor.map(func, *zip(*[args + (chunk, ) for chunk in chunks])))
+                results = np.zeros((len(idx_pairs), 2))
+                for c, chunk_result in enumerate(chunk_results):
+                    results[c::n_jobs] = chunk_result
+            else:
+                results = func(*args, idx_pairs)
+        else:
+            msg = self.u.msg.msg_arg_err("PairwiseStats.test", "test", test, PAIRWISE_TESTS)
+            self.u.err_p([msg])
+            raise VisException(msg)
+        stats_df = pd.DataFrame()
+        stats_df['group1'] = [p[0] for p in pairs]
+        stats_df['group2'] = [p[1] for p in pairs]
+        stats_df['test'] = test
+        stats_df['statistic'] = results[:, 0] if len(pairs) else []
+        stats_df['pvalue'] = results[:, 1] if len(pairs) else []
+        return stats_df
 
-    def perform_stats(self):
-        print(None)
 
-    def get_assumptions(self, stat_name: str):
-        references = ['[1] https://www.ncbi.nlm.nih.gov/pmc/articles/PMC2996580/', '[2] https://docs.scipy.org/doc/scipy/reference/stats.html#statistical-tests']
+def adjust_pvalues(pvalues: np.array, method='fdr_bh') -> np.array:
+    """
+    Multiple testing correction, NaN p values are ignored (and stay NaN).
+    :param pvalues: np.array of p values
+    :param method: 'fdr_bh' (Benjamini-Hochberg), 'bonferroni' or None (no correction)
+    :return: np.array of adjusted p values
+    """
+    pvalues = np.asarray(pvalues, dtype=float)
+    padj = np.full(len(pvalues), np.nan)
+    tested = ~np.isnan(pvalues)
+    p = pvalues[tested]
+    if method is None:
+        padj[tested] = p
+    elif method == 'bonferroni':
+        padj[tested] = np.minimum(p * len(p), 1.0)
+    elif method == 'fdr_bh':
+        order = np.argsort(p)
+        ranked = p[order] * len(p) / np.arange(1, len(p) + 1)
+        # Enforce monotonicity from the largest p value down
+        ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+        adjusted = np.empty(len(p))
+        adjusted[order] = np.minimum(ranked, 1.0)
+        padj[tested] = adjusted
+    else:
+        raise VisException(f'adjust_pvalues: method was {method}, it must be one of: fdr_bh, bonferroni, None')
+    return padj
+
+
+class Stats:
+
+    """
+    Chooses and runs a statistical test for each feature (row) of a dataframe, comparing groups of sample columns.
+    The assumptions in assumption_dict (normality, equal variance, minimum sample size, pairing and number of groups)
+    are checked for every feature at once and each test is run once over all the features it was chosen for using
+    scipy's axis-wise tests, so there is no loop over features in Python.
+
+    References:
+    [1] https://www.ncbi.nlm.nih.gov/pmc/articles/PMC2996580/
+    [2] https://docs.scipy.org/doc/scipy/reference/stats.html#statistical-tests
+    """
 
-    def output_assumptions(self, test_name: str):
+    # Order in which the tests are tried when the test is chosen from the data, the first whose assumptions are met
+    # is used i.e. parametric before non-parametric and two group tests before the multi group tests.
+    test_preference = ['ttest_ind', 'ttest_rel', 'ttest_welch', 'anova', 'mannwhitneyu', 'wilcoxon', 'kruskal']
+    # tukeyhsd (in assumption_dict) is a post hoc test giving a p value per pair of groups rather than one per
+    # feature, so it isn't run here, use PairwiseStats to compare the groups pairwise.
+    supported_tests = test_preference + ['levene', 'ttest_1samp']
+
+    def __init__(self, df: pd.DataFrame, groups: dict, paired=False, alpha=0.05, correction='fdr_bh',
+                 alternative='two-sided', popmean=0, sciutil=None):
+        """
+        :param df: dataframe with a row per feature (e.g. gene) and a column per sample
+        :param groups: dict of group name: list of the sample columns in that group (in the paired order if paired)
+        :param paired: whether the samples in the groups are paired
+        :param alpha: significance level used for the normality and equal variance checks
+        :param correction: multiple testing correction, 'fdr_bh', 'bonferroni' or None
+        :param alternative: 'two-sided', 'less' or 'greater' for the tests that support it
+        :param popmean: expected mean for ttest_1samp
+        """
+        self.u = SciUtil() if sciutil is None else sciutil
+        self.df = df
+        self.groups = groups
+        self.paired = paired
+        self.alpha = alpha
+        self.correction = correction
+        self.alternative = alternative
+        self.popmean = popmean
+        for name, columns in groups.items():
+            for c in columns:
+                if c not in df.columns:
+                    msg = self.u.msg.msg_arg_err("Stats", "groups", c, list(df.columns))
+                    self.u.err_p([msg])
+                    raise VisException(msg)
+
+    def get_group_values(self, rows=None) -> list:
+        """ List of np.arrays (features x samples), one per group, optionally only for a slice of the rows. """
+        df = self.df if rows is None else self.df.iloc[rows]
+        return [df[columns].values.astype(float) for columns in self.groups.values()]
+
+    @staticmethod
+    def run_by_nan(func, group_values: list) -> tuple:
+        """
+        Runs a scipy test on the features without NaNs with nan_policy='propagate' (vectorised over the rows) and only
+        the features with NaNs with nan_policy='omit' (which scipy runs one row at a time).
+        :param func: function(group_values, nan_policy) returning a scipy result with statistic and pvalue
+        :param group_values: list of np.arrays (features x samples), one per group
+        :return: statistic, pvalue np.arrays
+        """
+        has_nan = np.zeros(len(group_values[0]), dtype=bool)
+        for g in group_values:
+            has_nan |= np.isnan(g).any(axis=1)
+        statistic = np.full(len(has_nan), np.nan)
+        pvalue = np.full(len(has_nan), np.nan)
+        for rows, nan_policy in [(~has_nan, 'propagate'), (has_nan, 'omit')]:
+            if rows.any():
+                res = func([g[rows] for g in group_values], nan_policy)
+                statistic[rows] = np.asarray(res.statistic, dtype=float)
+                pvalue[rows] = np.asarray(res.pvalue, dtype=float)
+        return statistic, pvalue
+
+    def check_assumptions(self, group_values: list) -> pd.DataFrame:
+        """
+        Checks the assumptions for every feature at once.
+        :param group_values: list of np.arrays (features x samples), one per group
+        :return: dataframe with a row per feature: normality (every group passes a Shapiro-Wilk test, or
+        D'Agostino-Pearson for groups of 20 or more), equal-variance (Levene's test) and min_sample_size (the
+        smallest number of non-NaN values in a group)
+        """
+        num_features = len(group_values[0])
+        sizes = np.array([np.sum(~np.isnan(g), axis=1) for g in group_values])
+        normality = np.ones(num_features, dtype=bool)
+        for g in group_values:
+            if g.shape[1] < 3:
+                normality[:] = False
+                continue
+            test = stats.normaltest if g.shape[1] >= 20 else stats.shapiro
+            with np.errstate(all='ignore'):
+                _, pvalues = self.run_by_nan(lambda values, nan_policy: test(values[0], axis=1, nan_policy=nan_policy),
+                                             [g])
+            # Constant features can't be tested for normality (shapiro gives them p = 1), treat them as not normal
+            # so they go to a rank test rather than getting a NaN p value from a t-test
+            constant = np.fmax.reduce(g, axis=1) == np.fmin.reduce(g, axis=1)
+            normality &= (np.nan_to_num(pvalues, nan=0) > self.alpha) & ~constant
+        if len(group_values) > 1 and np.min(sizes) >= 2:
+            with np.errstate(all='ignore'):
+                _, pvalues = self.run_by_nan(
+                    lambda values, nan_policy: stats.levene(*values, axis=1, nan_policy=nan_policy), group_values)
+            equal_variance = np.nan_to_num(pvalues, nan=1) > self.alpha
+        else:
+            equal_variance = np.zeros(num_features, dtype=bool)
+        assumptions = pd.DataFrame()
+        assumptions['normality'] = normality
+        assumptions['equal-variance'] = equal_variance
+        assumptions['min_sample_size'] = np.min(sizes, axis=0)
+        return assumptions
+
+    def choose_tests(self, assumptions: pd.DataFrame) -> np.array:
+        """
+        Picks the first test in test_preference whose assumptions (see assumption_dict) are met by each feature.
+        :param assumptions: output of check_assumptions
+        :return: np.array of test names, None where no test's assumptions are met
+        """
+        chosen = np.full(len(assumptions), None, dtype=object)
+        num_groups = len(self.groups)
+        for test in self.test_preference:
+            required = self.get_assumptions(test)
+            if required.get('paired') is not None and required['paired'] != self.paired:
+                continue
+            if required.get('num_groups') is not None and required['num_groups'] != num_groups:
+                continue
+            if required.get('num_groups') is None and num_groups < 2:
+                continue
+            ok = assumptions['min_sample_size'].values >= required.get('min_sample_size', 0)
+            if required.get('normality'):
+                ok &= assumptions['normality'].values
+            if required.get('equal-variance'):
+                ok &= assumptions['equal-variance'].values
+            chosen[ok & (chosen == None)] = test  # noqa: E711 element-wise comparison
+        return chosen
+
+    def run_test(self, test: str, group_values: list) -> tuple:
+        """
+        Runs one test across all the features (rows) of the group values at once.
+        :return: statistic, pvalue np.arrays
+        """
+        num_groups = len(group_values)
+        two_group_tests = ['ttest_ind', 'ttest_welch', 'ttest_rel', 'mannwhitneyu', 'wilcoxon']
+        if (test in two_group_tests and num_groups != 2) or (test == 'ttest_1samp' and num_groups != 1):
+            msg = self.u.msg.msg_arg_err("run_test", "groups", num_groups,
+                                         [self.get_assumptions(test).get('num_groups')])
+            self.u.err_p([msg, f'{test} needs a different number of groups.'])
+            raise VisException(msg)
+        if test not in self.supported_tests:
+            msg = self.u.msg.msg_arg_err("run_test", "test", test, self.supported_tests)
+            self.u.err_p([msg])
+            raise VisException(msg)
+
+        def run(values, nan_policy):
+            kwargs = dict(axis=1, nan_policy=nan_policy)
+            if test == 'ttest_ind':
+                return stats.ttest_ind(*values, alternative=self.alternative, **kwargs)
+            if test == 'ttest_welch':
+                return stats.ttest_ind(*values, equal_var=False, alternative=self.alternative, **kwargs)
+            if test == 'ttest_rel':
+                return stats.ttest_rel(*values, alternative=self.alternative, **kwargs)
+            if test == 'ttest_1samp':
+                return stats.ttest_1samp(values[0], self.popmean, alternative=self.alternative, **kwargs)
+            if test == 'mannwhitneyu':
+                return stats.mannwhitneyu(*values, alternative=self.alternative, **kwargs)
+            if test == 'wilcoxon':
+                return stats.wilcoxon(*values, alternative=self.alternative, **kwargs)
+            if test == 'anova':
+                return stats.f_oneway(*values, **kwargs)
+            if test == 'kruskal':
+                return stats.kruskal(*values, **kwargs)
+            return stats.levene(*values, **kwargs)
+
+        with np.errstate(all='ignore'):
+            return self.run_by_nan(run, group_values)
+
+    def test_features(self, test=None, rows=None) -> pd.DataFrame:
+        """
+        Checks the assumptions, chooses the test (unless one is given) and runs it for the features (without
+        multiple testing correction).
+        :param test: name of the test to run on every feature, None to choose it from the data for each feature
+        :param rows: optional slice or array of row positions to test, default is every row
+        :return: dataframe indexed like the features with test, statistic, pvalue and the assumption columns
+        """
+        group_values = self.get_group_values(rows)
+        assumptions = self.check_assumptions(group_values)
+        assumptions.index = self.df.index if rows is None else self.df.index[rows]
+        tests = self.choose_tests(assumptions) if test is None else np.full(len(assumptions), test, dtype=object)
+        statistic = np.full(len(assumptions), np.nan)
+        pvalue = np.full(len(assumptions), np.nan)
+        for t in pd.unique(tests[tests != None]):  # noqa: E711 element-wise comparison
+            idxs = np.where(tests == t)[0]
+            statistic[idxs], pvalue[idxs] = self.run_test(t, [g[idxs] for g in group_values])
+        results = pd.DataFrame(index=assumptions.index)
+        results['test'] = tests
+        results['statistic'] = statistic
+        results['pvalue'] = pvalue
+        for c in assumptions.columns:
+            results[c] = assumptions[c].values
+        return results
+
+    def perform_stats(self, test=None) -> pd.DataFrame:
+        """
+        Tests every feature and corrects for multiple testing.
+        :param test: name of the test to run on every feature, None to choose it from the data for each feature
+        :return: dataframe indexed like the features with test, statistic, pvalue, padj, normality, equal-variance
+        and min_sample_size columns
+        """
+        results = self.test_features(test)
+        untested = np.sum(results['test'].isnull())
+        if untested:
+            self.u.warn_p([f'No test had its assumptions met for {untested} features, e.g. too few samples. '
+                           f'These have a NaN p value.'])
+        results.insert(3, 'padj', adjust_pvalues(results['pvalue'].values, self.correction))
+        return results
+
+    def get_assumptions(self, stat_name: str) -> dict:
+        """ The assumptions of a test, see assumption_dict. """
+        if stat_name not in assumption_dict:
+            msg = self.u.msg.msg_arg_err("get_assumptions", "stat_name", stat_name, list(assumption_dict.keys()))
+            self.u.err_p([msg])
+            raise VisException(msg)
+        return assumption_dict[stat_name]['Assumptions']
+
+    def output_assumptions(self, test_name: str) -> list:
+        """ Prints and returns the description and assumptions of a test. """
         # assumption rows: https://www.ncbi.nlm.nih.gov/pmc/articles/PMC2996580/
-        assumptions = [f'Assumptions:']
+        test = assumption_dict[test_name]
+        lines = [test.get('Name', test_name), test.get('Short', ''), test.get('Null Hypothesis', ''),
+                 'Assumptions:']
+        lines += [f'\t{k}: {v}' for k, v in self.get_assumptions(test_name).items()]
+        lines += test.get('Notes', [])
+        lines += [test.get('Link', '')]
+        self.u.dp(lines)
+        return lines
+
+    def get_written_features(self, path: str, file_format: str) -> set:
+        """
+        Features that already have results in the output, so an interrupted run can carry on where it stopped.
+        A CSV line that was only partly written when the run was interrupted is removed.
+        """
+        if file_format == 'csv':
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                return set()
+            with open(path, 'rb+') as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                f.seek(max(0, size - 1))
+                if f.read(1) != b'\n':
+                    # Truncate back to the end of the last complete line, reading back from the end a block at a time
+                    end = size
+                    while end > 0:
+                        start = max(0, end - 65536)
+                        f.seek(start)
+                        newline = f.read(end - start).rfind(b'\n')
+                        if newline >= 0:
+                            break
+                        end = start
+                    f.truncate(start + newline + 1 if end > 0 else 0)
+            if os.path.getsize(path) == 0:
+                return set()
+            return set(pd.read_csv(path, usecols=['feature'], dtype={'feature': str})['feature'].values)
+        if not os.path.isdir(path):
+            return set()
+        features = set()
+        for part in self.get_parts(path):
+            features.update(pd.read_parquet(part, columns=['feature'])['feature'].astype(str).values)
+        return features
+
+    @staticmethod
+    def get_parts(path: str) -> list:
+        """ Parquet part files in the output directory, in the order they were written. """
+        return [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.parquet')]
+
+    def write_chunk(self, results: pd.DataFrame, path: str, file_format: str) -> None:
+        """ Appends a chunk of results to the CSV, or writes it as the next part of the parquet directory. """
+        if file_format == 'csv':
+            write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+            results.to_csv(path, mode='a', header=write_header, index=False)
+        else:
+            os.makedirs(path, exist_ok=True)
+            part = os.path.join(path, f'part-{len(self.get_parts(path)):05d}.parquet')
+            # Write to a temporary file first so an interruption never leaves a partial part behind
+            results.to_parquet(part + '.tmp', index=False)
+            os.replace(part + '.tmp', part)
+
+    def write_padj(self, path: str, file_format: str, chunk_size: int) -> None:
+        """
+        Fills in the adjusted p values once every feature has been tested, only the p values are held in memory and
+        the file is rewritten chunk by chunk.
+        """
+        if file_format == 'csv':
+            pvalues = np.concatenate([c['pvalue'].values for c in
+                                      pd.read_csv(path, usecols=['pvalue'], chunksize=chunk_size)])
+            padj = adjust_pvalues(pvalues, self.correction)
+            tmp_path = path + '.tmp'
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            offset = 0
+            for chunk in pd.read_csv(path, chunksize=chunk_size, dtype={'feature': str}):
+                chunk['padj'] = padj[offset: offset + len(chunk)]
+                offset += len(chunk)
+                chunk.to_csv(tmp_path, mode='a', header=not os.path.exists(tmp_path), index=False)
+            os.replace(tmp_path, path)
+        else:
+            parts = self.get_parts(path)
+            pvalues = [pd.read_parquet(part, columns=['pvalue'])['pvalue'].values for part in parts]
+            padj = adjust_pvalues(np.concatenate(pvalues), self.correction)
+            offset = 0
+            for part, part_pvalues in zip(parts, pvalues):
+                chunk = pd.read_parquet(part)
+                chunk['padj'] = padj[offset: offset + len(part_pvalues)]
+                offset += len(part_pvalues)
+                chunk.to_parquet(part + '.tmp', index=False)
+                os.replace(part + '.tmp', part)
 
-    def write_stats_file(self):
-        print(None)
\ No newline at end of file
+    def write_stats_file(self, path: str, test=None, chunk_size=10000, file_format=None, overwrite=False) -> str:
+        """
+        Tests the features chunk by chunk, writing each chunk's results as soon as they are computed so genome
+        scale runs don't hold every result in memory. If the output already exists (and overwrite is False) the
+        features already in it are skipped, so an interrupted run can be resumed and new features can be appended
+        to an existing file. The adjusted p values are computed across everything in the file at the end.
+        :param path: output CSV file, or directory of parquet part files when file_format is 'parquet'
+        :param test: name of the test to run on every feature, None to choose it from the data for each feature
+        :param chunk_size: number of features to test and write at a time
+        :param file_format: 'csv' or 'parquet', default is parquet if path ends in .parquet otherwise csv
+        :param overwrite: remove any existing output and start again
+        :return: path
+        """
+        if file_format is None:
+            file_format = 'parquet' if path.endswith('.parquet') else 'csv'
+        if file_format not in ['csv', 'parquet']:
+            msg = self.u.msg.msg_arg_err("write_stats_file", "file_format", file_format, ['csv', 'parquet'])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        if file_format == 'parquet':
+            try:
+                pd.io.parquet.get_engine('auto')
+            except ImportError:
+                msg = 'write_stats_file: writing parquet needs pyarrow or fastparquet installed, or use csv.'
+                self.u.err_p([msg])
+                raise VisException(msg)
+        if overwrite and os.path.isdir(path):
+            for part in self.get_parts(path):
+                os.remove(part)
+        elif overwrite and os.path.exists(path):
+            os.remove(path)
+        written = self.get_written_features(path, file_format)
+        if written:
+            self.u.warn_p([f'{path} already has results for {len(written)} features, these are skipped.'])
+        todo = np.where(~self.df.index.astype(str).isin(written))[0]
+        for start in range(0, len(todo), chunk_size):
+            results = self.test_features(test, todo[start: start + chunk_size])
+            results.insert(3, 'padj', np.nan)
+            results.index.name = 'feature'
+            results = results.reset_index()
+            results['feature'] = results['feature'].astype(str)
+            self.write_chunk(results, path, file_format)
+        if (file_format == 'csv' and not os.path.exists(path)) or \
+                (file_format == 'parquet' and not os.path.isdir(path)):
+            self.u.warn_p(['No features to write to: ', path])
+            return path
+        self.write_padj(path, file_format, chunk_size)
+        return path
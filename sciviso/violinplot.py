@@ -18,15 +18,16 @@
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
+from itertools import combinations
 
-from statannot import add_stat_annotation
 from sciviso import Vis
+from sciviso.stats import PairwiseStats
 
 class Violinplot(Vis):
 
     def __init__(self, df: pd.DataFrame, x: object, y: object, title='', xlabel='', ylabel='', hue=None, order=None,
                  hue_order=None, showfliers=False, add_dots=False, add_stats=False, stat_method='Mann-Whitney',
-                 figsize=(3, 3), box_pairs=None, config=None):
+                 figsize=(3, 3), box_pairs=None, config=None, stat_n_jobs=1):
         super().__init__(df, figsize=figsize)
         self.df = df
         self.x = x
@@ -42,6 +43,8 @@ class Violinplot(Vis):
         self.add_stats = add_stats
         self.stat_method = stat_method
         self.box_pairs = box_pairs
+        self.stat_n_jobs = stat_n_jobs
+        self.stats_df = None
         if config:
             self.load_style(config)
 
@@ -75,24 +78,17 @@ class Violinplot(Vis):
             ax = sns.stripplot(data=vis_df, x=x, y=y, hue_order=hue_order, order=order, alpha=0.9, s=1, color='.2')
         if self.add_stats:
             # Add all pairs in the order if the box pairs is none
-
-            pairs = []
-            if box_pairs is None:
-                box_pairs = []
-                for i in order:
-                    for j in order:
-                        if i != j:
-                            # Ensure we don't get duplicates
-                            pair = f'{i}{j}' if i < j else f'{j}{i}'
-                            if pair not in pairs:
-                                box_pairs.append((i, j))
-                                pairs.append(pair)
+            if box_pairs is None and hue is None:
+                box_pairs = list(combinations(order, 2))
+            elif box_pairs is None:
+                # Compare the hue groups within each x group
+                box_pairs = [((o, h1), (o, h2)) for o in order for h1, h2 in combinations(hue_order, 2)]
             # Add stats annotation
-
-            add_stat_annotation(ax, data=vis_df, x=x, y=y, order=order,
-                                box_pairs=box_pairs,
-                                test=self.stat_method, text_format='star', loc='inside', verbose=2,
-                                pvalue_thresholds=[[1e-4, "****"], [1e-3, "***"], [1e-2, "**"], [0.05, "*"]])
+            pairwise = PairwiseStats(vis_df, x, y, hue=hue, sciutil=self.u)
+            self.stats_df = pairwise.test(box_pairs, self.stat_method, n_jobs=self.stat_n_jobs)
+            self.add_stat_annotation(ax, vis_df, x, y, order, self.stats_df, hue=hue, hue_order=hue_order,
+                                     pvalue_thresholds=[[1e-4, "****"], [1e-3, "***"], [1e-2, "**"], [0.05, "*"],
+                                                        [1, "ns"]])
         ax.set_xticklabels(ax.get_xticklabels(), rotation=45, horizontalalignment='right')
         ax.tick_params(labelsize=self.label_font_size)
         plt.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0., fontsize=self.label_font_size)
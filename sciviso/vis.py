@@ -17,6 +17,7 @@
 
 import io
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import seaborn as sns
 from matplotlib.colors import ListedColormap
@@ -209,7 +210,8 @@ class Vis:
 
     def save_svg(self, label_lst: list) -> None:
         label = self.u.generate_label(label_lst, '.svg')
-        plt.savefig(label)
+        # dpi only affects rasterized artists (e.g. large scatter plots), everything else stays vector
+        plt.savefig(label, dpi=self.dpi)
 
     def save_png(self, label_lst: list) -> None:
         label = self.u.generate_label(label_lst, '.png')
@@ -303,6 +305,64 @@ class Vis:
     def plot(self):
         self.u.warn_p(["Please initiate one of the charts. Vis is just a wrapper. See docs for more info."])
 
+    def add_stat_annotation(self, ax, vis_df: pd.DataFrame, x: str, y: str, order: list, stats_df: pd.DataFrame,
+                            pvalue_thresholds=None, hue=None, hue_order=None, width=0.8):
+        """
+        Draws a bracket and star for each pair of groups in stats_df (see stats.PairwiseStats) above a categorical
+        plot. Brackets spanning fewer groups are drawn first so the wider ones stack above them.
+        Parameters
+        ----------
+        ax:                 axis with the categorical plot, groups are at x positions 0, 1, ... in the order
+        vis_df:             long format dataframe that was plotted
+        x:                  group column
+        y:                  value column
+        order:              order of the groups along the x axis
+        stats_df:           dataframe with group1, group2 and pvalue columns
+        pvalue_thresholds:  list of [threshold, text], the first threshold the p value is less than or equal to is used
+        hue:                hue column, if given the groups in stats_df are (x, hue) tuples
+        hue_order:          order of the hue groups within each x group
+        width:              width the hue groups are dodged over (seaborn's default)
+
+        Returns
+        -------
+        ax
+        """
+        if pvalue_thresholds is None:
+            pvalue_thresholds = [[1e-4, "****"], [1e-3, "***"], [1e-2, "**"], [0.05, "*"], [1, "ns"]]
+        if hue is None:
+            groups = list(order)
+            centres = np.arange(len(order), dtype=float)
+            group_max = vis_df.groupby(x, observed=True)[y].max()
+        else:
+            groups = [(o, h) for o in order for h in hue_order]
+            # Seaborn dodges the hue groups evenly over the width of each x group
+            centres = np.array([i - width / 2 + width * (j + 0.5) / len(hue_order)
+                                for i in range(len(order)) for j in range(len(hue_order))])
+            group_max = vis_df.groupby([x, hue], observed=True)[y].max()
+        positions = {g: i for i, g in enumerate(groups)}
+        tops = np.array([group_max.get(g, np.nan) for g in groups], dtype=float)
+        y_min, y_max = ax.get_ylim()
+        offset = 0.05 * (y_max - y_min)
+        bracket_height = 0.02 * (y_max - y_min)
+        spans = []
+        for g1, g2, p in zip(stats_df['group1'], stats_df['group2'], stats_df['pvalue']):
+            if g1 in positions and g2 in positions:
+                i, j = sorted([positions[g1], positions[g2]])
+                spans.append((j - i, i, j, p))
+        for _, i, j, p in sorted(spans, key=lambda span: span[:3]):
+            level = np.nanmax(tops[i: j + 1]) + offset
+            text = next((t for threshold, t in pvalue_thresholds if p <= threshold), '')
+            ax.plot([centres[i], centres[i], centres[j], centres[j]],
+                    [level, level + bracket_height, level + bracket_height, level],
+                    lw=self.axis_line_width * 2, c='black')
+            ax.text((centres[i] + centres[j]) / 2, level + bracket_height, text, ha='center', va='bottom',
+                    fontsize=self.label_font_size)
+            # Leave room for the text before the next bracket over these groups
+            tops[i: j + 1] = level + bracket_height + offset
+        if spans:
+            ax.set_ylim(y_min, max(y_max, np.nanmax(tops) + offset))
+        return ax
+
     def set_ax_params(self, ax):
         ax.tick_params(direction='out', length=2, width=self.axis_line_width)
         ax.spines['bottom'].set_linewidth(self.axis_line_width)
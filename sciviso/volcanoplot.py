@@ -15,12 +15,25 @@
 #                                                                             #
 ###############################################################################
 
+import os
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-from adjustText import adjust_text
 
-from sciviso import Vis
+from matplotlib.colors import to_rgba_array
+
+from sciviso import Vis, VisException
+
+# Point categories, the index in this list is the code given by Volcanoplot.classify
+CATEGORIES = ['ns_small-neg-logFC', 'ns_small-pos-logFC', 'ns_big-neg-logFC', 'ns_big-pos-logFC',
+              'sig_small-neg-logFC', 'sig_small-pos-logFC', 'sig_big-neg-logFC', 'sig_big-pos-logFC']
+
+# Where a label can go relative to its point, in points: (dx, dy, horizontal alignment, vertical alignment). Tried in
+# order, the further ring is only used (with a line back to the point) when the close positions are taken.
+LABEL_POSITIONS = [(0, 8, 'center', 'bottom'), (6, 4, 'left', 'bottom'), (-6, 4, 'right', 'bottom'),
+                   (6, -4, 'left', 'top'), (-6, -4, 'right', 'top'), (0, -8, 'center', 'top'),
+                   (0, 24, 'center', 'bottom'), (20, 14, 'left', 'bottom'), (-20, 14, 'right', 'bottom'),
+                   (20, -14, 'left', 'top'), (-20, -14, 'right', 'top'), (0, -24, 'center', 'top')]
 
 
 class Volcanoplot(Vis):
@@ -28,7 +41,12 @@ class Volcanoplot(Vis):
     def __init__(self, df: pd.DataFrame, log_fc: str, p_val: str, label_column: str, title='',
                  xlabel='', ylabel='', invert=False, p_val_cutoff=0.05, log_fc_cuttoff=2, label_big_sig=False,
                  colours=None, offset=None, text_colours={}, values_to_label=None, max_labels=20, values_colours={},
-                 figsize=(3, 3), config={}):
+                 figsize=(3, 3), config={}, label_method='grid', label_budget=None):
+        """
+        label_method: 'grid' places all the labels in one pass over an occupancy grid so they don't overlap, labels that
+        don't fit are dropped; 'adjust_text' uses adjustText for each group of points (slow for many labels).
+        label_budget: maximum number of labels across the whole plot (the most significant are kept), None for no limit.
+        """
         super().__init__(df, figsize=figsize)
         self.log_fc = config.get("log_fc") if config.get("log_fc") else log_fc
         self.p_val = config.get("p_val") if config.get("p_val") else p_val
@@ -56,95 +74,322 @@ class Volcanoplot(Vis):
         self.max_labels = config.get("max_labels") if config.get("max_labels") else max_labels
         self.values_colours = config.get("values_colours") if config.get("values_colours") else values_colours
         self.text_colours = config.get("text_colours") if config.get("text_colours") else text_colours
+        self.label_method = config.get("label_method") if config.get("label_method") else label_method
+        self.label_budget = config.get("label_budget") if config.get("label_budget") else label_budget
+        self.s = 10
+        # Labels to draw, and the category of each point (index into CATEGORIES), both set by plot
+        self.labels_to_place = []
+        self.category_codes = None
+        # Category codes of each contrast drawn by plot_contrasts
+        self.contrast_codes = {}
         if config:
             self.load_style(config)
 
-    def add_scatter_and_annotate(self, fig: plt, x_all: np.array, y_all: np.array,
-                                 colour: str, idxs: np.array, annotate=False):
-        x = x_all[idxs]
-        y = y_all[idxs]
-        ax = fig.scatter(x, y, c=colour, alpha=self.opacity, s=self.s)
+    def classify(self) -> np.array:
+        """
+        Classifies every point once into an index of CATEGORIES: 4 * significant + 2 * big logFC + positive logFC.
+        The codes are kept on self.category_codes so the groups can be used after plotting (see get_categories).
+        Returns
+        -------
+        np.array of int8 category codes, one per row of the dataframe
+        """
+        log_fc = self.df[self.log_fc].values
+        p_val = self.df[self.p_val].values
+        codes = 4 * (p_val <= self.p_val_cutoff) + 2 * (np.abs(log_fc) >= self.log_fc_cuttoff) + (log_fc > 0)
+        self.category_codes = codes.astype(np.int8)
+        return self.category_codes
 
-        # Check if we want to annotate any of these with their gene IDs
+    def get_categories(self) -> pd.Series:
+        """
+        Category of each row as a categorical series (with the dataframe's index), e.g. to get the significant genes:
+        df[volcanoplot.get_categories().str.startswith('sig')]
+        """
+        if self.category_codes is None:
+            self.classify()
+        return pd.Series(pd.Categorical.from_codes(self.category_codes, CATEGORIES), index=self.df.index,
+                         name='category')
 
+    def get_labels(self, x: np.array, y: np.array, codes: np.array) -> list:
+        """
+        Collects the labels to place: every point in values_to_label and, if label_big_sig is set, the max_labels most
+        significant points of each of the significant big logFC categories.
+        Returns
+        -------
+        list of (name, x, y, priority, text keyword arguments) as used by place_labels
+        """
+        labels = []
+        names = self.df[self.label_column].to_numpy()
+        significance = self.get_significance(x, y)
         if self.values_to_label is not None:
-            texts = []
-            labels = self.df[self.label_column].values[idxs]
-            for i, name in enumerate(labels):
-                if name in self.values_to_label:
-                    lbl_bg = self.values_colours.get(name)
-                    color = self.text_colours.get(name)
-                    texts.append(fig.text(x[i], y[i], name, color=color, fontsize=self.label_font_size,
-                                          bbox=dict(fc=lbl_bg, alpha=1.0)))
-            adjust_text(texts, force_text=2.0)
+            for i in np.flatnonzero(pd.Series(names).isin(self.values_to_label).values):
+                name = names[i]
+                # Labels the user asked for are placed before the automatic ones
+                labels.append((name, x[i], y[i], (1, significance[i]),
+                               dict(color=self.text_colours.get(name),
+                                    bbox=dict(fc=self.values_colours.get(name), alpha=1.0))))
         # Check if the user wants these labeled
-        if self.label_big_sig and annotate:
-            # If they do have a limit on the number of ones we show (i.e. we don't want 10000 gene names...)
-            max_values = -1 * self.max_labels
-            if len(y) < self.max_labels:
-                max_values = -1 * (len(y) - 1)
-            most_sig_idxs = np.argpartition(y, max_values)[max_values:]
-            labels = self.df[self.label_column].values[idxs][most_sig_idxs]
-            x = x[most_sig_idxs]
-            y = y[most_sig_idxs]
-            # We only label the ones with the max log fc
-            for i, name in enumerate(labels):
-                fig.annotate(name, (x[i], y[i]),
-                             xytext=(0, 10),
-                             textcoords='offset points', ha='center', va='bottom',
-                             bbox=dict(boxstyle='round,pad=0.5',
-                                       fc='white', alpha=0.2)
-                             )
-        return ax
+        if self.label_big_sig:
+            for category in ['sig_big-pos-logFC', 'sig_big-neg-logFC']:
+                idxs = np.flatnonzero(codes == CATEGORIES.index(category))
+                # If they do have a limit on the number of ones we show (i.e. we don't want 10000 gene names...)
+                if len(idxs) > self.max_labels:
+                    idxs = idxs[np.argpartition(significance[idxs], -self.max_labels)[-self.max_labels:]]
+                for i in idxs:
+                    labels.append((names[i], x[i], y[i], (0, significance[i]),
+                                   dict(bbox=dict(boxstyle='round,pad=0.5', fc='white', alpha=0.2))))
+        return labels
 
-    def plot(self):
+    def adjust_labels(self, ax: plt.axes, labels: list) -> None:
+        """ Draws the labels at their points and lets adjustText move them apart (slow for many labels). """
+        from adjustText import adjust_text
+        texts = []
+        for name, x, y, priority, text_kwargs in labels:
+            if priority[0]:
+                texts.append(ax.text(x, y, name, fontsize=self.label_font_size, **text_kwargs))
+            else:
+                ax.annotate(name, (x, y), xytext=(0, 10), textcoords='offset points', ha='center', va='bottom',
+                            **text_kwargs)
+        if texts:
+            adjust_text(texts, force_text=2.0)
+
+    def get_significance(self, x: np.array, y: np.array) -> np.array:
+        """ -log10 p value of the points (the x axis if inverted), used to rank the labels. """
+        return x if self.invert else y
+
+    def place_labels(self, ax: plt.axes, labels: list) -> list:
         """
-        For annotation styling see: https://matplotlib.org/api/pyplot_api.html#matplotlib.pyplot.annotate
+        Places all the labels in one greedy pass, most important first. Each label tries the positions in
+        LABEL_POSITIONS around its point and takes the first whose box (estimated from the font size) doesn't touch a
+        cell of an occupancy grid (cells are one label high) already covered by a placed label. Labels that don't fit
+        anywhere, or are over label_budget, are dropped. The cost is bounded by the number of labels times positions
+        rather than growing with the square of the labels.
+        Parameters
+        ----------
+        ax:     axis the points were drawn on
+        labels: list of (name, x, y, priority, text keyword arguments), larger priorities are placed first
+
         Returns
         -------
-
+        list of the annotations drawn
         """
+        if not labels:
+            return []
+        ax.autoscale_view()
+        px_per_pt = ax.figure.dpi / 72
+        points = ax.transData.transform(np.array([[l[1], l[2]] for l in labels], dtype=float))
+        ax_box = ax.get_window_extent()
+        # Text height including the box padding, used as the grid cell size
+        height = self.label_font_size * 1.8 * px_per_pt
+        occupied = set()
+        placed = []
+        order = sorted(range(len(labels)), key=lambda i: labels[i][3], reverse=True)
+        for i in order:
+            if self.label_budget is not None and len(placed) >= self.label_budget:
+                break
+            name, x, y, _, text_kwargs = labels[i]
+            width = (len(str(name)) * 0.6 * self.label_font_size + 4) * px_per_pt
+            px, py = points[i]
+            for dx, dy, ha, va in LABEL_POSITIONS:
+                left = px + dx * px_per_pt - {'left': 0, 'center': width / 2, 'right': width}[ha]
+                bottom = py + dy * px_per_pt - (0 if va == 'bottom' else height)
+                if left < ax_box.x0 or left + width > ax_box.x1 or bottom < ax_box.y0 or bottom + height > ax_box.y1:
+                    continue
+                cells = {(cx, cy) for cx in range(int(left // height), int((left + width) // height) + 1)
+                         for cy in range(int(bottom // height), int((bottom + height) // height) + 1)}
+                if cells & occupied:
+                    continue
+                occupied |= cells
+                far = abs(dx) > 10 or abs(dy) > 10
+                placed.append(ax.annotate(name, (x, y), xytext=(dx, dy), textcoords='offset points', ha=ha, va=va,
+                                          fontsize=self.label_font_size,
+                                          arrowprops=dict(arrowstyle='-', lw=0.5, color='grey') if far else None,
+                                          **text_kwargs))
+                break
+        return placed
+
+    def get_offset(self) -> float:
+        """ Offset added to the p values before the log, the smallest non zero p value unless one was given. """
         # if offset is not given, make the offset the smallest value in the dataset
         if not self.offset:
             vals = self.df[self.p_val].values
             self.offset = np.min(vals[np.nonzero(vals)])
             self.u.warn_p(['No offset was provided, setting offset to be smallest value recorded in dataset: ',
                            self.offset])
+        return self.offset
 
-        # x axis has log_fc, first only plot the values < cutoff
+    def get_xy(self) -> tuple:
+        """ Coordinates of the points: logFC and -log10 p value (swapped if invert). """
         x = self.df[self.log_fc].values
-        y = -1 * np.log10(self.df[self.p_val].values + self.offset)
-
-        log_fc_np = self.df[self.log_fc].values
-        p_val_np = self.df[self.p_val].values
-
+        y = -1 * np.log10(self.df[self.p_val].values + self.get_offset())
         if self.invert:
-            x = -1 * np.log10(self.df[self.p_val].values + self.offset)
-            y = self.df[self.log_fc].values
-        sig_small_pos_logfc = np.where((p_val_np <= self.p_val_cutoff) & (np.abs(log_fc_np) < self.log_fc_cuttoff)
-                                       & (log_fc_np > 0))
-        sig_big_pos_logfc = np.where((p_val_np <= self.p_val_cutoff) & (np.abs(log_fc_np) >= self.log_fc_cuttoff)
-                                     & (log_fc_np > 0))
-
-        sig_small_neg_logfc = np.where((p_val_np <= self.p_val_cutoff) & (np.abs(log_fc_np) < self.log_fc_cuttoff)
-                                       & (log_fc_np <= 0))
-        sig_big_neg_logfc = np.where((p_val_np <= self.p_val_cutoff) & (np.abs(log_fc_np) >= self.log_fc_cuttoff)
-                                     & (log_fc_np <= 0))
-
-        ns = np.where(p_val_np > self.p_val_cutoff)
-        # Plot the points
-        fig, ax = plt.subplots(figsize=self.figsize)
+            x, y = y, x
+        return x, y
 
-        self.add_scatter_and_annotate(ax, x, y, self.colours['sig_small-pos-logFC'], ns)
+    def draw(self, ax: plt.axes) -> plt.axes:
+        """
+        Draws the points of self.df on an existing axis and collects the labels on self.labels_to_place (they are
+        drawn by place_labels once the layout is fixed, or straight away when label_method is 'adjust_text').
+        """
+        if self.label_method not in ['grid', 'adjust_text']:
+            msg = self.u.msg.msg_arg_err("plot", "label_method", self.label_method, ['grid', 'adjust_text'])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        x, y = self.get_xy()
+        codes = self.classify()
+        # Plot the points in one call, sorted by category so the significant ones are drawn on top
+        order = np.argsort(codes, kind='stable')
+        # Non-significant points used to take the sig_small-pos-logFC colour, keep that if no ns colours are given
+        lookup = to_rgba_array([self.colours.get(c, self.colours['sig_small-pos-logFC']) for c in CATEGORIES])
+        ax.scatter(x[order], y[order], c=lookup[codes[order]], alpha=self.opacity, s=self.s)
+        self.labels_to_place = self.get_labels(x, y, codes)
+        if self.label_method == 'adjust_text':
+            self.adjust_labels(ax, self.labels_to_place)
+        return ax
 
-        self.add_scatter_and_annotate(ax, x, y, self.colours['sig_small-pos-logFC'], sig_small_pos_logfc)
-        self.add_scatter_and_annotate(ax, x, y, self.colours['sig_big-pos-logFC'], sig_big_pos_logfc, annotate=True)
+    def plot(self):
+        """
+        For annotation styling see: https://matplotlib.org/api/pyplot_api.html#matplotlib.pyplot.annotate
+        Returns
+        -------
 
-        # Negative
-        self.add_scatter_and_annotate(ax, x, y, self.colours['sig_small-neg-logFC'], sig_small_neg_logfc)
-        self.add_scatter_and_annotate(ax, x, y, self.colours['sig_big-neg-logFC'], sig_big_neg_logfc, annotate=True)
+        """
+        fig, ax = plt.subplots(figsize=self.figsize)
+        self.draw(ax)
         self.add_labels()
         ax.tick_params(labelsize=self.label_font_size)
         self.set_ax_params(ax)
         plt.tight_layout()
+        if self.label_method == 'grid':
+            # One global pass over all the labels, once the layout (and so the axis size) is fixed
+            self.place_labels(ax, self.labels_to_place)
         return ax
+
+    def get_contrasts(self, contrasts=None, contrast_column='contrast') -> dict:
+        """
+        Splits the data into one dataframe per contrast.
+        Parameters
+        ----------
+        contrasts:          dict of contrast name to dataframe, if None self.df is used as a long format table
+        contrast_column:    column of self.df naming the contrast of each row
+
+        Returns
+        -------
+        dict of contrast name to dataframe
+        """
+        if contrasts is not None:
+            return contrasts
+        if contrast_column not in self.df.columns:
+            msg = self.u.msg.msg_arg_err("get_contrasts", "contrast_column", contrast_column, list(self.df.columns))
+            self.u.err_p([msg])
+            raise VisException(msg)
+        # One pass over the column rather than a mask per contrast
+        return {name: self.df.iloc[idxs] for name, idxs in self.df.groupby(contrast_column, sort=False).indices.items()}
+
+    def get_limits(self, contrasts: dict) -> tuple:
+        """ x and y limits covering the points of all the contrasts (with a 5% margin). """
+        df = self.df
+        mins, maxs = [], []
+        for contrast_df in contrasts.values():
+            self.df = contrast_df
+            x, y = self.get_xy()
+            mins.append([np.nanmin(x), np.nanmin(y)])
+            maxs.append([np.nanmax(x), np.nanmax(y)])
+        self.df = df
+        low, high = np.nanmin(mins, axis=0), np.nanmax(maxs, axis=0)
+        margin = 0.05 * (high - low)
+        return (low[0] - margin[0], high[0] + margin[0]), (low[1] - margin[1], high[1] + margin[1])
+
+    def plot_contrasts(self, contrasts=None, contrast_column='contrast', output_dir=None, facet=False, ncols=4,
+                       share_limits=True, file_format='svg'):
+        """
+        Plots many contrasts with this one Volcanoplot (so the style, colours and figure are only set up once).
+
+        Without facet, a single figure is reused: its axis is cleared and redrawn for each contrast and, if output_dir
+        is given, saved there as <output_dir>/volcanoplot_<contrast>_<date>.<file_format>. The layout is only computed
+        for the first contrast when the limits are shared. With facet, all the contrasts are drawn on one grid of
+        ncols columns.
+        Parameters
+        ----------
+        contrasts:          dict of contrast name to dataframe, if None self.df is used as a long format table
+        contrast_column:    column of the long format table naming the contrast of each row
+        output_dir:         directory the plots (or the facet grid) are saved to, nothing is saved if None
+        facet:              draw all the contrasts on one figure
+        ncols:              number of columns of the facet grid
+        share_limits:       use the same axis limits for every contrast
+        file_format:        'svg' or 'png'
+
+        Returns
+        -------
+        the figure, and a dict of contrast name to saved file (empty if output_dir is None)
+        """
+        if file_format not in ['svg', 'png']:
+            msg = self.u.msg.msg_arg_err("plot_contrasts", "file_format", file_format, ['svg', 'png'])
+            self.u.err_p([msg])
+            raise VisException(msg)
+        contrasts = self.get_contrasts(contrasts, contrast_column)
+        # The contrasts are drawn through self.df, self.title and self.offset, put them back even if one fails
+        df, title, offset = self.df, self.title, self.offset
+        try:
+            if not self.offset:
+                # The same offset for all the contrasts so the y axes are comparable
+                self.df = pd.concat([c[[self.p_val]] for c in contrasts.values()])
+                self.get_offset()
+            limits = self.get_limits(contrasts) if share_limits else None
+            self.contrast_codes = {}
+            files = {}
+            if facet:
+                nrows = int(np.ceil(len(contrasts) / ncols))
+                fig, axes = plt.subplots(nrows, ncols, figsize=(self.figsize[0] * ncols, self.figsize[1] * nrows),
+                                         squeeze=False)
+                axes = axes.ravel()
+                labels = []
+                for i, (name, contrast_df) in enumerate(contrasts.items()):
+                    ax = axes[i]
+                    self.df = contrast_df
+                    self.draw(ax)
+                    self.contrast_codes[name] = self.category_codes
+                    labels.append(self.labels_to_place)
+                    ax.set_title(name, fontsize=self.title_font_size, fontweight=self.title_font_weight)
+                    ax.set_xlabel(self.xlabel if i // ncols == nrows - 1 else '', fontsize=self.label_font_size)
+                    ax.set_ylabel(self.ylabel if i % ncols == 0 else '', fontsize=self.label_font_size)
+                    self.set_ax_params(ax)
+                    if limits:
+                        ax.set_xlim(limits[0])
+                        ax.set_ylim(limits[1])
+                for ax in axes[len(contrasts):]:
+                    ax.set_visible(False)
+                fig.tight_layout()
+                if self.label_method == 'grid':
+                    for ax, ax_labels in zip(axes, labels):
+                        self.place_labels(ax, ax_labels)
+                if output_dir is not None:
+                    files['facet'] = self.u.generate_label([os.path.join(output_dir, ''), self.label, 'facet'],
+                                                           '.' + file_format)
+                    fig.savefig(files['facet'], dpi=self.dpi)
+            else:
+                fig, ax = plt.subplots(figsize=self.figsize)
+                for i, (name, contrast_df) in enumerate(contrasts.items()):
+                    # Reuse the axis: only the artists are removed, the figure and its layout stay
+                    ax.cla()
+                    self.df = contrast_df
+                    self.title = name
+                    self.draw(ax)
+                    self.contrast_codes[name] = self.category_codes
+                    ax.set_title(name, fontsize=self.title_font_size, fontweight=self.title_font_weight)
+                    ax.set_xlabel(self.xlabel, fontsize=self.label_font_size, fontweight=self.text_font_weight)
+                    ax.set_ylabel(self.ylabel, fontsize=self.label_font_size, fontweight=self.text_font_weight)
+                    self.set_ax_params(ax)
+                    if limits:
+                        ax.set_xlim(limits[0])
+                        ax.set_ylim(limits[1])
+                    if i == 0 or not limits:
+                        fig.tight_layout()
+                    if self.label_method == 'grid':
+                        self.place_labels(ax, self.labels_to_place)
+                    if output_dir is not None:
+                        files[name] = self.u.generate_label([os.path.join(output_dir, ''), self.label, str(name)],
+                                                            '.' + file_format)
+                        fig.savefig(files[name], dpi=self.dpi)
+        finally:
+            self.df, self.title, self.offset = df, title, offset
+        return fig, files
@@ -33,9 +33,9 @@ setup(name='sciviso',
           'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
           'Natural Language :: English',
           'Operating System :: OS Independent',
-          'Programming Language :: Python :: 3.6',
-          'Programming Language :: Python :: 3.7',
           'Programming Language :: Python :: 3.8',
+          'Programming Language :: Python :: 3.9',
+          'Programming Language :: Python :: 3.10',
           'Topic :: Scientific/Engineering :: Bio-Informatics',
       ],
       keywords='util',
@@ -45,8 +45,12 @@ setup(name='sciviso',
               'sciviso = sciviso.__main__:main'
           ]
       },
-      install_requires=['sciutil', 'pandas', 'numpy', 'matplotlib', 'statannot', 'seaborn', 'adjustText', 'wordcloud',
-                        'networkx', 'dash', 'kaleido'],  # the last two are for sankey plots
-      python_requires='>=3.6',
+      # scipy 1.9 for axis and nan_policy on shapiro and levene (stats.Stats), pandas 1.5 for
+      # factorize(use_na_sentinel) (Sankeyplot)
+      install_requires=['sciutil', 'pandas>=1.5', 'numpy', 'scipy>=1.9', 'matplotlib', 'seaborn', 'adjustText',
+                        'wordcloud', 'networkx', 'plotly'],
+      # Only needed to export the plotly Sankey diagrams as images, Sankeyplot(engine='matplotlib') saves them directly
+      extras_require={'plotly-export': ['dash', 'kaleido']},
+      python_requires='>=3.8',
       data_files=[("", ["LICENSE"])]
       )
\ No newline at end of file
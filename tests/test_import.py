@@ -0,0 +1,75 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import subprocess
+import sys
+import unittest
+
+# Optional dependencies that only some of the charts need
+HEAVY_MODULES = ['plotly', 'networkx', 'adjustText', 'statannot']
+ALL_CHARTS = ['Violinplot', 'Boxplot', 'Barchart', 'Heatmap', 'Histogram', 'Scatterplot', 'Volcanoplot',
+              'Emapplot', 'Line', 'Sankeyplot', 'Countplot']
+
+
+def run_cold(code: str) -> str:
+    """ Run code in a fresh interpreter (so nothing is already imported) and return what it prints. """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, MPLBACKEND='Agg', PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    return subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True,
+                          text=True).stdout.strip()
+
+
+def time_import(attributes: list, repeats=3) -> tuple:
+    """ Best of repeats cold start time to import sciviso and access the attributes, and the number of modules. """
+    code = 'import sys, time\n' \
+           't = time.perf_counter()\n' \
+           'import sciviso\n' + \
+           ''.join(f'sciviso.{a}\n' for a in attributes) + \
+           'print(time.perf_counter() - t, len(sys.modules))'
+    runs = [run_cold(code).split() for _ in range(repeats)]
+    return min(float(r[0]) for r in runs), int(runs[0][1])
+
+
+class TestImport(unittest.TestCase):
+
+    def test_lazy_import(self):
+        loaded = run_cold('import sys, sciviso\n'
+                          'print(",".join(m for m in sys.modules if m.split(".")[0] in '
+                          f'{HEAVY_MODULES + ["matplotlib", "pandas"]}))')
+        self.assertEqual(loaded, '')
+        loaded = run_cold('import sys, sciviso\n'
+                          'sciviso.Barchart\n'
+                          f'print(",".join(m for m in {HEAVY_MODULES} if m in sys.modules))')
+        self.assertEqual(loaded, '')
+
+    def test_import_benchmark(self):
+        barchart, barchart_modules = time_import(['Barchart'])
+        everything, everything_modules = time_import(ALL_CHARTS)
+        print(f'Cold import of sciviso.Barchart: {barchart:.3f}s ({barchart_modules} modules), '
+              f'all charts: {everything:.3f}s ({everything_modules} modules)')
+        # Timings are noisy on shared machines so check the work that was skipped
+        self.assertLess(barchart_modules, everything_modules)
+
+    def test_attributes(self):
+        import sciviso
+        for chart in ALL_CHARTS:
+            self.assertIn(chart, dir(sciviso))
+        from sciviso import Barchart, Vis
+        self.assertTrue(issubclass(Barchart, Vis))
+        with self.assertRaises(AttributeError):
+            sciviso.NotAChart
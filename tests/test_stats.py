@@ -0,0 +1,162 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import importlib.util
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import tempfile
+import unittest
+from scipy import stats
+
+from sciviso import VisException
+from sciviso.stats import Stats, adjust_pvalues
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        num_features = 500
+        a = rng.randn(num_features, 6)
+        b = rng.randn(num_features, 6) + 0.5
+        # Make some of the features skewed and some with unequal variance so different tests get chosen
+        b[:100] = rng.exponential(size=(100, 6)) ** 3
+        b[100:200] *= 5
+        self.a_cols = [f'a{i}' for i in range(6)]
+        self.b_cols = [f'b{i}' for i in range(6)]
+        self.df = pd.DataFrame(np.hstack([a, b]), columns=self.a_cols + self.b_cols)
+        self.df.index = [f'gene{i}' for i in range(num_features)]
+
+    def test_perform_stats(self):
+        st = Stats(self.df, {'A': self.a_cols, 'B': self.b_cols})
+        results = st.perform_stats()
+        self.assertEqual(list(results.index), list(self.df.index))
+        self.assertEqual(set(results['test'].values), {'ttest_ind', 'ttest_welch', 'mannwhitneyu'})
+        scipy_tests = {'ttest_ind': lambda x, y: stats.ttest_ind(x, y),
+                       'ttest_welch': lambda x, y: stats.ttest_ind(x, y, equal_var=False),
+                       'mannwhitneyu': lambda x, y: stats.mannwhitneyu(x, y, alternative='two-sided')}
+        for gene in ['gene0', 'gene150', 'gene300']:
+            row = results.loc[gene]
+            expected = scipy_tests[row['test']](self.df.loc[gene, self.a_cols].values.astype(float),
+                                                self.df.loc[gene, self.b_cols].values.astype(float))
+            self.assertAlmostEqual(row['pvalue'], expected.pvalue)
+            self.assertAlmostEqual(row['statistic'], expected.statistic)
+        # Non-normal features never get a parametric test
+        self.assertFalse(np.any(results['normality'].values & (results['test'] == 'mannwhitneyu').values))
+        self.assertTrue(np.allclose(results['padj'].values, stats.false_discovery_control(results['pvalue'].values)))
+
+    def test_choose_tests(self):
+        # Paired data gets paired tests, more than two groups get anova/kruskal
+        results = Stats(self.df, {'A': self.a_cols, 'B': self.b_cols}, paired=True).perform_stats()
+        self.assertTrue(set(results['test'].values) <= {'ttest_rel', 'wilcoxon'})
+        results = Stats(self.df, {'A': self.a_cols[:3], 'B': self.b_cols[:3], 'C': self.a_cols[3:]}).perform_stats()
+        # Kruskal needs 5 samples per group so some features can't be tested
+        self.assertTrue(set(results['test'].dropna().values) <= {'anova'})
+        self.assertTrue(np.all(np.isnan(results['pvalue'].values[results['test'].isnull().values])))
+        results = Stats(self.df, {'A': self.a_cols, 'B': self.b_cols}).perform_stats(test='levene')
+        self.assertEqual(set(results['test'].values), {'levene'})
+        with self.assertRaises(VisException):
+            Stats(self.df, {'A': self.a_cols, 'B': ['not_a_column']})
+        # A constant feature isn't counted as normal so it isn't sent to a t-test
+        df = self.df.copy()
+        df.loc[df.index[0], self.a_cols] = 1.0
+        st = Stats(df, {'A': self.a_cols, 'B': self.b_cols})
+        assumptions = st.check_assumptions(st.get_group_values())
+        self.assertFalse(assumptions['normality'].values[0])
+        self.assertEqual(st.perform_stats()['test'].values[0], 'mannwhitneyu')
+
+    def test_nan_features(self):
+        df = self.df.copy()
+        df.iloc[[3, 10], 1] = np.nan
+        st = Stats(df, {'A': self.a_cols, 'B': self.b_cols})
+        results = st.test_features(test='ttest_ind')
+        # Features with NaNs are tested on their other values, the rest exactly as before
+        for i in [3, 10]:
+            x, y = df[self.a_cols].values[i], df[self.b_cols].values[i]
+            self.assertAlmostEqual(results['pvalue'].values[i], stats.ttest_ind(x[~np.isnan(x)], y).pvalue)
+        expected = Stats(self.df, {'A': self.a_cols, 'B': self.b_cols}).test_features(test='ttest_ind')
+        clean = ~np.isin(np.arange(len(df)), [3, 10])
+        self.assertTrue(np.allclose(results['pvalue'].values[clean], expected['pvalue'].values[clean]))
+        self.assertEqual(list(results['min_sample_size'].values[[3, 10]]), [5, 5])
+
+    def test_adjust_pvalues(self):
+        pvalues = np.array([0.01, 0.04, np.nan, 0.03, 0.5])
+        padj = adjust_pvalues(pvalues, 'fdr_bh')
+        self.assertTrue(np.isnan(padj[2]))
+        tested = ~np.isnan(pvalues)
+        self.assertTrue(np.allclose(padj[tested], stats.false_discovery_control(pvalues[tested])))
+        self.assertTrue(np.allclose(adjust_pvalues(pvalues, 'bonferroni')[tested], [0.04, 0.16, 0.12, 1.0]))
+
+    def test_write_stats_file(self):
+        tmp_dir = tempfile.mkdtemp(prefix='sciviso_stats_')
+        try:
+            st = Stats(self.df, {'A': self.a_cols, 'B': self.b_cols})
+            expected = st.perform_stats()
+            path = os.path.join(tmp_dir, 'stats.csv')
+            st.write_stats_file(path, chunk_size=64)
+            written = pd.read_csv(path, index_col=0)
+            self.assertEqual(list(written.index), list(expected.index))
+            self.assertEqual(list(written.columns), list(expected.columns))
+            self.assertTrue(np.allclose(written['padj'].values, expected['padj'].values))
+            self.assertEqual(list(written['test'].values), list(expected['test'].values))
+
+            # Simulate an interruption part way through a line, resuming should give the same file
+            with open(path, 'rb+') as f:
+                f.truncate(os.path.getsize(path) // 2)
+            st.write_stats_file(path, chunk_size=64)
+            resumed = pd.read_csv(path, index_col=0)
+            self.assertEqual(list(resumed.index), list(expected.index))
+            self.assertTrue(np.allclose(resumed['pvalue'].values, expected['pvalue'].values))
+            self.assertTrue(np.allclose(resumed['padj'].values, expected['padj'].values))
+
+            # Appending new features adds them and adjusts across the whole file
+            extra = self.df.iloc[:10].copy()
+            extra.index = [f'new{i}' for i in range(10)]
+            Stats(extra, {'A': self.a_cols, 'B': self.b_cols}).write_stats_file(path)
+            appended = pd.read_csv(path, index_col=0)
+            self.assertEqual(len(appended), len(self.df) + 10)
+            self.assertTrue(np.allclose(appended['padj'].values, adjust_pvalues(appended['pvalue'].values)))
+
+            # The partly written line can be longer than a read block
+            with open(path, 'wb') as f:
+                f.write(b'feature,pvalue\ng1,0.5\n' + b'g2,' + b'1' * 100000)
+            self.assertEqual(st.get_written_features(path, 'csv'), {'g1'})
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'feature,pvalue\ng1,0.5\n')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow') or importlib.util.find_spec('fastparquet'),
+                         'needs a parquet engine')
+    def test_write_stats_parquet(self):
+        tmp_dir = tempfile.mkdtemp(prefix='sciviso_stats_')
+        try:
+            st = Stats(self.df, {'A': self.a_cols, 'B': self.b_cols})
+            expected = st.perform_stats()
+            path = os.path.join(tmp_dir, 'stats.parquet')
+            st.write_stats_file(path, chunk_size=100)
+            self.assertEqual(len(os.listdir(path)), 5)
+            # Remove the last part as if the run stopped before writing it
+            os.remove(os.path.join(path, 'part-00004.parquet'))
+            st.write_stats_file(path, chunk_size=100)
+            written = pd.read_parquet(path).set_index('feature')
+            self.assertEqual(list(written.index), list(expected.index))
+            self.assertTrue(np.allclose(written['padj'].values, expected['padj'].values))
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -17,15 +17,23 @@
 
 import os
 import matplotlib.pyplot as plt
+import networkx as nx
 import pandas as pd
 import numpy as np
 import seaborn as sns
 import shutil
 import tempfile
 import unittest
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.text import Text
+from scipy import stats
+from scipy.cluster import hierarchy
 
 from sciviso import Barchart, Boxplot, Heatmap, Histogram, Scatterplot, Violinplot, Volcanoplot, Line, \
-    Emapplot, Sankeyplot
+    Emapplot, Sankeyplot, VisException
+from sciviso.heatmap import LINKAGE_CACHE, kmeans_linkage
+from sciviso.sankey import SIRCLE_COLOURS
+from sciviso.stats import PairwiseStats
 
 
 class TestVis(unittest.TestCase):
@@ -88,7 +96,7 @@ class TestVis(unittest.TestCase):
                                              ["Iris-setosa", "Iris-virginica"])
         boxplot = Boxplot(df, "Conditions", "Values", box_colors=['pink', 'orange'], add_dots=True)
         boxplot.plot()
-        plt.savefig('fig.svg')
+        plt.savefig(os.path.join(self.tmp_dir, 'fig.svg'))
         plt.show()
 
     def test_heatmap(self):
@@ -105,7 +113,7 @@ class TestVis(unittest.TestCase):
                           row_colours=[row_colors, row_colors2], rows_to_colour=['sepal_length'],
                           linewidths=0.5, x_tick_labels=0)
         heatmap.plot(linecolor="none")
-        heatmap.save_png([self.data_dir, "heatmap"])
+        heatmap.save_png([self.tmp_dir, "heatmap"])
         plt.show()
         heatmap.plot_hm(linecolor="none")
         plt.show()
@@ -167,5 +175,546 @@ class TestVis(unittest.TestCase):
         eplot = Emapplot(df, overlap_column='geneID', config={'figsize': (3, 3)})
         eplot.build_graph(c_vmin=0.01, c_vmax=0.05, edge_vmin=1, edge_vmax=100,
                     g_min=10, g_mid=100, g_max=200)
-        plt.savefig('fig.svg')
+        plt.savefig(os.path.join(self.tmp_dir, 'fig.svg'))
         plt.show()
+
+    def test_emapplot_sparse_overlaps(self):
+        df = pd.read_csv(self.data_dir + 'emapexample.csv')
+        eplot = Emapplot(df, overlap_column='geneID')
+        # The sparse product should give exactly the same edges as intersecting every pair
+        for min_overlap in [1, 5]:
+            sparse_map = eplot.get_edge_map_sparse(min_overlap)
+            pairwise_map = eplot.get_edge_map_pairwise(min_overlap)
+            self.assertEqual(dict(sparse_map), dict(pairwise_map))
+        # With no minimum every pair of terms is joined
+        sparse_map = eplot.get_edge_map_sparse(0)
+        self.assertEqual(sum(len(v) for v in sparse_map.values()), len(df) * (len(df) - 1) // 2)
+        gene_matrix = eplot.get_gene_matrix()
+        self.assertEqual(gene_matrix.shape[0], len(df))
+        self.assertEqual(list(gene_matrix.sum(axis=1).A1), [len(set(g.split('/'))) for g in df['geneID'].values])
+        eplot.build_graph(overlap_method='sparse')
+        plt.show()
+
+    def test_emapplot_similarity(self):
+        df = pd.read_csv(self.data_dir + 'emapexample.csv')
+        eplot = Emapplot(df, overlap_column='geneID')
+        gene_sets = dict(zip(df['ID'].values, [set(g.split('/')) for g in df['geneID'].values]))
+        jaccard_map = eplot.get_edge_map_sparse(similarity='jaccard', similarity_cutoff=0.2)
+        for id_i, edges in jaccard_map.items():
+            for id_j, value in edges.items():
+                a, b = gene_sets[id_i], gene_sets[id_j]
+                self.assertAlmostEqual(value, len(a & b) / len(a | b))
+                self.assertGreaterEqual(value, 0.2)
+        overlap_map = eplot.get_edge_map_sparse(similarity='overlap')
+        for id_i, edges in overlap_map.items():
+            for id_j, value in edges.items():
+                a, b = gene_sets[id_i], gene_sets[id_j]
+                self.assertAlmostEqual(value, len(a & b) / min(len(a), len(b)))
+        # Identical terms agree perfectly
+        kappa = eplot.get_similarity([5], [5], [5], 100, 'kappa')
+        self.assertAlmostEqual(kappa[0], 1.0)
+
+        # LSH only finds a subset of the exact edges, but the values it finds are exact
+        lsh_map = eplot.get_edge_map_sparse(similarity='jaccard', similarity_cutoff=0.2, use_lsh=True)
+        for id_i, edges in lsh_map.items():
+            for id_j, value in edges.items():
+                self.assertAlmostEqual(value, jaccard_map[id_i][id_j])
+        # Hashing the terms in small chunks gives the same signatures
+        gene_matrix = eplot.get_gene_matrix()
+        signatures = eplot.get_minhash_signatures(gene_matrix, seed=1)
+        self.assertTrue(np.array_equal(signatures, eplot.get_minhash_signatures(gene_matrix, seed=1, max_cells=1000)))
+        eplot.build_graph(similarity='jaccard', similarity_cutoff=0.2, use_lsh=True, lsh_seed=1)
+        plt.show()
+
+    def test_emapplot_components(self):
+        df = pd.read_csv(self.data_dir + 'emapexample.csv')
+        eplot = Emapplot(df, overlap_column='geneID')
+        edge_map = eplot.get_edge_map_sparse(min_overlap=5)
+        components = eplot.get_components(edge_map)
+        # Should match networkx's connected components
+        G = nx.Graph()
+        G.add_nodes_from(df['ID'].values)
+        G.add_edges_from([(i, j) for i in edge_map for j in edge_map[i]])
+        expected = {frozenset(c) for c in nx.connected_components(G)}
+        found = {frozenset(df['ID'].values[components == c]) for c in set(components)}
+        self.assertEqual(expected, found)
+        graph_df = eplot.build_graph(min_overlap=5)
+        self.assertEqual(list(graph_df['component'].values), list(components))
+        plt.show()
+
+    def test_emapplot_layout(self):
+        df = pd.read_csv(self.data_dir + 'emapexample.csv')
+        eplot = Emapplot(df, overlap_column='geneID')
+        G = nx.Graph()
+        G.add_nodes_from(df['ID'].values)
+        edge_map = eplot.get_edge_map_sparse(min_overlap=5)
+        G.add_edges_from([(i, j) for i in edge_map for j in edge_map[i]])
+        # Seeded layouts are reproducible and cached layouts aren't recomputed
+        pos = eplot.get_layout(G, 'spring', seed=1, use_cache=False)
+        pos_again = eplot.get_layout(G, 'spring', seed=1, use_cache=False)
+        for node in G.nodes():
+            self.assertTrue(np.allclose(pos[node], pos_again[node]))
+        cached = eplot.get_layout(G, 'spring', seed=1)
+        self.assertIs(cached, eplot.get_layout(G, 'spring', seed=1))
+        for layout in ['kamada_kawai', 'spectral', 'grid_force', 'auto']:
+            pos = eplot.get_layout(G, layout)
+            self.assertEqual(set(pos.keys()), set(G.nodes()))
+            self.assertTrue(np.all(np.isfinite(np.array(list(pos.values())))))
+        eplot.build_graph(min_overlap=5, layout='grid_force')
+        plt.show()
+
+    def test_boxplot_format_data(self):
+        boxplot = Boxplot(self.df, self.label, self.y)
+        conditions = ["sepal", "length"]
+        filter_values = ["Iris-setosa", "Iris-virginica"]
+        df = boxplot.format_data_for_boxplot(self.df, conditions, "label", filter_values)
+        # Build the expected long format row by row, then condition, then sample
+        values, samples, condition = [], [], []
+        for i in np.where(self.df['label'].isin(filter_values))[0]:
+            for cond in conditions:
+                for c in [c for c in self.df.columns if cond in c]:
+                    values.append(self.df[c].values[i])
+                    condition.append(cond)
+                    samples.append(c)
+        self.assertEqual(list(df['Values'].values), values)
+        self.assertEqual(list(df['Samples'].astype(str).values), samples)
+        self.assertEqual(list(df['Conditions'].astype(str).values), condition)
+        self.assertEqual(df['Conditions'].dtype.name, 'category')
+        # No filter keeps every row
+        df = boxplot.format_data_for_boxplot(self.df, conditions)
+        self.assertEqual(len(df), len(self.df) * 4)
+
+    def test_pairwise_stats(self):
+        pairs = [('Iris-setosa', 'Iris-versicolor'), ('Iris-setosa', 'Iris-virginica'),
+                 ('Iris-versicolor', 'Iris-virginica')]
+        tests = {'Mann-Whitney': lambda a, b: stats.mannwhitneyu(a, b, alternative='two-sided'),
+                 't-test_ind': stats.ttest_ind,
+                 't-test_welch': lambda a, b: stats.ttest_ind(a, b, equal_var=False),
+                 't-test_paired': stats.ttest_rel,
+                 'Wilcoxon': stats.wilcoxon}
+        pairwise = PairwiseStats(self.df, self.label, self.y)
+        for test, scipy_test in tests.items():
+            stats_df = pairwise.test(pairs, test)
+            for g1, g2, statistic, pvalue in stats_df[['group1', 'group2', 'statistic', 'pvalue']].values:
+                expected = scipy_test(self.df[self.y][self.df[self.label] == g1].values,
+                                      self.df[self.y][self.df[self.label] == g2].values)
+                self.assertAlmostEqual(statistic, expected.statistic)
+                self.assertAlmostEqual(pvalue, expected.pvalue)
+        # Splitting over processes gives the same answer
+        stats_df = pairwise.test(pairs, 'Mann-Whitney', n_jobs=2)
+        self.assertTrue(np.allclose(stats_df['pvalue'].values, pairwise.test(pairs)['pvalue'].values))
+
+        boxplot = Boxplot(self.df, self.label, self.y, stat_method='t-test_welch')
+        boxplot.plot()
+        self.assertEqual(len(boxplot.stats_df), 3)
+        plt.show()
+
+    def test_boxplot_hue_pairs(self):
+        df = self.df.copy()
+        df['batch'] = np.where(np.arange(len(df)) % 2 == 0, 'u', 'v')
+        pairs = [(('Iris-setosa', 'u'), ('Iris-setosa', 'v')), (('Iris-setosa', 'u'), ('Iris-virginica', 'v'))]
+        boxplot = Boxplot(df, self.label, self.y, hue='batch', box_pairs=pairs)
+        boxplot.plot()
+        # Groups are the (x, hue) combinations rather than the pooled x groups
+        for (g1, g2), pvalue in zip(pairs, boxplot.stats_df['pvalue'].values):
+            a = df[self.y][(df[self.label] == g1[0]) & (df['batch'] == g1[1])].values
+            b = df[self.y][(df[self.label] == g2[0]) & (df['batch'] == g2[1])].values
+            self.assertAlmostEqual(pvalue, stats.mannwhitneyu(a, b, alternative='two-sided').pvalue)
+        plt.close()
+        # By default the hue groups are compared within each x group
+        boxplot = Boxplot(df, self.label, self.y, hue='batch')
+        boxplot.plot()
+        self.assertEqual(list(boxplot.stats_df['group1']), [(g, 'u') for g in sorted(set(df[self.label]))])
+        plt.close()
+        # Pooled x pairs can't be tested once the data is split by hue
+        with self.assertRaises(VisException):
+            Boxplot(df, self.label, self.y, hue='batch', box_pairs=[('Iris-setosa', 'Iris-virginica')]).plot()
+        plt.close()
+
+    def test_scatterplot_rasterize(self):
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame({'x': rng.randn(60000), 'y': rng.randn(60000)})
+        scatterplot = Scatterplot(df, 'x', 'y', 'Title', 'Xlabel', 'Ylabel')
+        # Above the threshold the points are drawn as a bitmap but the labels are still text
+        self.assertTrue(scatterplot.use_rasterization(len(df)))
+        ax = scatterplot.plot()
+        self.assertTrue(ax.collections[0].get_rasterized())
+        scatterplot.save_svg([self.tmp_dir, 'raster'])
+        svg_file = [f for f in os.listdir(self.tmp_dir) if f.endswith('.svg')][0]
+        with open(os.path.join(self.tmp_dir, svg_file)) as f:
+            svg = f.read()
+        self.assertIn('<image', svg)
+        self.assertIn('Xlabel', svg)
+        self.assertLess(len(svg), 5e6)
+        plt.close()
+        scatterplot = Scatterplot(df.iloc[:100], 'x', 'y', rasterize=None)
+        self.assertFalse(scatterplot.plot().collections[0].get_rasterized())
+        plt.close()
+
+    def test_scatterplot_aggregate(self):
+        rng = np.random.RandomState(0)
+        num_points = 200000
+        df = pd.DataFrame({'x': rng.randn(num_points), 'y': rng.randn(num_points),
+                           'value': rng.rand(num_points), 'cluster': rng.choice(['a', 'b', 'c'], num_points)})
+        x, y = df['x'].values, df['y'].values
+        extent = [x.min(), x.max(), y.min(), y.max()]
+        # Counts match a 2D histogram over the same bins
+        grid = Scatterplot.aggregate_points(x, y, (40, 50), extent)
+        expected, _, _ = np.histogram2d(y, x, bins=[40, 50], range=[extent[2:], extent[:2]])
+        self.assertTrue(np.array_equal(grid, expected))
+        means = Scatterplot.aggregate_points(x, y, (40, 50), extent, df['value'].values, how='mean')
+        sums, _, _ = np.histogram2d(y, x, bins=[40, 50], range=[extent[2:], extent[:2]], weights=df['value'].values)
+        filled = expected > 0
+        self.assertTrue(np.allclose(means[filled], sums[filled] / expected[filled]))
+        self.assertTrue(np.all(np.isnan(means[~filled])))
+        # A pixel with only one category gets that category
+        codes = np.array([0, 1, 1, 2])
+        grid = Scatterplot.aggregate_points(np.array([0.1, 0.9, 0.9, 0.9]), np.array([0.1, 0.9, 0.9, 0.9]),
+                                            (2, 2), [0, 1, 0, 1], codes, how='category')
+        self.assertEqual(grid.tolist(), [[0, -1], [-1, 1]])
+        # Missing categories (code -1) don't spill into another pixel
+        grid = Scatterplot.aggregate_points(np.array([0.1, 0.9]), np.array([0.1, 0.9]), (2, 2), [0, 1, 0, 1],
+                                            np.array([0, -1]), how='category')
+        self.assertEqual(grid.tolist(), [[0, -1], [-1, -1]])
+        nan_df = pd.DataFrame({'x': [0.1, 0.9, 0.9], 'y': [0.1, 0.9, 0.1], 'cluster': ['a', 'b', None]})
+        scatterplot = Scatterplot(nan_df, 'x', 'y', aggregate='category', aggregate_column='cluster',
+                                  aggregate_shape=(2, 2))
+        ax = scatterplot.plot()
+        alpha = ax.images[0].get_array()[:, :, 3]
+        self.assertEqual((alpha > 0).tolist(), [[True, False], [False, True]])
+        plt.close('all')
+
+        for aggregate in ['count', 'mean', 'category']:
+            scatterplot = Scatterplot(df, 'x', 'y', 'Title', 'Xlabel', 'Ylabel', aggregate=aggregate,
+                                      aggregate_column='cluster' if aggregate == 'category' else 'value')
+            ax = scatterplot.plot()
+            self.assertEqual(len(ax.images), 1)
+            self.assertEqual(len(ax.collections), 0)
+            plt.close('all')
+        # The mean needs numeric values rather than the default colour
+        with self.assertRaises(VisException):
+            Scatterplot(df, 'x', 'y', 'Title', 'Xlabel', 'Ylabel', aggregate='mean').plot()
+        plt.close('all')
+
+    def test_scatterplot_categories(self):
+        scatterplot = Scatterplot(self.df, self.x, self.y, 'Title', 'Xlabel', 'Ylabel', color_col=self.label)
+        ax = scatterplot.plot()
+        # One scatter for all the categories with a legend entry per category
+        self.assertEqual(len(ax.collections), 1)
+        labels = [t.get_text() for t in ax.get_legend().get_texts()]
+        self.assertEqual(labels, list(pd.unique(self.df[self.label])))
+        # Each point keeps its category's colour
+        colours = ax.collections[0].get_facecolors()
+        offsets = ax.collections[0].get_offsets()
+        legend_colours = {label: tuple(h.get_color()) for label, h in zip(labels, ax.get_legend().legend_handles)}
+        for (px, py), colour in zip(offsets[:5], colours[:5]):
+            label = self.df[(self.df[self.x] == px) & (self.df[self.y] == py)][self.label].values[0]
+            self.assertTrue(np.allclose(colour[:3], legend_colours[label][:3]))
+        plt.close()
+
+    def test_scatterplot_annotate(self):
+        points = ['Iris-setosa', 'not-a-label']
+        scatterplot = Scatterplot(self.df, self.x, self.y, points_to_annotate=points, annotation_label=self.label)
+        idxs = scatterplot.get_annotation_idxs(self.df[self.label].values)
+        expected = [i for i, name in enumerate(self.df[self.label].values) if name in points]
+        self.assertEqual(list(idxs), expected)
+        ax = scatterplot.plot()
+        self.assertEqual(len(ax.texts), len(expected))
+        plt.close()
+
+    def test_volcanoplot_labels(self):
+        df = pd.read_csv(self.data_dir + 'volcano.csv')
+        volcanoplot = Volcanoplot(df, 'logfc', 'padj', 'external_gene_name', label_big_sig=True, max_labels=50,
+                                  offset=1e-300)
+        ax = volcanoplot.plot()
+        self.assertTrue(0 < len(ax.texts) <= len(volcanoplot.labels_to_place))
+        # None of the placed labels overlap (Text.get_window_extent leaves out the line back to the point)
+        renderer = ax.figure.canvas.get_renderer()
+        for t in ax.texts:
+            t.update_positions(renderer)
+        boxes = [Text.get_window_extent(t, renderer) for t in ax.texts]
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                self.assertFalse(boxes[i].overlaps(boxes[j]))
+        plt.close()
+        # The budget is shared by all the groups
+        volcanoplot = Volcanoplot(df, 'logfc', 'padj', 'external_gene_name', label_big_sig=True, max_labels=50,
+                                  offset=1e-300, label_budget=5)
+        ax = volcanoplot.plot()
+        self.assertEqual(len(ax.texts), 5)
+        plt.close()
+
+    def test_volcanoplot_categories(self):
+        df = pd.read_csv(self.data_dir + 'volcano.csv')
+        volcanoplot = Volcanoplot(df, 'logfc', 'padj', 'external_gene_name')
+        codes = volcanoplot.classify()
+        sig = df['padj'].values <= 0.05
+        big = np.abs(df['logfc'].values) >= 2
+        pos = df['logfc'].values > 0
+        self.assertEqual(np.sum(codes == 7), np.sum(sig & big & pos))
+        self.assertEqual(np.sum(codes == 6), np.sum(sig & big & ~pos))
+        self.assertEqual(np.sum(codes < 4), np.sum(~sig))
+        categories = volcanoplot.get_categories()
+        self.assertEqual(list(categories.index), list(df.index))
+        self.assertEqual(len(df[categories.str.startswith('sig')]), np.sum(sig))
+        # All the points are drawn with a single scatter
+        ax = volcanoplot.plot()
+        self.assertEqual(len(ax.collections), 1)
+        self.assertEqual(len(ax.collections[0].get_offsets()), len(df))
+        plt.close()
+
+    def test_volcanoplot_contrasts(self):
+        df = pd.read_csv(self.data_dir + 'volcano.csv').head(3000)
+        long_df = pd.concat([df.assign(contrast=name, logfc=df['logfc'] * scale)
+                             for name, scale in [('a', 1), ('b', 2), ('c', 0.5)]], ignore_index=True)
+        volcanoplot = Volcanoplot(long_df, 'logfc', 'padj', 'external_gene_name', label_big_sig=True, max_labels=5)
+        fig, files = volcanoplot.plot_contrasts(output_dir=self.tmp_dir)
+        self.assertEqual(sorted(files), ['a', 'b', 'c'])
+        for path in files.values():
+            self.assertTrue(os.path.exists(path))
+        # One figure reused for all the contrasts, with the limits shared (b has the largest logFCs)
+        self.assertEqual(len(fig.axes), 1)
+        self.assertLessEqual(fig.axes[0].get_xlim()[0], 2 * df['logfc'].min())
+        self.assertEqual(sorted(volcanoplot.contrast_codes), ['a', 'b', 'c'])
+        self.assertTrue(np.array_equal(volcanoplot.contrast_codes['a'],
+                                       Volcanoplot(df, 'logfc', 'padj', 'external_gene_name').classify()))
+        # The original dataframe is kept
+        self.assertEqual(len(volcanoplot.df), len(long_df))
+        plt.close()
+        # Facet grid from a dict of dataframes
+        contrasts = {name: group for name, group in long_df.groupby('contrast')}
+        fig, files = volcanoplot.plot_contrasts(contrasts, facet=True, ncols=2)
+        self.assertEqual(len([ax for ax in fig.axes if ax.get_visible()]), 3)
+        self.assertEqual(files, {})
+        limits = [ax.get_xlim() for ax in fig.axes[:3]]
+        self.assertTrue(all(limit == limits[0] for limit in limits))
+        plt.close()
+        # A failing contrast leaves the plot as it was
+        offset = volcanoplot.offset
+        with self.assertRaises(KeyError):
+            volcanoplot.plot_contrasts({'a': df, 'bad': df.drop(columns=['logfc'])})
+        self.assertEqual(len(volcanoplot.df), len(long_df))
+        self.assertEqual(volcanoplot.offset, offset)
+        plt.close('all')
+
+    def test_heatmap_linkage_cache(self):
+        LINKAGE_CACHE.clear()
+        heatmap = Heatmap(self.df, self.numeric_cols, self.label, linkage_cache_dir=self.tmp_dir)
+        values = self.df[self.numeric_cols].values
+        linkage = heatmap.get_linkage(values)
+        self.assertTrue(np.allclose(linkage, hierarchy.linkage(values, method='average', metric='euclidean')))
+        # A second call (or another heatmap of the same data) uses the cached linkage
+        self.assertIs(Heatmap(self.df, self.numeric_cols, self.label).get_linkage(values.copy()), linkage)
+        # Different settings are cached separately
+        self.assertFalse(np.allclose(Heatmap(self.df, self.numeric_cols, self.label,
+                                             linkage_method='single').get_linkage(values), linkage))
+        # The linkage is read back from disk once it's out of memory
+        LINKAGE_CACHE.clear()
+        self.assertEqual(len([f for f in os.listdir(self.tmp_dir) if f.startswith('linkage_')]), 1)
+        self.assertTrue(np.array_equal(heatmap.get_linkage(values), linkage))
+        # Plot uses (and exposes) the cached linkages
+        grid = heatmap.plot()
+        self.assertTrue(np.array_equal(heatmap.row_linkage, linkage))
+        self.assertEqual(list(grid.dendrogram_row.reordered_ind), list(heatmap.get_order('rows')))
+        plt.close()
+
+    def test_heatmap_kmeans_linkage(self):
+        rng = np.random.default_rng(0)
+        values = np.vstack([rng.normal(c * 10, 1, (300, 5)) for c in range(3)])
+        linkage = kmeans_linkage(values, max_exact=100)
+        self.assertTrue(hierarchy.is_valid_linkage(linkage))
+        self.assertEqual(sorted(hierarchy.leaves_list(linkage)), list(range(len(values))))
+        # Well separated groups are kept together
+        clusters = hierarchy.fcluster(linkage, 3, 'maxclust')
+        self.assertTrue(all(len(set(clusters[i * 300: (i + 1) * 300])) == 1 for i in range(3)))
+        # Rows k-means can't split are still all in the linkage
+        self.assertTrue(hierarchy.is_valid_linkage(kmeans_linkage(np.ones((250, 3)), max_exact=100)))
+        # In a heatmap, 'auto' only uses it above max_exact_rows
+        LINKAGE_CACHE.clear()
+        heatmap = Heatmap(self.df, self.numeric_cols, self.label, cluster_backend='auto', max_exact_rows=50,
+                          dtype=np.float32)
+        grid = heatmap.plot()
+        self.assertEqual(len(heatmap.row_linkage), len(self.df) - 1)
+        self.assertEqual(list(grid.dendrogram_row.reordered_ind), list(heatmap.get_order('rows')))
+        # The columns are few enough to be clustered exactly
+        self.assertTrue(np.allclose(heatmap.col_linkage, hierarchy.linkage(
+            self.df[self.numeric_cols].values.T.astype(np.float32), method='average')))
+        plt.close()
+
+    def test_heatmap_aggregate(self):
+        values = np.arange(12, dtype=float).reshape(6, 2)
+        values[1, 0] = np.nan
+        binned, starts = Heatmap.aggregate_bins(values, 3)
+        self.assertEqual(list(starts), [0, 2, 4])
+        self.assertTrue(np.allclose(binned, [[0, 2], [5, 6], [9, 10]]))
+        binned, _ = Heatmap.aggregate_bins(values, 3, how='max')
+        self.assertTrue(np.allclose(binned, [[0, 3], [6, 7], [10, 11]]))
+        # A matrix with more rows than pixels is drawn as one image of at most one row per pixel
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame(rng.normal(size=(5000, 20)), columns=[f'c{i}' for i in range(20)])
+        df['id'] = [f'row{i}' for i in range(len(df))]
+        heatmap = Heatmap(df, list(df.columns[:20]), 'id', cluster_rows=False)
+        ax = heatmap.plot_hm()
+        self.assertEqual(len(ax.images), 1)
+        self.assertEqual(len(ax.collections), 0)
+        self.assertLessEqual(ax.images[0].get_array().shape[0], heatmap.figsize[1] * heatmap.dpi)
+        self.assertLess(len(ax.get_yticklabels()), 50)
+        self.assertEqual(ax.get_yticklabels()[1].get_text(), df['id'].values[int(ax.get_yticks()[1])])
+        plt.close()
+        # seaborn's 'auto' and lists of labels work for the aggregated image too
+        column_labels = [f'col{i}' for i in range(20)]
+        heatmap = Heatmap(df, list(df.columns[:20]), 'id', cluster_rows=False, x_tick_labels=column_labels,
+                          y_tick_labels='auto')
+        ax = heatmap.plot_hm()
+        self.assertEqual(len(ax.images), 1)
+        self.assertEqual(ax.get_yticklabels()[1].get_text(), df['id'].values[int(ax.get_yticks()[1])])
+        self.assertEqual(ax.get_xticklabels()[1].get_text(), column_labels[int(ax.get_xticks()[1])])
+        plt.close()
+        # The rows keep the dataframe order whichever way they are rendered (cluster_rows is on by default)
+        df = df.head(1200)
+        heatmap = Heatmap(df, list(df.columns[:20]), 'id', y_tick_labels=1)
+        for render in ['mesh', 'aggregate']:
+            ax = heatmap.plot_hm(render=render)
+            ticks = [t.get_text() for t in ax.get_yticklabels()]
+            self.assertEqual(ticks[:2], ['row0', df['id'].values[int(ax.get_yticks()[1])]])
+            self.assertEqual(ticks, sorted(ticks, key=lambda t: int(t[3:])))
+            plt.close()
+        # Only an explicit order reorders them
+        linkage = heatmap.get_linkage(heatmap.get_matrix().values)
+        ax = heatmap.plot_hm(row_linkage=linkage)
+        first_row = df.iloc[hierarchy.leaves_list(linkage)[0], :20].values.astype(float)
+        self.assertTrue(np.allclose(ax.images[0].get_array()[0], first_row))
+        plt.close()
+
+    def test_heatmap_matrix_cache(self):
+        df = pd.DataFrame(np.random.default_rng(0).normal(size=(50, 4)), columns=self.numeric_cols)
+        df['label'] = np.repeat(['a', 'b'], 25)
+        heatmap = Heatmap(df, self.numeric_cols, 'label', rows_to_colour=['label'])
+        matrix = heatmap.get_matrix()
+        self.assertEqual(list(matrix.index), list(df['label'].values))
+        # The numeric block is used as is rather than copied, and only built once
+        self.assertTrue(np.shares_memory(matrix.values, df[self.numeric_cols].values))
+        self.assertIs(heatmap.get_matrix(), matrix)
+        luts = heatmap.get_row_colour_luts()
+        self.assertIs(heatmap.get_row_colour_luts(), luts)
+        colours, lut = luts[0]
+        self.assertEqual(sorted(lut), ['a', 'b'])
+        self.assertEqual(list(colours), [lut[label] for label in df['label'].values])
+        heatmap.plot()
+        self.assertIs(heatmap.get_matrix(), matrix)
+        plt.close()
+        # A new dataframe or set of columns rebuilds them
+        heatmap.df = df.copy()
+        self.assertIsNot(heatmap.get_matrix(), matrix)
+        self.assertIsNot(heatmap.get_row_colour_luts(), luts)
+        heatmap.chart_columns = self.numeric_cols[:2]
+        self.assertEqual(list(heatmap.get_matrix().columns), self.numeric_cols[:2])
+        # float32 halves the matrix
+        heatmap = Heatmap(df, self.numeric_cols, 'label', dtype=np.float32)
+        self.assertEqual(heatmap.get_matrix().values.dtype, np.float32)
+
+    def test_sankey_links(self):
+        df = pd.DataFrame({'a': ['x', 'x', 'y', 'x', np.nan], 'b': ['p', 'q', 'p', 'p', 'q'],
+                           'group': ['MDS', 'TMDE', 'MDS', 'other', 'MDS']})
+        sk = Sankeyplot(df)
+        nodes, links = sk.get_nodes_and_links(['a', 'b', 'group'], 'group')
+        self.assertEqual(list(nodes['label']), ['x', 'y', 'nan', 'p', 'q', 'MDS', 'TMDE', 'other'])
+        self.assertEqual(list(nodes['column']), ['a'] * 3 + ['b'] * 2 + ['group'] * 3)
+        # Links in order of first appearance, with the count and the colour of the last row following them
+        self.assertEqual(list(links[['source', 'target', 'value']].itertuples(index=False, name=None)),
+                         [(0, 3, 2), (0, 4, 1), (1, 3, 1), (2, 4, 1), (3, 5, 2), (4, 6, 1), (3, 7, 1), (4, 5, 1)])
+        self.assertEqual(links['colour'].values[0], sk.colours[2])
+        self.assertEqual(links['colour'].values[4], SIRCLE_COLOURS['MDS'])
+        # Colours can be given per value
+        sk = Sankeyplot(df, colours={'MDS': 'red', 'TMDE': 'blue', 'other': 'green'})
+        fig = sk.plot(columns=['a', 'b', 'group'], colour_col='group')
+        self.assertEqual(list(fig.data[0].link.color[4:]), ['red', 'blue', 'green', 'red'])
+
+    def test_sankey_weighted(self):
+        counts = pd.DataFrame({'a': ['x', 'x', 'y'], 'b': ['p', 'q', 'p'], 'group': ['MDS', 'TMDE', 'MDS'],
+                               'n': [3, 1, 2]})
+        # The same as one row per entity
+        entities = counts.loc[counts.index.repeat(counts['n'])].drop(columns='n')
+        nodes, links = Sankeyplot(counts).get_nodes_and_links(['a', 'b', 'group'], 'group', weight_col='n')
+        exp_nodes, exp_links = Sankeyplot(entities).get_nodes_and_links(['a', 'b', 'group'], 'group')
+        self.assertEqual(list(nodes['label']), list(exp_nodes['label']))
+        self.assertEqual(list(links['source']), list(exp_links['source']))
+        self.assertEqual(list(links['target']), list(exp_links['target']))
+        self.assertTrue(np.allclose(links['value'].values.astype(float), exp_links['value'].values.astype(float)))
+        # An edge table, duplicated flows are summed
+        edges = pd.DataFrame({'from': ['x', 'x', 'p', 'x'], 'to': ['p', 'q', 'MDS', 'p'], 'size': [1, 2, 3, 4]})
+        sk = Sankeyplot(edges)
+        nodes, links = sk.get_nodes_and_links_from_edges('from', 'to', 'size')
+        self.assertEqual(list(nodes['label']), ['x', 'p', 'q', 'MDS'])
+        self.assertEqual(list(links[['source', 'target', 'value']].itertuples(index=False, name=None)),
+                         [(0, 1, 5), (0, 2, 2), (1, 3, 3)])
+        fig = sk.plot(source_col='from', target_col='to', value_col='size')
+        self.assertEqual(list(fig.data[0].link.value), [5, 2, 3])
+
+    def test_sankey_matplotlib(self):
+        df = pd.DataFrame({'a': ['x', 'x', 'y', 'x'], 'b': ['p', 'q', 'p', 'p'],
+                           'group': ['MDS', 'TMDE', 'MDS', 'MDS']})
+        sk = Sankeyplot(df, engine='matplotlib', figsize=(4, 3))
+        nodes, links = sk.get_nodes_and_links(['a', 'b', 'group'], 'group')
+        nodes, links = Sankeyplot.get_layout(nodes, links)
+        # Nodes are as tall as their flows and the ribbons fill them exactly
+        self.assertTrue(np.allclose(nodes['height'].values[:2] / nodes['height'].values[0], [1, 1 / 3]))
+        for end in ['source', 'target']:
+            for node, group in links.groupby(end):
+                self.assertTrue(np.isclose(group['height'].sum(), nodes['height'].values[node]))
+                self.assertTrue(np.isclose(group[end + '_top'].max(), nodes['top'].values[node]))
+        self.assertEqual(len(set(nodes['x'])), 3)
+        ax = sk.plot(columns=['a', 'b', 'group'], colour_col='group')
+        self.assertEqual(len(ax.collections[0].get_paths()), len(links))
+        self.assertEqual(len(ax.texts), len(nodes))
+        self.assertEqual(tuple(ax.figure.get_size_inches()), (4, 3))
+        sk.save_svg([self.tmp_dir, 'sankey'])
+        self.assertTrue(any(f.startswith('sankey') for f in os.listdir(self.tmp_dir)))
+        plt.close()
+        # Edge tables are put in stages by the longest path to each node
+        edges = pd.DataFrame({'from': ['x', 'p', 'x'], 'to': ['p', 'MDS', 'MDS'], 'size': [2, 2, 1]})
+        sk = Sankeyplot(edges, engine='matplotlib')
+        nodes, links = sk.get_nodes_and_links_from_edges('from', 'to', 'size')
+        self.assertEqual(list(Sankeyplot.get_node_stages(nodes, links)), [0, 1, 2])
+        sk.plot(source_col='from', target_col='to', value_col='size')
+        plt.close()
+
+    def test_line_collection(self):
+        line = Line(self.df, 'title', 'Xlabel', 'Ylabel')
+        idxs = np.where(self.df['label'] == 'Iris-setosa')[0]
+        cols = [['sepal_length', 'petal_length'], ['sepal_width', 'petal_width']]
+        ax = line.plot_line_grps(idxs, ['length', 'width'], cols)
+        # One artist per group for the profiles, plus one line for each mean
+        self.assertEqual(len(ax.collections), 4)
+        segments = ax.collections[0].get_segments()
+        self.assertEqual(len(segments), len(idxs))
+        self.assertTrue(np.allclose(segments[0][:, 1], self.df[cols[0]].values[idxs[0]]))
+        self.assertTrue(np.allclose(ax.lines[1].get_ydata(), self.df[cols[1]].values[idxs].mean(axis=0)))
+        self.assertEqual([t.get_text() for t in ax.get_legend().get_texts()], ['length', 'width'])
+        self.assertGreaterEqual(ax.get_ylim()[1], self.df[cols[0]].values[idxs].max())
+        plt.close()
+
+    def test_line_summary(self):
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame(rng.normal(size=(2000, 6)), columns=[f't{i}' for i in range(6)])
+        values = df.values[:, :3]
+        summary = Line.summarise(values, quantiles=(0.05, 0.25, 0.75, 0.95))
+        self.assertTrue(np.allclose(summary['mean'], values.mean(axis=0)))
+        self.assertTrue(np.allclose(summary['sd'], values.std(axis=0, ddof=1)))
+        self.assertTrue(np.allclose(summary['sem'], stats.sem(values, axis=0)))
+        self.assertTrue(np.allclose(summary['q0.95'], np.quantile(values, 0.95, axis=0)))
+        line = Line(df)
+        cols = [['t0', 't1', 't2'], ['t3', 't4', 't5']]
+        # Above the threshold no profile is drawn, just the bands
+        ax = line.plot_line_grps(np.arange(len(df)), ['a', 'b', 'c'], cols, labels_lst=['x', 'y'],
+                                 quantiles=(0.05, 0.25, 0.75, 0.95), band='sem')
+        self.assertEqual(len(line.summaries), 2)
+        self.assertFalse(any(isinstance(c, LineCollection) for c in ax.collections))
+        # Two quantile bands and the sem band per group
+        self.assertEqual(len([c for c in ax.collections if isinstance(c, PolyCollection)]), 6)
+        self.assertTrue(np.allclose(ax.lines[0].get_ydata(), summary['mean']))
+        plt.close()
+        # Below it the profiles are drawn as before
+        ax = line.plot_line_grps(np.arange(100), ['a', 'b', 'c'], cols)
+        self.assertEqual(len([c for c in ax.collections if isinstance(c, LineCollection)]), 2)
+        plt.close()